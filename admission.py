@@ -0,0 +1,131 @@
+import math, threading, time
+from collections import deque
+
+class Overloaded(Exception):
+    """Raised when a request is turned away to protect ISE.
+
+    Args:
+        message: Error description as a string.
+        status: HTTP status code to answer with as an integer, 429 when rate
+            limited or 503 when there are too many requests waiting.
+        retry_after: Suggested number of seconds to wait before retrying.
+    """
+    def __init__(self, message, status=503, retry_after=1):
+        Exception.__init__(self, message)
+        self.status = status
+        self.retry_after = retry_after
+
+class Limiter(object):
+    """Limits the requests sent to an ISE node, both by how many can be in
+    flight at once and by rate (a token bucket). Requests that can't go right
+    away wait their turn in order, up to a deadline; if too many are already
+    waiting, they are turned away. This is safe to use from multiple threads.
+
+    Args:
+        concurrency: Optional maximum number of requests in flight at once,
+            None type for no limit.
+        rate: Optional maximum number of requests per second on average,
+            None type for no limit.
+        burst: Optional number of requests that may be sent at once after a
+            quiet period, defaults to rate (at least 1).
+        queue: Optional maximum number of requests waiting at once.
+        timeout: Optional number of seconds a request may wait.
+    """
+    def __init__(self, concurrency=None, rate=None, burst=None, queue=100,
+            timeout=5):
+        self.concurrency = concurrency
+        self.rate = rate
+        self.burst = burst or max(1, rate or 0)
+        self.queue = queue
+        self.timeout = timeout
+        self.tokens = self.burst
+        self.refilled = time.monotonic()
+        self.active = 0
+        self.waiting = deque() # tickets of waiting requests, in order
+        self.condition = threading.Condition()
+
+    def refill(self, now):
+        """Add the tokens earned since the last refill. Call with the
+        condition held.
+
+        Args:
+            now: Current time.monotonic() value.
+        """
+        if self.rate:
+            self.tokens = min(self.burst,
+                    self.tokens + (now - self.refilled) * self.rate)
+        self.refilled = now
+
+    def retry_after(self):
+        """Estimate how long a new request would have to wait. Call with the
+        condition held.
+
+        Returns:
+            Number of seconds as an integer, at least 1.
+        """
+        if self.rate:
+            wait = (len(self.waiting) + 1 - self.tokens) / self.rate
+        else:
+            wait = self.timeout * len(self.waiting) / float(self.queue or 1)
+        return max(1, int(math.ceil(wait)))
+
+    def acquire(self, timeout=None):
+        """Wait for a turn to send a request. Call release() once it is done.
+
+        Args:
+            timeout: Optional number of seconds to wait, instead of the
+                limiter's timeout.
+
+        Raises:
+            Overloaded if too many requests are waiting, or if the wait would
+            pass the deadline.
+        """
+        timeout = self.timeout if timeout is None else timeout
+        with self.condition:
+            if len(self.waiting) >= self.queue:
+                raise Overloaded('Too many requests waiting for ISE', 503,
+                        self.retry_after())
+            ticket = object()
+            self.waiting.append(ticket)
+            deadline = time.monotonic() + timeout
+            try:
+                while True:
+                    now = time.monotonic()
+                    self.refill(now)
+                    slot = (self.concurrency is None or
+                            self.active < self.concurrency)
+                    token = not self.rate or self.tokens >= 1
+                    if self.waiting[0] is ticket and slot and token:
+                        self.active += 1
+                        if self.rate:
+                            self.tokens -= 1
+                        return
+                    if now >= deadline:
+                        if not token:
+                            raise Overloaded('ISE request rate limit ' +
+                                    'exceeded', 429, self.retry_after())
+                        raise Overloaded('Timed out waiting for ISE', 503,
+                                self.retry_after())
+                    wait = deadline - now
+                    if not token:
+                        # nobody releases tokens, so wake up when one is due
+                        wait = min(wait, (1 - self.tokens) / self.rate)
+                    self.condition.wait(wait)
+            finally:
+                self.waiting.remove(ticket)
+                self.condition.notify_all()
+
+    def release(self):
+        """Note that a request from acquire() is done."""
+        with self.condition:
+            self.active -= 1
+            self.condition.notify_all()
+
+    def status(self):
+        """Get a summary of the limiter.
+
+        Returns:
+            Dictionary with 'active' and 'waiting' keys.
+        """
+        with self.condition:
+            return {'active': self.active, 'waiting': len(self.waiting)}
@@ -0,0 +1,106 @@
+"""Benchmarks for normalizing MAC addresses in bulk, comparing the old
+character-by-character ISETools.parse_mac with maccodec, on a mix of Cisco
+dotted, hyphenated, colon-separated and bare addresses with a few invalid
+ones.
+
+Run from the project folder:
+    python benchmarks/bench_maccodec.py --rows 1000000
+"""
+import argparse, os, random, sys, time, types
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+try:
+    import settings
+except ImportError:
+    # benchmarks don't talk to ISE, so placeholder settings are enough
+    settings = sys.modules['settings'] = types.ModuleType('settings')
+    settings.GROUP_ID = '6c2b5f70-8c00-11e6-996c-525400b48521'
+    settings.IPSK_ADMINS = []
+import isetools, maccodec
+
+def make_macs(rows, seed=0):
+    """Make a list of MAC addresses in mixed forms, about 1% invalid."""
+    rand = random.Random(seed)
+    macs = []
+    for _ in range(rows):
+        text = '%012x' % rand.getrandbits(48)
+        form = rand.randrange(4)
+        if form == 0:
+            mac = '.'.join(text[i:i + 4] for i in range(0, 12, 4))
+        elif form == 1:
+            mac = '-'.join(text[i:i + 2] for i in range(0, 12, 2)).upper()
+        elif form == 2:
+            mac = ':'.join(text[i:i + 2] for i in range(0, 12, 2))
+        else:
+            mac = text.upper()
+        if rand.random() < 0.01:
+            mac = mac[:-1]
+        macs.append(mac)
+    return macs
+
+def legacy_parse_mac(mac):
+    mac = mac.upper()
+    mac = ''.join(char for char in mac if char in 'ABCDEF0123456789')
+    if len(mac) != 12:
+        raise SyntaxError('MAC Address needs to be 12 characters')
+    return ':'.join(mac[i:i+2] for i in range(0, len(mac), 2))
+
+def one_at_a_time(parse, macs):
+    normalized = []
+    errors = {}
+    for i, mac in enumerate(macs):
+        try:
+            normalized.append(parse(mac))
+        except SyntaxError as e:
+            normalized.append(None)
+            errors[i] = str(e)
+    return normalized, errors
+
+def bench(name, func, rows, repeat):
+    seconds = min(timed(func) for _ in range(repeat))
+    print('{:<36} {:>8.2f} s {:>8.3f} us/row'.format(name, seconds,
+            seconds / rows * 1e6))
+
+def timed(func):
+    started = time.perf_counter()
+    func()
+    return time.perf_counter() - started
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rows', type=int, default=1000000,
+            help='MAC addresses per batch')
+    parser.add_argument('--repeat', type=int, default=3,
+            help='runs of each benchmark, the fastest is reported')
+    args = parser.parse_args()
+    tools = isetools.ISETools(['ise1'], 'user', 'pass', None)
+    macs = make_macs(args.rows)
+    expected = one_at_a_time(legacy_parse_mac, macs)
+    assert maccodec.normalize_many(macs) == expected
+    assert one_at_a_time(tools.parse_mac, macs) == expected
+    values = maccodec.to_int_many(macs)[0]
+    valid = [value for value in values if value is not None]
+    assert maccodec.from_int_many(valid) == [mac for mac in expected[0]
+            if mac is not None]
+
+    print('Normalize %d MAC addresses' % args.rows)
+    bench('  before: parse_mac, one at a time',
+            lambda: one_at_a_time(legacy_parse_mac, macs), args.rows,
+            args.repeat)
+    bench('  after: parse_mac, one at a time',
+            lambda: one_at_a_time(tools.parse_mac, macs), args.rows,
+            args.repeat)
+    bench('  after: normalize_many',
+            lambda: maccodec.normalize_many(macs), args.rows, args.repeat)
+    print('48-bit integer form')
+    bench('  to_int_many', lambda: maccodec.to_int_many(macs), args.rows,
+            args.repeat)
+    bench('  from_int_many', lambda: maccodec.from_int_many(valid),
+            args.rows, args.repeat)
+    strings = set(mac for mac in expected[0] if mac is not None)
+    integers = set(valid)
+    print('De-duplicated set of %d addresses' % len(strings))
+    print('  strings  {:>8.1f} MB'.format((sys.getsizeof(strings) +
+            sum(map(sys.getsizeof, strings))) / 1e6))
+    print('  integers {:>8.1f} MB'.format((sys.getsizeof(integers) +
+            sum(map(sys.getsizeof, integers))) / 1e6))
@@ -0,0 +1,128 @@
+"""Microbenchmarks for building ERS request bodies and parsing ERS responses,
+comparing the old XML/BeautifulSoup handling with the JSON handling in
+isetools.
+
+Run from the project folder:
+    python benchmarks/bench_serialization.py
+"""
+import json, os, sys, timeit, types
+import xml.etree.ElementTree as ElemTree
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+try:
+    import settings
+except ImportError:
+    # benchmarks don't talk to ISE, so placeholder settings are enough
+    settings = sys.modules['settings'] = types.ModuleType('settings')
+    settings.GROUP_ID = '6c2b5f70-8c00-11e6-996c-525400b48521'
+    settings.IPSK_ADMINS = []
+import isetools
+
+MAC = '74:31:7D:60:9C:9B'
+PSK = 'bcdfghjklmnp'
+UNID = 'u0000000'
+ENDPOINTID = '74317d60-9c9b-1118-ab3e-0050596dbc91'
+
+SEARCH_XML = ("<?xml version='1.0' encoding='UTF-8' standalone='yes'?>" +
+        "<ns3:searchResult total='1' xmlns:ns5='ers.ise.cisco.com' " +
+        "xmlns:ns3='v2.ers.ise.cisco.com'><ns3:resources><ns5:resource " +
+        "description='' id='" + ENDPOINTID + "' name='" + MAC + "'>" +
+        "<link rel='self' href='https://ise1:9060/ers/config/endpoint/" +
+        ENDPOINTID + "' type='application/xml'/></ns5:resource>" +
+        "</ns3:resources></ns3:searchResult>")
+SEARCH_JSON = json.dumps({'SearchResult': {'total': 1, 'resources': [
+        {'id': ENDPOINTID, 'name': MAC, 'link': {'rel': 'self',
+        'href': 'https://ise1:9060/ers/config/endpoint/' + ENDPOINTID,
+        'type': 'application/json'}}]}})
+ERROR_HTML = ('<html><head><title>Error report</title></head><body>' +
+        '<h1>HTTP Status 401 - Unauthorized</h1><hr/><p><b>Type</b> Status ' +
+        'Report</p><p><b>Description</b> The request has not been applied ' +
+        'because it lacks valid authentication credentials.</p><hr/>' +
+        '<h3>Apache Tomcat</h3></body></html>')
+
+class Response(object):
+    """Just enough of requests.Response for parsing."""
+    def __init__(self, text, status_code=200):
+        self.text = text
+        self.status_code = status_code
+
+    def __str__(self):
+        return '<Response [' + str(self.status_code) + ']>'
+
+    def json(self):
+        return json.loads(self.text)
+
+def legacy_body():
+    return """<?xml version='1.0' encoding='UTF-8' standalone='yes'?>
+            <ns3:endpoint name='name' id='id' description='description'
+            xmlns:ns2='ers.ise.cisco.com'
+            xmlns:ns3='identity.ers.ise.cisco.com'>
+                <customAttributes>
+                    <customAttributes>
+                        <entry>
+                            <key>iPSK</key>
+                            <value>psk=""" + PSK + """</value>
+                        </entry>
+                    </customAttributes>
+                </customAttributes>
+            <groupId>""" + settings.GROUP_ID + """</groupId>
+            <identityStore></identityStore>
+            <identityStoreId></identityStoreId>
+            <mac>""" + MAC + """</mac>
+            <portalUser>""" + UNID + """</portalUser>
+            <profileId></profileId>
+            <staticGroupAssignment>true</staticGroupAssignment>
+            <staticProfileAssignment>false</staticProfileAssignment>
+            </ns3:endpoint>"""
+
+def legacy_search(result):
+    root = ElemTree.fromstring(result.text)
+    responseCode = str(result).split('[')[1].split(']')[0]
+    for child in root.iter():
+        if 'id' in child.attrib:
+            return child.attrib['id'], responseCode
+
+def legacy_error(result):
+    from bs4 import BeautifulSoup
+    soup = BeautifulSoup(result.text, 'html.parser')
+    errorsummary = soup.body.h1.get_text()
+    errordescription = (soup.body.find('p').find_next('p').get_text(
+            ).split('Description ')[1])
+    return errorsummary, errordescription
+
+def current_search(tools, result):
+    return tools.get_endpointid(MAC)
+
+def current_error(tools, result):
+    try:
+        tools.raise_error(result)
+    except isetools.ISEAPIError as e:
+        return str(e)
+
+def bench(name, func, number):
+    seconds = min(timeit.repeat(func, number=number, repeat=5))
+    print('{:<28} {:>10.2f} us/call'.format(name, seconds / number * 1e6))
+
+if __name__ == '__main__':
+    import logging
+    logging.disable(logging.CRITICAL)
+    tools = isetools.ISETools(['ise1'], 'user', 'pass', None)
+    tools.cache.maxsize = 0 # measure parsing, not the cache
+    search = Response(SEARCH_JSON)
+    tools.read = lambda path, headers, **kwargs: search
+
+    print('Request body')
+    bench('  before: XML concatenation', legacy_body, 100000)
+    bench('  after: JSON', lambda: tools.endpoint_json(MAC, PSK, UNID),
+            100000)
+    print('Search response')
+    legacy = Response(SEARCH_XML)
+    bench('  before: ElementTree', lambda: legacy_search(legacy), 20000)
+    bench('  after: JSON', lambda: current_search(tools, search), 20000)
+    print('HTML error page')
+    error = Response(ERROR_HTML, 401)
+    try:
+        bench('  before: BeautifulSoup', lambda: legacy_error(error), 2000)
+    except ImportError:
+        print('  before: BeautifulSoup      (bs4 not installed, skipped)')
+    bench('  after: regex', lambda: current_error(tools, error), 20000)
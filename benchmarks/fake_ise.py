@@ -0,0 +1,360 @@
+"""A local stand-in for the ISE ERS API, for load tests and benchmarks.
+
+Each fake node listens on port 9060 of its own loopback address (127.0.0.1,
+127.0.0.2, ...) so the server list works exactly as it does against ISE. The
+nodes share one in-memory endpoint store, like a replicated ISE deployment,
+and only the primary admin node (PAN) accepts writes. Bulk requests are not
+emulated.
+
+Run from the project folder:
+    python benchmarks/fake_ise.py --nodes 2 --latency 0.05
+"""
+import argparse, base64, json, os, random, sys, tempfile, types, uuid
+from collections import Counter
+from tornado import gen, httpserver, ioloop, log, web
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+try:
+    import settings
+except ImportError:
+    # the fake ISE only needs enough settings to generate a certificate
+    settings = sys.modules['settings'] = types.ModuleType('settings')
+    settings.GROUP_ID = '6c2b5f70-8c00-11e6-996c-525400b48521'
+    settings.IPSK_ADMINS = []
+from setup_certs import setup_certs
+
+PORT = 9060
+CONTROL_PORT = 9061
+
+NOT_PAN_HTML = ('<html><head><title>Error report</title></head><body>' +
+        '<h1>HTTP Status 401 - Unauthorized</h1><hr/><p><b>Type</b> Status ' +
+        'Report</p><p><b>Description</b> CRUD operation is allowed on PAP ' +
+        'node only</p><hr/><h3>Apache Tomcat</h3></body></html>')
+UNAUTHORIZED_HTML = ('<html><head><title>Error report</title></head><body>' +
+        '<h1>HTTP Status 401 - Unauthorized</h1><hr/><p><b>Type</b> Status ' +
+        'Report</p><p><b>Description</b> The request has not been applied ' +
+        'because it lacks valid authentication credentials.</p><hr/>' +
+        '<h3>Apache Tomcat</h3></body></html>')
+
+def mac_for(number):
+    """Get the MAC address of a preloaded endpoint.
+
+    Args:
+        number: Endpoint number as an integer.
+
+    Returns:
+        MAC address as a string.
+    """
+    return '02:00:' + ':'.join('%02X' % ((number >> shift) & 0xff)
+            for shift in (24, 16, 8, 0))
+
+class FakeCluster(object):
+    """Endpoint store and behavior shared by every fake node.
+
+    Args:
+        nodes: Number of nodes as an integer.
+        pan: Optional index of the node that acts as the PAN.
+        username: Optional ERS username to accept.
+        password: Optional ERS password to accept.
+        latency: Optional seconds each read takes.
+        write_latency: Optional seconds each write takes.
+        jitter: Optional maximum extra seconds added to each request.
+        timeout_rate: Optional fraction of requests (0-1) that hang.
+        hang: Optional seconds a hanging request takes to answer.
+        error_rate: Optional fraction of requests (0-1) that fail with a 500.
+    """
+    def __init__(self, nodes, pan=0, username='bench', password='bench',
+            latency=0, write_latency=0, jitter=0, timeout_rate=0, hang=15,
+            error_rate=0):
+        self.servers = ['127.0.0.' + str(node + 1) for node in range(nodes)]
+        self.pan = self.servers[pan]
+        self.auth = 'Basic ' + base64.b64encode((username + ':' +
+                password).encode('utf-8')).decode('ascii')
+        self.latency = latency
+        self.write_latency = write_latency
+        self.jitter = jitter
+        self.timeout_rate = timeout_rate
+        self.hang = hang
+        self.error_rate = error_rate
+        self.endpoints = {} # Endpoint ID -> ERSEndPoint details
+        self.names = {} # MAC address -> Endpoint ID
+        self.calls = Counter() # (server, operation) -> number of calls
+
+    def preload(self, count, group, unid='bench'):
+        """Fill the store with endpoints numbered 0 to count - 1.
+
+        Args:
+            count: Number of endpoints as an integer.
+            group: Endpoint group ID to put them in as a string.
+            unid: Optional uNID to register them to as a string.
+        """
+        for number in range(count):
+            self.save({'name': mac_for(number), 'mac': mac_for(number),
+                    'groupId': group, 'portalUser': unid,
+                    'staticGroupAssignment': True,
+                    'staticProfileAssignment': False,
+                    'customAttributes': {'customAttributes':
+                    {'iPSK': 'psk=preloaded' + str(number)}}})
+
+    def save(self, details, endpointid=None):
+        """Create or replace an endpoint.
+
+        Args:
+            details: ERSEndPoint dictionary.
+            endpointid: Optional Endpoint ID as a string, for updates.
+
+        Returns:
+            Endpoint ID as a string.
+        """
+        endpointid = endpointid or str(uuid.uuid4())
+        old = self.endpoints.get(endpointid)
+        if old is not None:
+            self.names.pop(old['mac'], None)
+        details = dict(details, id=endpointid)
+        details['name'] = details['mac'] = details['mac'].upper()
+        self.endpoints[endpointid] = details
+        self.names[details['mac']] = endpointid
+        return endpointid
+
+    def delete(self, endpointid):
+        """Remove an endpoint.
+
+        Args:
+            endpointid: Endpoint ID as a string.
+
+        Returns:
+            True if the endpoint existed, False otherwise.
+        """
+        details = self.endpoints.pop(endpointid, None)
+        if details is None:
+            return False
+        self.names.pop(details['mac'], None)
+        return True
+
+    def stats(self):
+        """Get the number of calls made to each node.
+
+        Returns:
+            Dictionary of server name -> dictionary of operation -> calls.
+        """
+        stats = {}
+        for (server, operation), calls in self.calls.items():
+            stats.setdefault(server, {})[operation] = calls
+        return stats
+
+    def listen(self, certfile, keyfile, control_port=CONTROL_PORT):
+        """Start every node, and a control port for call statistics, on the
+        current IOLoop.
+
+        Args:
+            certfile: HTTPS certificate filename.
+            keyfile: HTTPS private key filename.
+            control_port: Optional port for the control API on 127.0.0.1.
+        """
+        for server in self.servers:
+            app = web.Application(handlers, cluster=self, server=server)
+            httpserver.HTTPServer(app, ssl_options={'certfile': certfile,
+                    'keyfile': keyfile}).listen(PORT, server)
+        web.Application([(r"/calls", Calls)], cluster=self).listen(
+                control_port, '127.0.0.1')
+
+class ERSHandler(web.RequestHandler):
+    """Base handler with the authentication, latency, failure and PAN
+    behavior common to every ERS resource.
+    """
+    operation = 'unknown'
+    write_methods = ('POST', 'PUT', 'DELETE')
+
+    async def prepare(self):
+        self.cluster = self.settings['cluster']
+        server = self.settings['server']
+        write = self.request.method in self.write_methods
+        self.cluster.calls[(server, self.request.method + ' ' +
+                self.operation)] += 1
+
+        cluster = self.cluster
+        delay = (cluster.write_latency if write else cluster.latency)
+        delay += random.uniform(0, cluster.jitter)
+        if random.random() < cluster.timeout_rate:
+            delay = cluster.hang
+        if delay:
+            await gen.sleep(delay)
+
+        if self.request.headers.get('Authorization') != cluster.auth:
+            self.html_error(401, UNAUTHORIZED_HTML)
+        elif random.random() < cluster.error_rate:
+            self.ers_error(500, 'Simulated internal error')
+        elif write and server != cluster.pan:
+            self.html_error(401, NOT_PAN_HTML)
+
+    def html_error(self, status, html):
+        self.set_status(status)
+        self.set_header('Content-Type', 'text/html')
+        self.finish(html)
+
+    def ers_error(self, status, title):
+        self.set_status(status)
+        self.finish({'ERSResponse': {'operation': self.request.method + '-' +
+                self.operation, 'messages': [{'title': title,
+                'type': 'ERROR', 'code': 'Application resource validation ' +
+                'exception'}]}})
+
+    def search_result(self, resources, total):
+        server = self.settings['server']
+        self.finish({'SearchResult': {'total': total, 'resources': [
+                {'id': details['id'], 'name': details['name'], 'link': {
+                'rel': 'self', 'href': 'https://' + server + ':' + str(PORT) +
+                '/ers/config/endpoint/' + details['id'],
+                'type': 'application/json'}} for details in resources]}})
+
+class VersionInfo(ERSHandler):
+    operation = 'versioninfo'
+
+    def get(self):
+        self.finish({'VersionInfo': {'currentServerVersion': '1.4',
+                'supportedVersions': '1.0,1.1,1.2,1.3,1.4'}})
+
+class Endpoints(ERSHandler):
+    operation = 'endpoint'
+
+    def get(self):
+        field, _, value = self.get_argument('filter', '').partition('.EQ.')
+        if field == 'mac':
+            endpointid = self.cluster.names.get(value.upper())
+            found = [self.cluster.endpoints[endpointid]] if endpointid else []
+            self.search_result(found, len(found))
+        elif field == 'groupId':
+            size = int(self.get_argument('size', 20))
+            page = int(self.get_argument('page', 1))
+            found = [details for details in self.cluster.endpoints.values()
+                    if details.get('groupId') == value]
+            self.search_result(found[(page - 1) * size:page * size],
+                    len(found))
+        else:
+            self.search_result(list(self.cluster.endpoints.values()),
+                    len(self.cluster.endpoints))
+
+    def post(self):
+        details = json.loads(self.request.body)['ERSEndPoint']
+        if details['mac'].upper() in self.cluster.names:
+            self.ers_error(500, 'Unable to create the endpoint. ' +
+                    details['mac'] + ' already exists.')
+            return
+        endpointid = self.cluster.save(details)
+        self.set_status(201)
+        self.set_header('Location', 'https://' + self.settings['server'] +
+                ':' + str(PORT) + '/ers/config/endpoint/' + endpointid)
+        self.finish()
+
+class EndpointByName(ERSHandler):
+    operation = 'endpoint/name'
+
+    def get(self, mac):
+        endpointid = self.cluster.names.get(mac.upper())
+        if endpointid is None:
+            self.ers_error(404, 'Resource not found')
+        else:
+            self.finish({'ERSEndPoint': self.cluster.endpoints[endpointid]})
+
+class Endpoint(ERSHandler):
+    operation = 'endpoint/id'
+
+    def get(self, endpointid):
+        details = self.cluster.endpoints.get(endpointid)
+        if details is None:
+            self.ers_error(404, 'Resource not found')
+        else:
+            self.finish({'ERSEndPoint': details})
+
+    def put(self, endpointid):
+        if endpointid not in self.cluster.endpoints:
+            self.ers_error(404, 'Resource not found')
+            return
+        details = json.loads(self.request.body)['ERSEndPoint']
+        self.cluster.save(details, endpointid)
+        self.finish({'UpdatedFieldsList': {'updatedField': []}})
+
+    def delete(self, endpointid):
+        if self.cluster.delete(endpointid):
+            self.set_status(204)
+            self.finish()
+        else:
+            self.ers_error(404, 'Resource not found')
+
+class Calls(web.RequestHandler):
+    """Control API: GET the number of ERS calls per node, DELETE to reset."""
+    def get(self):
+        self.finish(self.settings['cluster'].stats())
+
+    def delete(self):
+        self.settings['cluster'].calls.clear()
+        self.set_status(204)
+        self.finish()
+
+handlers = [
+    (r"/ers/config/service/versioninfo", VersionInfo),
+    (r"/ers/config/endpoint/?", Endpoints),
+    (r"/ers/config/endpoint/name/([^/]+)", EndpointByName),
+    (r"/ers/config/endpoint/([^/]+)", Endpoint),
+]
+
+def make_certs(folder=None):
+    """Generate a self-signed certificate for the fake nodes.
+
+    Args:
+        folder: Optional folder to put the files in, defaults to a new
+            temporary folder.
+
+    Returns:
+        Certificate filename and key filename.
+    """
+    folder = folder or tempfile.mkdtemp(prefix='fake_ise')
+    return setup_certs(os.path.join(folder, 'fake_ise.cer'),
+            os.path.join(folder, 'fake_ise.key'))
+
+def add_arguments(parser):
+    """Add the fake ISE options to an argparse parser."""
+    parser.add_argument('--nodes', type=int, default=2,
+            help='number of ISE nodes (127.0.0.1, 127.0.0.2, ...)')
+    parser.add_argument('--pan', type=int, default=-1,
+            help='index of the node that acts as the PAN (default: last)')
+    parser.add_argument('--endpoints', type=int, default=1000,
+            help='number of endpoints to preload in GROUP_ID')
+    parser.add_argument('--latency', type=float, default=0.02,
+            help='seconds each ERS read takes')
+    parser.add_argument('--write-latency', type=float, default=0.05,
+            help='seconds each ERS write takes')
+    parser.add_argument('--jitter', type=float, default=0.01,
+            help='maximum random seconds added to each ERS call')
+    parser.add_argument('--timeout-rate', type=float, default=0,
+            help='fraction of ERS calls that hang for --hang seconds')
+    parser.add_argument('--hang', type=float, default=15,
+            help='seconds a hanging ERS call takes (client timeout is 10)')
+    parser.add_argument('--error-rate', type=float, default=0,
+            help='fraction of ERS calls that fail with a 500')
+    parser.add_argument('--control-port', type=int, default=CONTROL_PORT,
+            help='port on 127.0.0.1 that reports ERS calls per node')
+
+def run(args, ready=None):
+    """Run the fake ISE nodes until the process is stopped.
+
+    Args:
+        args: Parsed arguments from add_arguments().
+        ready: Optional multiprocessing Event to set once listening.
+    """
+    cluster = FakeCluster(args.nodes, pan=args.pan % args.nodes,
+            latency=args.latency, write_latency=args.write_latency,
+            jitter=args.jitter, timeout_rate=args.timeout_rate,
+            hang=args.hang, error_rate=args.error_rate)
+    cluster.preload(args.endpoints, settings.GROUP_ID)
+    certfile, keyfile = make_certs()
+    cluster.listen(certfile, keyfile, args.control_port)
+    if ready is not None:
+        ready.set()
+    ioloop.IOLoop.current().start()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    add_arguments(parser)
+    log.enable_pretty_logging()
+    run(parser.parse_args())
@@ -0,0 +1,298 @@
+"""Load test the web server against fake ISE nodes.
+
+Starts the fake ISE ERS API (benchmarks/fake_ise.py) in a separate process,
+creates the web server with main.create_server, and sends concurrent traffic
+for each scenario: iPSK registrations (POST /ise/psk), lookups
+(GET /ise/psk), health checks (/ise/test) and Ruckus DPSK generation. Reports
+latency percentiles, throughput and the number of ERS calls per request.
+
+Results can be saved and compared with a later run, to catch regressions
+before deploying:
+    python benchmarks/loadtest.py --save before.json
+    python benchmarks/loadtest.py --compare before.json
+
+The fake nodes listen on 127.0.0.1, 127.0.0.2, ... which works out of the box
+on Linux. Other systems need loopback aliases for more than one node.
+"""
+import argparse, json, logging, math, multiprocessing, os, random, sys, time
+import types, warnings
+from urllib.parse import urlencode
+from requests.packages.urllib3.exceptions import InsecureRequestWarning
+from tornado import gen, httpclient, ioloop, log, netutil
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+try:
+    import settings
+except ImportError:
+    # the fake ISE stands in for the real thing, so placeholders will do
+    settings = sys.modules['settings'] = types.ModuleType('settings')
+    settings.GROUP_ID = '6c2b5f70-8c00-11e6-996c-525400b48521'
+    settings.IPSK_ADMINS = []
+import main, fake_ise
+
+SCENARIOS = ['register', 'lookup', 'test', 'ruckus']
+DPSK_PATH = ('/api/public/v4_0/rkszones/' + main.ruckushandlers.zone_uuid +
+        '/wlans/' + main.ruckushandlers.wlan_uuid + '/dpsk/upload')
+BOUNDARY = 'loadtestboundary'
+
+def percentile(values, percent):
+    """Get a percentile of a list of numbers, by the nearest-rank method.
+
+    Args:
+        values: Sorted list of numbers.
+        percent: Percentile to get as a number from 0 to 100.
+
+    Returns:
+        The percentile as a number, or None if values is empty.
+    """
+    if not values:
+        return None
+    rank = int(math.ceil(percent / 100.0 * len(values)))
+    return values[min(max(rank, 1), len(values)) - 1]
+
+class LoadTest(object):
+    """Sends one scenario's worth of requests at a time to the web server.
+
+    Args:
+        base: Base URL of the web server as a string.
+        endpoints: Number of endpoints preloaded in the fake ISE as an integer.
+        concurrency: Number of requests in flight at once as an integer.
+        seed: Random seed as an integer, so runs send the same traffic.
+    """
+    def __init__(self, base, endpoints, concurrency, seed=0):
+        self.base = base
+        self.endpoints = endpoints
+        self.concurrency = concurrency
+        self.random = random.Random(seed)
+        self.registered = 0 # new endpoints registered so far
+        self.client = httpclient.AsyncHTTPClient(max_clients=concurrency)
+
+    def register(self):
+        # half update preloaded endpoints, half create new ones
+        if self.random.random() < 0.5:
+            mac = fake_ise.mac_for(self.random.randrange(self.endpoints))
+        else:
+            self.registered += 1
+            mac = fake_ise.mac_for(self.endpoints + self.registered)
+        body = json.dumps({'mac': mac, 'psk': 'load' + str(self.random.random()),
+                'unid': 'u0000000', 'firstname': 'Load', 'lastname': 'Test'})
+        return httpclient.HTTPRequest(self.base + '/ise/psk', method='POST',
+                headers={'Content-Type': 'application/json'}, body=body)
+
+    def lookup(self):
+        mac = fake_ise.mac_for(self.random.randrange(self.endpoints))
+        return httpclient.HTTPRequest(self.base + '/ise/psk?' +
+                urlencode({'mac': mac}))
+
+    def test(self):
+        return httpclient.HTTPRequest(self.base + '/ise/test')
+
+    def ruckus(self):
+        # alternate between Ruckus DPSK uploads and plain PSK generation
+        if self.random.random() < 0.5:
+            return httpclient.HTTPRequest(self.base + '/ise/psk/generate')
+        body = ('--' + BOUNDARY + '\r\nContent-Disposition: form-data; ' +
+                'name="file"; filename="dpsk.csv"\r\nContent-Type: text/csv' +
+                '\r\n\r\nloaduser,,,\r\n--' + BOUNDARY + '--\r\n')
+        return httpclient.HTTPRequest(self.base + DPSK_PATH, method='POST',
+                headers={'Content-Type': 'multipart/form-data; boundary=' +
+                BOUNDARY}, body=body)
+
+    @gen.coroutine
+    def run(self, scenario, count):
+        """Send requests for a scenario.
+
+        Args:
+            scenario: Scenario name as a string, one of SCENARIOS.
+            count: Number of requests to send as an integer.
+
+        Returns:
+            latencies: Sorted list of request latencies in seconds.
+            errors: Number of failed requests as an integer.
+            elapsed: Seconds the scenario took as a float.
+        """
+        make_request = getattr(self, scenario)
+        latencies = []
+        errors = [0]
+        remaining = [count]
+
+        @gen.coroutine
+        def worker():
+            while remaining[0] > 0:
+                remaining[0] -= 1
+                request = make_request()
+                request.request_timeout = 60
+                started = time.monotonic()
+                response = yield self.client.fetch(request, raise_error=False)
+                latencies.append(time.monotonic() - started)
+                if response.code >= 400 or response.code < 200:
+                    errors[0] += 1
+
+        started = time.monotonic()
+        yield [worker() for _ in range(self.concurrency)]
+        raise gen.Return((sorted(latencies), errors[0],
+                time.monotonic() - started))
+
+@gen.coroutine
+def ers_calls(client, port):
+    """Get the number of ERS calls the fake ISE nodes have answered, and
+    reset the counts.
+
+    Returns:
+        Dictionary of operation -> number of calls, across all nodes.
+    """
+    url = 'http://127.0.0.1:' + str(port) + '/calls'
+    response = yield client.fetch(url)
+    yield client.fetch(url, method='DELETE')
+    totals = {}
+    for operations in json.loads(response.body.decode('utf-8')).values():
+        for operation, calls in operations.items():
+            totals[operation] = totals.get(operation, 0) + calls
+    raise gen.Return(totals)
+
+@gen.coroutine
+def run_scenarios(args, base):
+    """Run each scenario and collect its results.
+
+    Returns:
+        Dictionary of scenario name -> result dictionary.
+    """
+    loadtest = LoadTest(base, args.endpoints, args.concurrency, args.seed)
+    # let PAN discovery and connection warm-up finish first
+    started = time.monotonic()
+    while (yield loadtest.client.fetch(base + '/ise/ready',
+            raise_error=False)).code != 200:
+        yield gen.sleep(0.05)
+    print('ready after %.1f ms' % ((time.monotonic() - started) * 1000))
+    results = {}
+    for scenario in args.scenarios:
+        if args.warmup:
+            yield loadtest.run(scenario, args.warmup)
+        yield ers_calls(loadtest.client, args.control_port)
+        latencies, errors, elapsed = yield loadtest.run(scenario,
+                args.requests)
+        calls = yield ers_calls(loadtest.client, args.control_port)
+        results[scenario] = {
+            'requests': len(latencies),
+            'errors': errors,
+            'throughput': len(latencies) / elapsed,
+            'p50': percentile(latencies, 50),
+            'p95': percentile(latencies, 95),
+            'p99': percentile(latencies, 99),
+            'ers_calls': calls,
+            'ers_per_request': sum(calls.values()) / float(len(latencies)),
+        }
+        print_result(scenario, results[scenario])
+    raise gen.Return(results)
+
+def print_result(scenario, result):
+    """Print one scenario's results."""
+    print('%-9s %6d requests %4d errors %8.1f req/s  p50 %7.1f ms  '
+            'p95 %7.1f ms  p99 %7.1f ms  %5.2f ERS calls/request' % (
+            scenario, result['requests'], result['errors'],
+            result['throughput'], result['p50'] * 1000,
+            result['p95'] * 1000, result['p99'] * 1000,
+            result['ers_per_request']))
+    for operation, calls in sorted(result['ers_calls'].items()):
+        print('%-9s     %-22s %6d' % ('', operation, calls))
+
+def compare(results, baseline, tolerance):
+    """Compare results with a saved run.
+
+    Args:
+        results: Dictionary of scenario name -> result dictionary.
+        baseline: Results of the saved run, in the same form.
+        tolerance: Allowed slowdown as a fraction (0.1 = 10%).
+
+    Returns:
+        List of regressions as strings, empty if there are none.
+    """
+    regressions = []
+    for scenario, result in results.items():
+        before = baseline.get(scenario)
+        if before is None:
+            continue
+        for key in ('p50', 'p95', 'p99'):
+            if result[key] > before[key] * (1 + tolerance):
+                regressions.append('%s %s %.1f ms -> %.1f ms' % (scenario,
+                        key, before[key] * 1000, result[key] * 1000))
+        if result['throughput'] < before['throughput'] * (1 - tolerance):
+            regressions.append('%s throughput %.1f -> %.1f req/s' % (scenario,
+                    before['throughput'], result['throughput']))
+        if result['ers_per_request'] > before['ers_per_request'] + 0.01:
+            regressions.append('%s ERS calls/request %.2f -> %.2f' % (
+                    scenario, before['ers_per_request'],
+                    result['ers_per_request']))
+        if result['errors'] > before['errors']:
+            regressions.append('%s errors %d -> %d' % (scenario,
+                    before['errors'], result['errors']))
+    return regressions
+
+def main_loadtest(args):
+    """Start the fake ISE and the web server, run the load test, and report.
+
+    Returns:
+        Exit status as an integer, 1 if there were regressions.
+    """
+    ready = multiprocessing.Event()
+    fake = multiprocessing.Process(target=fake_ise.run, args=(args, ready))
+    fake.daemon = True
+    fake.start()
+    if not ready.wait(30):
+        raise RuntimeError('Fake ISE did not start')
+
+    try:
+        serverlist = ['127.0.0.' + str(node + 1)
+                for node in range(args.nodes)]
+        server = main.create_server(serverlist, 'bench', 'bench',
+                workers=args.workers, sync_interval=args.sync_interval,
+                verify=False, hedge_reads=args.hedge_reads)
+        sockets = netutil.bind_sockets(0, '127.0.0.1')
+        server.add_sockets(sockets)
+        base = 'http://127.0.0.1:' + str(sockets[0].getsockname()[1])
+        results = ioloop.IOLoop.current().run_sync(
+                lambda: run_scenarios(args, base))
+    finally:
+        fake.terminate()
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            print('REGRESSION: ' + regression)
+        return 1 if regressions else 0
+    return 0
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    fake_ise.add_arguments(parser)
+    parser.add_argument('--scenarios', nargs='+', default=SCENARIOS,
+            choices=SCENARIOS, help='scenarios to run, in order')
+    parser.add_argument('--requests', type=int, default=500,
+            help='requests to send per scenario')
+    parser.add_argument('--warmup', type=int, default=20,
+            help='unmeasured requests to send before each scenario')
+    parser.add_argument('--concurrency', type=int, default=20,
+            help='requests in flight at once')
+    parser.add_argument('--workers', type=int, default=10,
+            help='ISE_WORKERS for the web server')
+    parser.add_argument('--sync-interval', type=int, default=0,
+            help='ISE_SYNC_INTERVAL for the web server')
+    parser.add_argument('--hedge-reads', action='store_true',
+            help='ISE_HEDGE_READS for the web server')
+    parser.add_argument('--seed', type=int, default=0,
+            help='random seed, so runs send the same traffic')
+    parser.add_argument('--save', help='save results to a JSON file')
+    parser.add_argument('--compare',
+            help='compare results with a saved JSON file')
+    parser.add_argument('--tolerance', type=float, default=0.1,
+            help='allowed slowdown when comparing, as a fraction')
+    args = parser.parse_args()
+    log.enable_pretty_logging()
+    # per-request logs and certificate warnings would drown out the results
+    logging.getLogger('tornado.access').setLevel(logging.ERROR)
+    warnings.simplefilter('ignore', InsecureRequestWarning)
+    sys.exit(main_loadtest(args))
@@ -0,0 +1,94 @@
+import time
+
+class DeadlineExceeded(Exception):
+    """Raised when a request runs out of time, or its client has gone."""
+
+class Deadline(object):
+    """Time budget for everything done on behalf of one API request: every
+    ISE call, retry and failover takes its timeout from what is left. It can
+    also be cancelled, for example when the client disconnects. A Deadline is
+    only ever read from worker threads, so it needs no lock.
+
+    Args:
+        seconds: Optional number of seconds from now the request must be done
+            by, None type for no time limit.
+        parent: Optional Deadline object, cancelling it cancels this too.
+    """
+    def __init__(self, seconds=None, parent=None):
+        self.expires = None if seconds is None else time.monotonic() + seconds
+        self.cancelled = False
+        self.parent = parent
+
+    def cancel(self):
+        """Stop any further work for the request."""
+        self.cancelled = True
+
+    def remaining(self):
+        """Get the time left.
+
+        Returns:
+            Number of seconds as a float (0 once expired), or None type if
+            there is no time limit.
+        """
+        if self.expires is None:
+            return None
+        return max(0.0, self.expires - time.monotonic())
+
+    def check(self):
+        """Make sure there is still time to do more work.
+
+        Raises:
+            DeadlineExceeded if the request was cancelled or has expired.
+        """
+        if self.cancelled:
+            raise DeadlineExceeded('Request was cancelled')
+        if self.parent is not None:
+            self.parent.check()
+        if self.remaining() == 0:
+            raise DeadlineExceeded('Timed out waiting for ISE')
+
+    def timeout(self, timeout=None):
+        """Get the timeout to use for the next step of the request.
+
+        Args:
+            timeout: Optional timeout the step would otherwise use, in
+                seconds.
+
+        Returns:
+            The smaller of timeout and the time left, or None type if
+            neither is limited.
+
+        Raises:
+            DeadlineExceeded if the request was cancelled or has expired.
+        """
+        self.check()
+        remaining = self.remaining()
+        if remaining is None:
+            return timeout
+        return remaining if timeout is None else min(timeout, remaining)
+
+    def shared(self):
+        """Get a Deadline with the same expiry that can't be cancelled, for
+        work whose result is shared with other requests.
+
+        Returns:
+            Deadline object.
+        """
+        deadline = Deadline()
+        deadline.expires = self.expires
+        return deadline
+
+    def child(self):
+        """Get a Deadline with the same expiry that is cancelled along with
+        this one, but can also be cancelled on its own, for one of several
+        attempts at the same step.
+
+        Returns:
+            Deadline object.
+        """
+        deadline = Deadline(parent=self)
+        deadline.expires = self.expires
+        return deadline
+
+# for calls made without a deadline
+NO_DEADLINE = Deadline()
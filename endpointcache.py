@@ -0,0 +1,75 @@
+import threading, time
+from collections import OrderedDict
+
+class EndpointCache(object):
+    """In-process cache of MAC address -> last known endpoint details, bounded
+    by size (least recently used entries are dropped first) and by age. This
+    is safe to use from multiple threads.
+
+    Args:
+        maxsize: Optional maximum number of entries as an integer.
+        ttl: Optional number of seconds an entry stays valid.
+    """
+    def __init__(self, maxsize=10000, ttl=300):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, mac):
+        """Look up a MAC address.
+
+        Args:
+            mac: MAC address as a string.
+
+        Returns:
+            Dictionary of endpoint details, or None type if the MAC address is
+            not cached or its entry has expired.
+        """
+        with self.lock:
+            entry = self.entries.get(mac)
+            if entry is None or entry[0] < time.monotonic():
+                if entry is not None:
+                    del self.entries[mac]
+                self.misses += 1
+                return None
+            self.entries.move_to_end(mac)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, mac, endpoint):
+        """Add or replace the details for a MAC address.
+
+        Args:
+            mac: MAC address as a string.
+            endpoint: Dictionary of endpoint details, with at least an 'id'
+                key.
+        """
+        if self.maxsize <= 0:
+            return
+        with self.lock:
+            self.entries[mac] = (time.monotonic() + self.ttl, endpoint)
+            self.entries.move_to_end(mac)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, mac):
+        """Forget a MAC address, if cached.
+
+        Args:
+            mac: MAC address as a string.
+        """
+        with self.lock:
+            self.entries.pop(mac, None)
+
+    def stats(self):
+        """Get cache counters.
+
+        Returns:
+            Dictionary with 'hits', 'misses' and 'size' keys.
+        """
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses,
+                    'size': len(self.entries)}
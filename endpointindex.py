@@ -0,0 +1,189 @@
+import threading, logging, time
+
+class EndpointIndex(object):
+    """Local mirror of the endpoints in the iPSK endpoint group (GROUP_ID),
+    indexed by MAC address and by uNID. The mirror is filled by paging
+    through ERS search results, and kept current between syncs by the writes
+    ISETools makes. ERS searches only list endpoint IDs, so changes made
+    directly in ISE are picked up by fetching details again once they are
+    max_age old. Until then, index entries may be behind ISE. When running as
+    several processes, one process syncs and the others load a snapshot of
+    its index. This is safe to use from multiple threads.
+
+    Args:
+        pagesize: Optional number of endpoints to request per ERS page.
+        max_age: Optional number of seconds before a sync fetches an
+            endpoint's details again, None type to only fetch new endpoints.
+    """
+    def __init__(self, pagesize=100, max_age=3600):
+        self.pagesize = pagesize
+        self.max_age = max_age
+        self.endpoints = {} # MAC address -> endpoint details
+        self.unids = {} # uNID -> set of MAC addresses
+        # MAC address -> time last added or replaced; these are wall clock
+        # times, so they can be compared with snapshots from other processes
+        self.updated = {}
+        self.lock = threading.Lock()
+        self.synclock = threading.Lock()
+        self.started = None # start time of the last completed sync
+        self.synced = None # time of the last completed sync
+
+    def ready(self):
+        """Check whether the index has completed at least one sync.
+
+        Returns:
+            True if the index can be used for lookups, False otherwise.
+        """
+        return self.synced is not None
+
+    def get(self, mac):
+        """Look up a MAC address.
+
+        Args:
+            mac: MAC address as a string, formatted by ISETools.parse_mac.
+
+        Returns:
+            Dictionary of endpoint details, or None type if the MAC address is
+            not in the group.
+        """
+        with self.lock:
+            return self.endpoints.get(mac)
+
+    def list_unid(self, unid):
+        """List the endpoints registered to a uNID.
+
+        Args:
+            unid: uNID as a string.
+
+        Returns:
+            Dictionary of MAC address -> endpoint details.
+        """
+        with self.lock:
+            return {mac: self.endpoints[mac]
+                    for mac in self.unids.get(unid, ())}
+
+    def update(self, mac, endpoint):
+        """Add or replace an endpoint.
+
+        Args:
+            mac: MAC address as a string.
+            endpoint: Dictionary with 'id', 'psk', 'group' and 'unid' keys.
+        """
+        with self.lock:
+            self._update(mac, endpoint, time.time())
+
+    def _update(self, mac, endpoint, updated):
+        self._remove(mac)
+        self.endpoints[mac] = endpoint
+        self.updated[mac] = updated
+        self.unids.setdefault(endpoint.get('unid'), set()).add(mac)
+
+    def remove(self, mac):
+        """Remove an endpoint, if present.
+
+        Args:
+            mac: MAC address as a string.
+        """
+        with self.lock:
+            self._remove(mac)
+
+    def _remove(self, mac):
+        endpoint = self.endpoints.pop(mac, None)
+        self.updated.pop(mac, None)
+        if endpoint is not None:
+            macs = self.unids.get(endpoint.get('unid'))
+            if macs is not None:
+                macs.discard(mac)
+                if not macs:
+                    del self.unids[endpoint.get('unid')]
+
+    def sync(self, tools):
+        """Page through the endpoint group in ISE and bring the index up to
+        date. Details are only fetched for endpoints not already indexed, or
+        indexed more than max_age seconds ago, and endpoints no longer in the
+        group are dropped. If a sync is already running, this returns right
+        away.
+
+        Args:
+            tools: ISETools object to use for ERS calls.
+
+        Returns:
+            True if a sync was run, False otherwise.
+        """
+        if not self.synclock.acquire(blocking=False):
+            return False
+        try:
+            started = time.time()
+            expired = (started - self.max_age if self.max_age is not None
+                    else None)
+            seen = set()
+            refreshed = 0
+            page = 1
+            while True:
+                resources, total = tools.search_group(page, self.pagesize)
+                for endpointid, mac in resources:
+                    seen.add(mac)
+                    with self.lock:
+                        known = self.endpoints.get(mac)
+                        stale = (expired is not None and
+                                self.updated.get(mac, 0) < expired)
+                    if known is None or known['id'] != endpointid or stale:
+                        refreshed += known is not None
+                        # other processes get the whole index once it is
+                        # synced, not every endpoint as it is fetched
+                        endpoint = tools.get_endpoint(mac, fresh=True,
+                                publish=False)
+                        if endpoint is not None:
+                            self.update(mac, endpoint)
+                if not resources or page * self.pagesize >= total:
+                    break
+                page += 1
+
+            with self.lock:
+                # keep anything written while the sync was running
+                for mac in set(self.endpoints) - seen:
+                    if self.updated.get(mac, 0) < started:
+                        self._remove(mac)
+            self.started = started
+            self.synced = time.time()
+            logging.info('Endpoint index synced ' + str(len(seen)) +
+                    ' endpoints (' + str(refreshed) + ' refreshed) in ' +
+                    str(round(self.synced - started, 1)) + 's')
+            return True
+        finally:
+            self.synclock.release()
+
+    def snapshot(self):
+        """Get a copy of the index, for other processes to load.
+
+        Returns:
+            endpoints: Dictionary of MAC address -> endpoint details.
+            updated: Dictionary of MAC address -> time the endpoint was last
+                added or replaced.
+        """
+        with self.lock:
+            return dict(self.endpoints), dict(self.updated)
+
+    def load(self, endpoints, updated, started, synced):
+        """Bring the index up to date from another process's snapshot,
+        instead of syncing. Entries changed here more recently than in the
+        snapshot are kept, as are entries added here while its sync was
+        running.
+
+        Args:
+            endpoints: Dictionary of MAC address -> endpoint details, from
+                snapshot().
+            updated: Dictionary of MAC address -> time last added or replaced,
+                from snapshot().
+            started: Time the snapshot's sync started.
+            synced: Time the snapshot's sync finished.
+        """
+        with self.lock:
+            for mac in set(self.endpoints) - set(endpoints):
+                if self.updated.get(mac, 0) < started:
+                    self._remove(mac)
+            for mac, endpoint in endpoints.items():
+                if self.updated.get(mac, 0) < updated[mac]:
+                    self._update(mac, endpoint, updated[mac])
+            self.started = started
+            self.synced = synced
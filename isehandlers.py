@@ -1,41 +1,142 @@
-import logging, json, traceback, asyncio
-from tornado import web
+import logging, json, traceback, csv, io
+from tornado import gen, ioloop, iostream, locks, queues, web
+
+from admission import Overloaded
+from deadline import Deadline, DeadlineExceeded
+from isetools import SUPERSEDED
+import maccodec
+
+# ISE calls a single export or import keeps in flight at once
+STREAM_WORKERS = 4
+EXPORT_PAGE_SIZE = 100
+EXPORT_FORMATS = {'csv': 'text/csv; charset=UTF-8',
+        'ndjson': 'application/x-ndjson'}
 
 def assign_objects(isetools_obj):
     global ise_obj
     ise_obj = isetools_obj
 
-class Test(web.RequestHandler):
+class ISEHandler(web.RequestHandler):
+    """Base class for handlers that do work in ISE, which is tracked so
+    shutdown can wait for it to finish.
+    """
+    def prepare(self):
+        ise_obj.begin_request()
+        self.tracked = True
+
+    def on_finish(self):
+        self.untrack()
+
+    def untrack(self):
+        # requests whose client goes away mid-upload never finish
+        if getattr(self, 'tracked', False):
+            self.tracked = False
+            ise_obj.end_request()
+
+class Test(ISEHandler):
     async def get(self):
         try:
-            ise_obj.test_ise_version()
-            self.write({'result': "OK"})
+            if not ise_obj.health_interval:
+                # no background checks, so check now
+                await ise_obj.check_health()
+            report = ise_obj.health_report()
+            if report.pop('ok'):
+                self.write(dict(report, result="OK"))
+            else:
+                self.set_status(500)
+                self.write(dict(report, error="ISE Server unreachable or " +
+                        "could not authenticate"))
         except:
+            traceback.print_exc()
             self.set_status(500)
             self.write({'error': "ISE Server unreachable or could not authenticate"})
         finally:
             self.finish()
 
-class PSK(web.RequestHandler):
+class Alive(web.RequestHandler):
+    def get(self):
+        self.write({'result': "OK"})
+        self.finish()
+
+class Ready(web.RequestHandler):
+    def get(self):
+        if ise_obj.draining:
+            self.set_status(503)
+            self.write({'error': "Shutting down"})
+        elif not ise_obj.ready.is_set():
+            self.set_status(503)
+            self.write({'error': "Starting up"})
+        else:
+            self.write({'result': "OK"})
+        self.finish()
+
+class Stats(web.RequestHandler):
+    async def get(self):
+        self.write({'cache': ise_obj.cache_stats(),
+                'servers': ise_obj.health_status()})
+        self.finish()
+
+class Metrics(web.RequestHandler):
+    def get(self):
+        self.set_header('Content-Type', 'text/plain; version=0.0.4')
+        self.write(ise_obj.metrics_text())
+        self.finish()
+
+class PSK(ISEHandler):
+    def prepare(self):
+        ISEHandler.prepare(self)
+        self.deadline = ise_obj.deadline()
+
+    def on_connection_close(self):
+        # nobody is waiting for the result any more
+        self.deadline.cancel()
+
     async def get(self):
         mac = self.get_argument('mac', None)
+        unid = self.get_argument('unid', None)
+        fresh = self.get_argument('fresh', None) == '1'
+        trace = ise_obj.trace('psk_get')
         try:
-            if not mac:
-                raise ValueError("Missing argument 'mac'")
+            if not mac and not unid:
+                raise ValueError("Missing argument 'mac' or 'unid'")
 
-            response = ise_obj.get_endpointid(mac)
-            self.write({'result': (response[0] if response else None)})
-        except ValueError as e:
+            if mac:
+                with trace.stage('lookup'):
+                    response = await ise_obj.get_endpointid(mac, fresh=fresh,
+                            deadline=self.deadline)
+                self.write({'result': (response[0] if response else None)})
+            else:
+                with trace.stage('lookup'):
+                    endpoints = ise_obj.list_unid(unid)
+                if endpoints is None:
+                    # the first sync of a large group can take a while
+                    self.set_status(503)
+                    self.set_header('Retry-After', '10')
+                    self.write({'error': "The local copy of the endpoint " +
+                            "group is still syncing, try again shortly"})
+                    return
+                self.write({'result': {mac: endpoint['id']
+                        for mac, endpoint in endpoints.items()}})
+        except (ValueError, SyntaxError) as e:
             self.set_status(400)
             self.write({'error': str(e)})
+        except Overloaded as e:
+            self.set_status(e.status)
+            self.set_header('Retry-After', str(e.retry_after))
+            self.write({'error': str(e)})
+        except DeadlineExceeded as e:
+            self.set_status(504)
+            self.write({'error': str(e)})
         except Exception as e:
             traceback.print_exc()
             self.set_status(500)
             self.write({'error': str(e)})
         finally:
             self.finish()
+            trace.finish()
 
     async def post(self):
+        trace = ise_obj.trace('psk_post')
         # support both JSON bodies and URL arguments/parameters
         if self.request.headers.get('Content-Type') =='application/json':
             try:
@@ -56,17 +157,387 @@ class PSK(web.RequestHandler):
         lname = args.get('lastname', None)
 
         try:
-            if not mac or not psk or not unid or not fname or not lname:
-                raise ValueError("Missing argument: mac, psk, unid, fname, " +
-                        "and lname are required.")
-            mac = ise_obj.parse_mac(mac)
+            with trace.stage('parse'):
+                if not mac or not psk or not unid or not fname or not lname:
+                    raise ValueError("Missing argument: mac, psk, unid, " +
+                            "fname, and lname are required.")
+                mac = ise_obj.parse_mac(mac)
             logging.info(unid + " is attempting to create/update iPSK for "+mac)
-            responseCode = ise_obj.set_psk(mac, psk, unid)
+            if ise_obj.journal is not None:
+                with trace.stage('queue'):
+                    jobid = await ise_obj.queue_psk(mac, psk, unid, fname,
+                            lname)
+                logging.info("iPSK change for " + mac + " queued as job " +
+                        jobid)
+                self.set_status(202)
+                self.write({'result': 'iPSK change queued.', 'job': jobid})
+                return
+            responseCode = await ise_obj.set_psk(mac, psk, unid, trace=trace,
+                    deadline=self.deadline)
+            if responseCode == SUPERSEDED:
+                # not a failure, so no email, but this change wasn't made
+                logging.info("iPSK change for " + mac + " was superseded " +
+                        "by a later change")
+                self.set_status(409)
+                self.write({'error': "Superseded by a later iPSK change " +
+                        "for the same MAC address."})
+                return
             logging.info("Response code " + responseCode + " received for " +
                     "iPSK change in ISE for " + mac)
+            with trace.stage('email'):
+                ise_obj.send_email(responseCode, unid, fname, lname, mac)
             self.write({'result': 'iPSK succesfully updated/created.'})
+        except (ValueError, SyntaxError) as e:
+            traceback.print_exc()
+            self.set_status(400)
+            self.write({'error': str(e)})
+        except Overloaded as e:
+            # nothing was changed, the client should try again later
+            logging.warn("Turned away iPSK change for " + str(mac) + ": " +
+                    str(e))
+            self.set_status(e.status)
+            self.set_header('Retry-After', str(e.retry_after))
+            self.write({'error': str(e)})
+        except DeadlineExceeded as e:
+            # the change may or may not have reached ISE, so the client
+            # should check or try again
+            logging.warn("iPSK change for " + mac + " did not finish: " +
+                    str(e))
+            self.set_status(504)
+            self.write({'error': str(e)})
+        except Exception as e:
+            traceback.print_exc()
+            with trace.stage('email'):
+                ise_obj.send_email(str(e), unid, fname, lname, mac)
+            self.set_status(500)
+            self.write({'error': str(e)})
+        finally:
+            self.finish()
+            trace.finish()
+
+@web.stream_request_body
+class BulkPSK(ISEHandler):
+    def prepare(self):
+        ISEHandler.prepare(self)
+        self.is_json = self.request.headers.get('Content-Type', ''
+                ).startswith('application/json')
+        self.buffer = b''
+        self.rows = []
+        # bulk requests can take a long time, so they only stop if the
+        # client goes away
+        self.deadline = Deadline()
+        self.received = False
+
+    def on_connection_close(self):
+        self.deadline.cancel()
+        if not self.received:
+            self.untrack()
+
+    def data_received(self, chunk):
+        self.buffer += chunk
+        if not self.is_json:
+            # parse CSV rows as complete lines arrive
+            lines = self.buffer.split(b'\n')
+            self.buffer = lines.pop()
+            self.rows.extend(csv.reader(line.rstrip(b'\r').decode('utf-8')
+                    for line in lines))
+
+    async def post(self):
+        self.received = True
+        try:
+            if self.is_json:
+                rows = json.loads(self.buffer.decode('utf-8'))
+                if not isinstance(rows, list):
+                    raise ValueError("Expected a JSON array of objects")
+            else:
+                rows = self.rows + list(csv.reader([self.buffer.decode(
+                        'utf-8')]))
+                rows = [dict(zip(('mac', 'psk', 'unid', 'firstname',
+                        'lastname'), row)) for row in rows
+                        if row and row[0].strip().lower() != 'mac']
+        except ValueError as e:
+            traceback.print_exc()
+            self.set_status(400)
+            self.write({'error': "Could not parse request body: " + str(e)})
+            self.finish()
+            return
+
+        try:
+            # validate and de-duplicate rows, the last row for a MAC wins
+            rows = [args if isinstance(args, dict) else {} for args in rows]
+            macs, errors = maccodec.normalize_many([args.get('mac') or ''
+                    for args in rows])
+            results = []
+            entries = {}
+            for i, args in enumerate(rows):
+                mac = args.get('mac', None)
+                result = {'mac': mac}
+                results.append(result)
+                if not mac or not args.get('psk') or not args.get('unid'):
+                    result['error'] = ("Missing argument: mac, psk, and unid " +
+                            "are required.")
+                    continue
+                if i in errors:
+                    result['error'] = errors[i]
+                    continue
+                mac = result['mac'] = macs[i]
+                if mac in entries:
+                    entries[mac][1]['error'] = "Duplicate MAC address"
+                entries[mac] = ((args['psk'], args['unid']), result)
+
+            logging.info("Bulk iPSK request for " + str(len(entries)) +
+                    " endpoints")
+            statuses = await ise_obj.bulk_set_psk([(mac, psk, unid)
+                    for mac, ((psk, unid), result) in entries.items()],
+                    deadline=self.deadline)
+            for mac, (args, result) in entries.items():
+                if 'error' not in result:
+                    status = statuses.get(mac, 'failed: no result')
+                    if status.startswith('failed'):
+                        result['error'] = status
+                    else:
+                        result['result'] = status
+            self.write({'result': results})
+        except Overloaded as e:
+            self.set_status(e.status)
+            self.set_header('Retry-After', str(e.retry_after))
+            self.write({'error': str(e)})
+        except DeadlineExceeded as e:
+            self.set_status(504)
+            self.write({'error': str(e)})
+        except Exception as e:
+            traceback.print_exc()
+            self.set_status(500)
+            self.write({'error': str(e)})
+        finally:
+            self.finish()
+
+class PSKExport(ISEHandler):
+    def prepare(self):
+        ISEHandler.prepare(self)
+        # exports can take a long time, so they only stop if the client
+        # goes away
+        self.deadline = Deadline()
+
+    def on_connection_close(self):
+        self.deadline.cancel()
+
+    async def get(self):
+        fmt = self.get_argument('format', 'csv')
+        columns = ['mac', 'psk', 'unid', 'id']
+        if self.get_argument('psk', None) != '1':
+            columns.remove('psk')
+        sent = 0
+        try:
+            if fmt not in EXPORT_FORMATS:
+                raise ValueError("Unknown format '" + fmt + "', expected " +
+                        "csv or ndjson")
+            self.set_header('Content-Type', EXPORT_FORMATS[fmt])
+            if fmt == 'csv':
+                self.write(','.join(columns) + '\r\n')
+            page = 1
+            while True:
+                # one page at a time, so memory use doesn't grow with the
+                # size of the group
+                endpoints, total = await ise_obj.export_page(page,
+                        EXPORT_PAGE_SIZE, STREAM_WORKERS, self.deadline)
+                # endpoints that couldn't be looked up get an error row in
+                # their place, like the one that ends a failed export
+                if fmt == 'csv':
+                    rows = [['error', endpoint['mac'] + ': ' +
+                            endpoint['error']] if 'error' in endpoint else
+                            [endpoint[column] for column in columns]
+                            for endpoint in endpoints]
+                    out = io.StringIO()
+                    csv.writer(out).writerows(rows)
+                    self.write(out.getvalue())
+                else:
+                    rows = [{column: endpoint[column] for column in
+                            ('mac', 'id', 'error')} if 'error' in endpoint else
+                            {column: endpoint[column] for column in columns}
+                            for endpoint in endpoints]
+                    self.write(''.join(json.dumps(row) + '\n'
+                            for row in rows))
+                await self.flush()
+                sent += len(rows)
+                if page * EXPORT_PAGE_SIZE >= total:
+                    break
+                page += 1
+            logging.info("Exported " + str(sent) + " endpoints")
+        except (DeadlineExceeded, iostream.StreamClosedError):
+            logging.info("Export stopped after " + str(sent) + " endpoints, " +
+                    "the client went away")
         except ValueError as e:
+            self.set_status(400)
+            self.write({'error': str(e)})
+        except Exception as e:
             traceback.print_exc()
+            if not sent:
+                self.clear()
+                self.set_status(500)
+                self.write({'error': str(e)})
+            elif fmt == 'ndjson':
+                # too late to change the status, so end with the error
+                self.write(json.dumps({'error': str(e)}) + '\n')
+            else:
+                self.write('error,' + str(e).replace('\n', ' ') + '\r\n')
+        finally:
+            self.finish()
+
+@web.stream_request_body
+class PSKImport(ISEHandler):
+    def prepare(self):
+        ISEHandler.prepare(self)
+        self.is_json = 'json' in self.request.headers.get('Content-Type', '')
+        # results are sent back while the body is still arriving
+        self.set_header('Content-Type', 'application/x-ndjson')
+        self.buffer = b''
+        self.columns = None # CSV columns, from the header row if there is one
+        self.rows = 0
+        self.counts = {'result': 0, 'error': 0}
+        self.received = False
+        # rows wait here for a worker; when it is full, reading the body
+        # waits too
+        self.queue = queues.Queue(maxsize=STREAM_WORKERS)
+        self.flushing = locks.Lock()
+        self.deadline = Deadline()
+        self.workers = gen.multi([self.work()
+                for _ in range(STREAM_WORKERS)])
+
+    def on_connection_close(self):
+        self.deadline.cancel()
+        if not self.received:
+            ioloop.IOLoop.current().spawn_callback(self.stop)
+
+    async def data_received(self, chunk):
+        lines = (self.buffer + chunk).split(b'\n')
+        self.buffer = lines.pop()
+        for line in lines:
+            await self.add_line(line)
+
+    async def add_line(self, line):
+        line = line.rstrip(b'\r').decode('utf-8', 'replace')
+        if not line.strip():
+            return
+        self.rows += 1
+        try:
+            if self.is_json:
+                args = json.loads(line)
+                if not isinstance(args, dict):
+                    raise ValueError("Expected a JSON object")
+            else:
+                row = next(csv.reader([line]))
+                if self.columns is None:
+                    self.columns = ('mac', 'psk', 'unid')
+                    if row[0].strip().lower() == 'mac':
+                        # header row, as written by /ise/psk/export
+                        self.columns = [column.strip().lower()
+                                for column in row]
+                        self.rows -= 1
+                        return
+                args = dict(zip(self.columns, row))
+        except (ValueError, csv.Error) as e:
+            await self.send_result({'row': self.rows, 'mac': None,
+                    'error': "Could not parse row: " + str(e)})
+            return
+        if not self.deadline.cancelled:
+            await self.queue.put((self.rows, args))
+
+    async def work(self):
+        while True:
+            item = await self.queue.get()
+            if item is None:
+                return
+            row, args = item
+            await self.send_result(dict(await self.import_row(args), row=row))
+
+    async def import_row(self, args):
+        mac, psk, unid = args.get('mac'), args.get('psk'), args.get('unid')
+        if not mac or not psk or not unid:
+            return {'mac': mac, 'error': "Missing argument: mac, psk, and " +
+                    "unid are required."}
+        try:
+            mac = ise_obj.parse_mac(mac)
+            responseCode = await ise_obj.set_psk(mac, psk, unid,
+                    deadline=ise_obj.deadline(self.deadline))
+            if responseCode == SUPERSEDED:
+                return {'mac': mac, 'error': "Superseded by a later row " +
+                        "for the same MAC address"}
+            if not responseCode.startswith('2'):
+                return {'mac': mac, 'error': "ISE returned " + responseCode}
+            return {'mac': mac, 'result': responseCode}
+        except Exception as e:
+            return {'mac': mac, 'error': str(e)}
+
+    async def send_result(self, result):
+        self.counts['error' if 'error' in result else 'result'] += 1
+        if self.deadline.cancelled:
+            return
+        self.write(json.dumps(result) + '\n')
+        # flushes must not overlap
+        async with self.flushing:
+            try:
+                await self.flush()
+            except iostream.StreamClosedError:
+                pass
+
+    async def stop(self):
+        for _ in range(STREAM_WORKERS):
+            await self.queue.put(None)
+        await self.workers
+        logging.info("Import of " + str(self.rows) + " rows ended with " +
+                str(self.counts['result']) + " done and " +
+                str(self.counts['error']) + " failed")
+        self.untrack()
+
+    async def post(self):
+        self.received = True
+        try:
+            if self.buffer:
+                await self.add_line(self.buffer)
+            await self.stop()
+            self.write(json.dumps({'rows': self.rows,
+                    'done': self.counts['result'],
+                    'failed': self.counts['error']}) + '\n')
+        finally:
+            self.finish()
+
+class PSKHistory(web.RequestHandler):
+    async def get(self):
+        mac = self.get_argument('mac', None)
+        unid = self.get_argument('unid', None)
+        try:
+            if not mac and not unid:
+                raise ValueError("Missing argument 'mac' or 'unid'")
+            limit = self.get_argument('limit', '100')
+            if not limit.isdigit() or not 1 <= int(limit) <= 1000:
+                raise ValueError("limit must be a number from 1 to 1000")
+            if mac:
+                mac = ise_obj.parse_mac(mac)
+            records = await ise_obj.history(mac, unid, int(limit))
+            self.write({'result': records})
+        except (ValueError, SyntaxError) as e:
+            self.set_status(400)
+            self.write({'error': str(e)})
+        except Exception as e:
+            traceback.print_exc()
+            self.set_status(500)
+            self.write({'error': str(e)})
+        finally:
+            self.finish()
+
+class PSKJob(ISEHandler):
+    async def get(self, jobid):
+        try:
+            if ise_obj.journal is None:
+                raise ValueError("Queued registrations are not enabled")
+            job = await ise_obj.get_job(jobid)
+            if job is None:
+                self.set_status(404)
+                self.write({'error': "No job found with ID " + jobid})
+            else:
+                self.write({'result': job})
+        except ValueError as e:
             self.set_status(400)
             self.write({'error': str(e)})
         except Exception as e:
@@ -78,5 +549,14 @@ class PSK(web.RequestHandler):
 
 handlers = [
     (r"/ise/psk", PSK),
+    (r"/ise/psk/bulk", BulkPSK),
+    (r"/ise/psk/export", PSKExport),
+    (r"/ise/psk/import", PSKImport),
+    (r"/ise/psk/history", PSKHistory),
+    (r"/ise/psk/jobs/([0-9a-f]+)", PSKJob),
     (r"/ise/test", Test),
+    (r"/ise/alive", Alive),
+    (r"/ise/ready", Ready),
+    (r"/ise/stats", Stats),
+    (r"/metrics", Metrics),
 ]
@@ -1,8 +1,99 @@
-import requests, logging, json
-import xml.etree.ElementTree as ElemTree
-from bs4 import BeautifulSoup
+import requests, logging, json, threading, time, re
+from html import escape
+from string import Template
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from tornado import gen, ioloop
+from tornado.concurrent import Future
+from tornado.locks import Event
 
 import settings
+from endpointcache import EndpointCache
+from endpointindex import EndpointIndex
+from nodehealth import NodeHealth, LatencyWindow
+from maildispatcher import MailDispatcher
+from metrics import Metrics, Trace
+from admission import Limiter, Overloaded
+from deadline import Deadline, DeadlineExceeded, NO_DEADLINE
+import maccodec
+
+# result of a write that was replaced by a later one for the same MAC
+# address before it was sent, see AsyncISETools.set_psk
+SUPERSEDED = 'superseded'
+
+# endpoint element for bulk requests, see ISETools.endpoint_xml
+ENDPOINT_XML = Template("""<ns3:endpoint name='name' id=$id
+                description='description'
+                xmlns:ns2='ers.ise.cisco.com'
+                xmlns:ns3='identity.ers.ise.cisco.com'>
+                    <customAttributes>
+                        <customAttributes>
+                            <entry>
+                                <key>iPSK</key>
+                                <value>psk=$psk</value>
+                            </entry>
+                        </customAttributes>
+                    </customAttributes>
+                <groupId>$group</groupId>
+                <identityStore></identityStore>
+                <identityStoreId></identityStoreId>
+                <mac>$mac</mac>
+                <portalUser>$unid</portalUser>
+                <profileId></profileId>
+                <staticGroupAssignment>true</staticGroupAssignment>
+                <staticProfileAssignment>false</staticProfileAssignment>
+                </ns3:endpoint>""")
+
+# for pulling error details out of HTML error pages, see ISETools.raise_error
+HTML_H1 = re.compile(r'<h1[^>]*>(.*?)</h1>', re.IGNORECASE | re.DOTALL)
+HTML_P = re.compile(r'<p[^>]*>(.*?)</p>', re.IGNORECASE | re.DOTALL)
+HTML_TAG = re.compile(r'<[^>]+>')
+
+# failure emails, see ISETools.send_email
+USER_EMAIL = Template('Dear $fname $lname, <br><p>' +
+        'Thank you for using onboard.utah.edu to register your IoT ' +
+        'device to connect with the University of Utah ULink network. '+
+        ' Unfortunately, we were unable to successfully register your '+
+        'device.<br><br>Please try again. Note: Devices on ULink must '+
+        'register the hardware, or MAC, address (view instructions at '+
+        '<a href="http://bit.ly/finding-mac-for-ulink">' +
+        'http://bit.ly/finding-mac-for-ulink</a>). Then use your MAC ' +
+        'address to register your device via ' +
+        '<a href="https://onboard.utah.edu/">' +
+        'https://onboard.utah.edu/</a>.<br><br>' +
+        'Your device with MAC address $mac, and associated '+
+        'password or pre-shared key (PSK), should be configured as ' +
+        'follows in order to connect:<br><br>' +
+        'SSID: ULink<br>Authentication: WPA2-Personal<br>Encryption: ' +
+        'AES<br><br>Please note: The ULink network is not intended ' +
+        'for laptops, smartphones, or tablets that are capable of '+
+        'connecting to UConnect.<br><br>For more information about ' +
+        "ULink, copy/paste the following link into your browser's " +
+        "address bar: " +
+        '<a href="http://bit.ly/ulink-device-configuration">' +
+        'http://bit.ly/ulink-device-configuration</a>.<br><br>' +
+        "If you're still unsuccessful after trying to register " +
+        'your device again, please contact the UIT Help Desk ' +
+        '(801-581-4000, option 1) for technical assistance.</p>')
+USER_EMAIL_FOOTER = ('Best regards,<br><br>University ' +
+        'Information Technology<br>The University of Utah<br>' +
+        '102 S 200 E Ste. 110<br>Salt Lake City, UT 84111<br>UIT Help '+
+        'Desk: 801-581-4000 x 1')
+ADMIN_DIGEST_HEADER = ("<p>Recent IOT device registrations failed on ULink." +
+        "</p><table><tr><th>Time</th><th>MAC Address</th><th>uNID</th>" +
+        "<th>Response code from ISE</th></tr>")
+ADMIN_DIGEST_ENTRY = Template("<tr><td>$time</td><td>$mac</td><td>$unid</td>" +
+        "<td>$code</td></tr>")
+ADMIN_DIGEST_FOOTER = ("</table><p>" +
+        "Please view TOAST logs for more information, or use this " +
+        "API call to test TOAST's connectivity/service account to ISE:"+
+        "<br>(GET) https://toast.utah.edu/ise/test</p>")
+# when there is a registration ledger, see ledger.py
+ADMIN_DIGEST_LEDGER_FOOTER = ("</table><p>" +
+        "Every attempt for a device, with the ISE node used and the error, " +
+        "can be looked up with this API call:<br>(GET) " +
+        "https://toast.utah.edu/ise/psk/history?mac=&lt;MAC address&gt;" +
+        "<br>or use this API call to test TOAST's connectivity/service " +
+        "account to ISE:<br>(GET) https://toast.utah.edu/ise/test</p>")
 
 class ISEAPIError(Exception):
     """
@@ -17,38 +108,447 @@ class ISETools(object):
         url: Server URL as a string.
         username: ISE service account username as a string.
         password: ISE service account password as a string.
+        hedge_reads: Optional, set to True to also send slow reads to a
+            second server, see send_read.
+        ledger: Optional Ledger object to record registration attempts in.
     """
-    get_headers = {'Accept':
-            'application/vnd.com.cisco.ise.identity.endpoint.1.0+xml'}
-    put_headers = {'Content-Type':
-            'application/vnd.com.cisco.ise.identity.endpoint.1.0+xml'}
-    post_headers = {'Content-Type':
-            'application/vnd.com.cisco.ise.identity.endpoint.1.0+xml'}
-    delete_headers = {'Accept':
-            'application/vnd.com.cisco.ise.identity.endpoint.1.0+xml'}
-
-    def __init__(self, serverlist, username, password, emailer):
+    get_headers = {'Accept': 'application/json'}
+    put_headers = {'Content-Type': 'application/json',
+            'Accept': 'application/json'}
+    post_headers = {'Content-Type': 'application/json',
+            'Accept': 'application/json'}
+    delete_headers = {'Accept': 'application/json'}
+    bulk_headers = {'Content-Type':
+            'application/vnd.com.cisco.ise.identity.endpointbulkrequest.1.0+xml'}
+    bulk_status_headers = {'Accept':
+            'application/vnd.com.cisco.ise.ers.bulkStatus.1.1+xml'}
+    # an Endpoint ID that should never exist, for probing node roles
+    probe_id = '00000000-0000-0000-0000-000000000000'
+    # reads are hedged once they take longer than this percentile of recent
+    # reads, or the default delay until there are enough of them
+    hedge_percentile = 95
+    hedge_min_delay = 0.01
+    hedge_default_delay = 1
+
+    def __init__(self, serverlist, username, password, emailer, poolsize=10,
+            idle_timeout=300, verify=True, metrics=None, limits=None,
+            hedge_reads=False, ledger=None):
         self.serverlist = serverlist
-        self.serverindex = 0
+        self.panindex = 0 # server to send writes to
+        self.readindex = 0 # rotates the order servers are tried for reads
+        self.health = {server: NodeHealth() for server in serverlist}
+        self.shared = None # SharedState, when running several processes
+        self.serverlock = threading.Lock()
         self.auth = (username, password)
         self.emailer = emailer
+        self.ledger = ledger
+        self.mailer = (MailDispatcher(emailer,
+                'ULink device registration failures', settings.IPSK_ADMINS,
+                digest_header=ADMIN_DIGEST_HEADER,
+                digest_footer=(ADMIN_DIGEST_FOOTER if ledger is None else
+                        ADMIN_DIGEST_LEDGER_FOOTER),
+                digest_interval=getattr(settings, 'EMAIL_DIGEST_INTERVAL', 300))
+                if emailer else None)
+        self.poolsize = poolsize
+        self.idle_timeout = idle_timeout
+        self.verify = verify # False, or a CA bundle for self-signed ISE certs
+        self.sessions = {}
+        self.lastused = {}
+        self.sessionlock = threading.Lock()
+        self.cache = EndpointCache(
+                maxsize=getattr(settings, 'ISE_CACHE_SIZE', 10000),
+                ttl=getattr(settings, 'ISE_CACHE_TTL', 300))
+        self.index = EndpointIndex(
+                max_age=getattr(settings, 'ISE_INDEX_MAX_AGE', 3600))
+        self.metrics = metrics or Metrics()
+        self.metrics.add_collector(self.collect_metrics)
+        self.checks = {} # server -> result of its last check_node
+        self.latencies = {} # (server, operation) -> LatencyWindow of reads
+        # runs the attempts of hedged reads, see send_read
+        self.hedger = (ThreadPoolExecutor(max_workers=2 * poolsize)
+                if hedge_reads else None)
+        # (server, 'read' or 'write') -> Limiter, see limits_for
+        self.limiters = {(server, kind): Limiter(**self.limits_for(limits,
+                server, kind)) for server in serverlist
+                for kind in ('read', 'write')}
+
+    def limits_for(self, limits, server, kind):
+        """Get the Limiter arguments for one server and kind of request.
 
-    def url(self):
+        Args:
+            limits: Dictionary with optional 'read' and 'write' keys, each a
+                dictionary of Limiter arguments, and optional server name keys
+                with the same form to override them for that server. May be
+                None type for no limits.
+            server: Server name as a string.
+            kind: 'read' or 'write'.
+
+        Returns:
+            Dictionary of Limiter arguments.
+        """
+        limits = limits or {}
+        return dict(limits.get(kind) or {},
+                **((limits.get(server) or {}).get(kind) or {}))
+
+    def url(self, server=None):
         """This autogenerates and returns the URL and server to use.
 
+        Args:
+            server: Optional server name as a string, defaults to the primary
+                admin node.
+
         Returns:
             URL prefix as a string.
         """
-        return ('https://' + self.serverlist[self.serverindex] +
-                ':9060/ers/config/')
+        if server is None:
+            server = self.pan()
+        return 'https://' + server + ':9060/ers/config/'
+
+    def pan(self):
+        """Get the server currently believed to be the primary admin node
+        (PAN), which is the only node that accepts writes.
+
+        Returns:
+            Server name as a string.
+        """
+        return self.serverlist[self.panindex]
+
+    def next_pan(self, failed):
+        """Switch writes to the next known server, unless another thread has
+        already switched away from the failed server.
+
+        Args:
+            failed: Server name that failed or rejected a write, as a string.
+        """
+        with self.serverlock:
+            if self.serverlist[self.panindex] != failed:
+                return
+            self.panindex = (self.panindex + 1) % len(self.serverlist)
+        if self.shared is not None:
+            self.shared.set('pan', self.pan())
+
+    def read_server(self, exclude=()):
+        """Pick a server to send a read to. This is the healthy server with
+        the best (lowest) latency score; ties are broken in rotating order so
+        reads still spread across similar servers.
+
+        Args:
+            exclude: Optional collection of server names to leave out.
+
+        Returns:
+            Server name as a string, or None type if no server is available.
+        """
+        with self.serverlock:
+            self.readindex = (self.readindex + 1) % len(self.serverlist)
+            servers = (self.serverlist[self.readindex:] +
+                    self.serverlist[:self.readindex])
+        servers = sorted((server for server in servers
+                if server not in exclude),
+                key=lambda server: self.health[server].score())
+        for server in servers:
+            if self.health[server].available():
+                return server
+        return None
+
+    def send(self, server, method, path, operation='other', limit=True,
+            timeout=10, deadline=None, **kwargs):
+        """Send a request to a single server, and record how it went in the
+        server's health and in the metrics. Requests wait for their turn with
+        the server's read or write Limiter first.
+
+        Args:
+            server: Server name as a string.
+            method: HTTP method as a string.
+            path: Path after the ERS prefix as a string.
+            operation: Optional operation name for metrics as a string.
+            limit: Optional, set to False to skip the Limiter (for health
+                checks and other housekeeping).
+            timeout: Optional timeout in seconds, shortened to fit the
+                deadline.
+            deadline: Optional Deadline object for the API request this is
+                part of.
+            **kwargs: Other arguments for requests.Session.request.
+
+        Returns:
+            requests.Response object.
+
+        Raises:
+            Overloaded if the Limiter turned the request away.
+            DeadlineExceeded if the deadline passed or was cancelled.
+        """
+        deadline = deadline or NO_DEADLINE
+        kind = 'read' if method == 'GET' else 'write'
+        limiter = self.limiters[(server, kind)] if limit else None
+        if limiter is not None:
+            try:
+                limiter.acquire(deadline.timeout(limiter.timeout))
+            except Overloaded as e:
+                self.metrics.inc('ise_rejected_total', {'server': server,
+                        'kind': kind, 'status': e.status})
+                raise
+
+        try:
+            timeout = deadline.timeout(timeout)
+        except:
+            if limiter is not None:
+                limiter.release()
+            raise
+        health = self.health[server]
+        health.begin()
+        self.metrics.inc('ise_requests_in_flight', {'server': server})
+        started = time.monotonic()
+        try:
+            # verify is passed per request, as REQUESTS_CA_BUNDLE would
+            # override it on the session
+            result = self.session(server).request(method,
+                    self.url(server) + path, verify=self.verify,
+                    timeout=timeout, **kwargs)
+        except requests.exceptions.RequestException:
+            self.record(server, operation, 'error',
+                    time.monotonic() - started)
+            raise
+        except:
+            # not an answer from the server, so it doesn't count either way
+            self.metrics.inc('ise_requests_in_flight', {'server': server}, -1)
+            health.abort()
+            raise
+        finally:
+            if limiter is not None:
+                limiter.release()
+        elapsed = time.monotonic() - started
+        self.record(server, operation, result.status_code, elapsed)
+        if kind == 'read' and result.status_code < 500:
+            self.latency_window(server, operation).add(elapsed)
+        return result
+
+    def latency_window(self, server, operation):
+        """Get the recent read times for an operation on a server.
+
+        Args:
+            server: Server name as a string.
+            operation: Operation name as a string.
+
+        Returns:
+            LatencyWindow object.
+        """
+        window = self.latencies.get((server, operation))
+        if window is None:
+            with self.serverlock:
+                window = self.latencies.setdefault((server, operation),
+                        LatencyWindow())
+        return window
+
+    def hedge_delay(self, server, operation):
+        """Get how long to wait for a read before also sending it to
+        another server.
+
+        Args:
+            server: Server name the read was sent to as a string.
+            operation: Operation name as a string.
+
+        Returns:
+            Number of seconds as a float.
+        """
+        delay = self.latency_window(server, operation).percentile(
+                self.hedge_percentile)
+        if delay is None:
+            return self.hedge_default_delay
+        return max(self.hedge_min_delay, delay)
+
+    def record(self, server, operation, code, elapsed):
+        """Record the outcome of a request in a server's health and in the
+        metrics, and let other processes know if that opened the server's
+        circuit.
+
+        Args:
+            server: Server name as a string.
+            operation: Operation name as a string.
+            code: HTTP status code as an integer, or 'error' if the server
+                did not answer.
+            elapsed: Request time in seconds.
+        """
+        labels = {'server': server, 'operation': operation}
+        self.metrics.inc('ise_requests_in_flight', {'server': server}, -1)
+        self.metrics.inc('ise_requests_total', dict(labels, code=code))
+        self.metrics.observe('ise_request_duration_seconds', labels, elapsed)
+
+        health = self.health[server]
+        ok = code != 'error' and code < 500
+        if health.record(ok, elapsed) and self.shared is not None:
+            self.shared.set('open:' + server, health.retry_time())
+
+    def failover(self, server, operation, reason):
+        """Record in the metrics that a request moved on from a server.
+
+        Args:
+            server: Server name that was skipped or failed as a string.
+            operation: Operation name as a string.
+            reason: Why as a string ('unreachable', 'not_pan' or
+                'circuit_open').
+        """
+        self.metrics.inc('ise_failovers_total', {'server': server,
+                'reason': reason})
+        if reason != 'circuit_open':
+            # the request was sent and has to be sent again
+            self.metrics.inc('ise_retries_total', {'operation': operation,
+                    'reason': reason})
+
+    def collect_metrics(self, metrics):
+        """Update point-in-time metrics: cache statistics and server health.
+
+        Args:
+            metrics: Metrics object.
+        """
+        stats = self.cache.stats()
+        metrics.set('ise_cache_hits_total', None, stats['hits'])
+        metrics.set('ise_cache_misses_total', None, stats['misses'])
+        metrics.set('ise_cache_size', None, stats['size'])
+        for server, status in self.health_status().items():
+            metrics.set('ise_circuit_open', {'server': server},
+                    int(status['state'] == NodeHealth.OPEN))
+            metrics.set('ise_error_rate', {'server': server},
+                    status['error_rate'])
+        for (server, kind), limiter in self.limiters.items():
+            metrics.set('ise_requests_waiting', {'server': server,
+                    'kind': kind}, limiter.status()['waiting'])
+
+    def sync_index(self, lease=3600):
+        """Bring the endpoint index up to date, see EndpointIndex.sync. When
+        running as several processes, only the one holding the index lease
+        pages through ERS; it shares the result, and the others load it in
+        sync_shared.
+
+        Args:
+            lease: Optional number of seconds before another process takes
+                over syncing, if this one stops calling sync_index.
+
+        Returns:
+            True if a sync was run, False otherwise.
+        """
+        if self.shared is None:
+            return self.index.sync(self)
+        if not self.shared.lease('index', lease) or not self.index.sync(self):
+            return False
+        self.shared.save_index(*self.index.snapshot(),
+                started=self.index.started, synced=self.index.synced)
+        return True
+
+    def sync_shared(self):
+        """Pick up changes made by other worker processes: endpoint changes,
+        the current PAN, open circuits, and a newer endpoint index. This does
+        nothing when running as a single process.
+        """
+        if self.shared is None:
+            return
+        for mac, endpoint in self.shared.poll():
+            if endpoint is None:
+                self.forget(mac, publish=False)
+            else:
+                self.remember(mac, endpoint, publish=False)
+
+        state = self.shared.get_all()
+        if state.get('pan') in self.serverlist:
+            with self.serverlock:
+                self.panindex = self.serverlist.index(state['pan'])
+        for server in self.serverlist:
+            if state.get('open:' + server, 0) > time.time():
+                self.health[server].open_until(state['open:' + server])
+        index = state.get('index')
+        if index is not None and index['synced'] > (self.index.synced or 0):
+            self.index.load(*self.shared.load_index(),
+                    started=index['started'], synced=index['synced'])
+
+    def health_status(self):
+        """Get the health of each server.
+
+        Returns:
+            Dictionary of server name -> NodeHealth.status() dictionary.
+        """
+        return {server: self.health[server].status()
+                for server in self.serverlist}
+
+    def discover_pan(self):
+        """Find the primary admin node by asking each server to delete an
+        endpoint that does not exist. The PAN answers 404, while other nodes
+        reject the write with a 401.
+
+        Returns:
+            Server name of the PAN as a string, or None type if no server
+            answered as the PAN.
+        """
+        start = self.panindex
+        for i in range(len(self.serverlist)):
+            server = self.serverlist[(start + i) % len(self.serverlist)]
+            try:
+                result = self.send(server, 'DELETE', "endpoint/" +
+                        self.probe_id, operation='pan_probe', limit=False,
+                        headers=self.delete_headers, timeout=5)
+            except requests.exceptions.RequestException:
+                continue
+            if result.status_code == 404:
+                with self.serverlock:
+                    changed = self.serverlist[self.panindex] != server
+                    self.panindex = self.serverlist.index(server)
+                if changed:
+                    logging.info(server + ' is the primary admin node')
+                    if self.shared is not None:
+                        self.shared.set('pan', server)
+                return server
+        logging.warn('Could not find the primary admin node')
+        return None
+
+    def new_session(self):
+        """Create a keep-alive HTTPS session for a single ISE server. Retries
+        are left to the caller, since they usually mean switching servers.
+        The pool keeps a connection for each worker and hedger thread. It
+        doesn't block, since waiting for a connection would ignore the
+        request's deadline, so threads beyond that (such as bulk lookups)
+        open a connection of their own, which is closed after use.
+
+        Returns:
+            requests.Session object.
+        """
+        session = requests.Session()
+        session.auth = self.auth
+        poolsize = (self.poolsize * 3 if self.hedger is not None
+                else self.poolsize)
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1,
+                pool_maxsize=poolsize, pool_block=False, max_retries=0)
+        session.mount('https://', adapter)
+        return session
 
-    def next_server(self):
-        """Switch to the next known server. This does not accept or return
+    def session(self, server=None):
+        """Get the pooled session for a server, creating it if needed. Sessions
+        are shared across handlers (and threads) so TCP/TLS connections to
+        each ISE node are reused.
+
+        Args:
+            server: Optional server name as a string, defaults to the current
+                server.
+
+        Returns:
+            requests.Session object.
+        """
+        if server is None:
+            server = self.pan()
+        with self.sessionlock:
+            session = self.sessions.get(server)
+            if session is None:
+                session = self.sessions[server] = self.new_session()
+            self.lastused[server] = time.monotonic()
+            return session
+
+    def evict_idle(self):
+        """Close sessions (and their pooled connections) that have not been
+        used within idle_timeout seconds. This does not accept or return
         anything.
         """
-        self.serverindex += 1
-        if self.serverindex >= len(self.serverlist):
-            self.serverindex = 0
+        now = time.monotonic()
+        with self.sessionlock:
+            for server in list(self.sessions):
+                if now - self.lastused.get(server, 0) > self.idle_timeout:
+                    logging.info('Closing idle connections to ' + server)
+                    self.sessions.pop(server).close()
 
     def get_dev_info(self):
     #Current development status
@@ -57,6 +557,7 @@ class ISETools(object):
     def parse_mac(self, mac):
         """Takes in a mac address and converts it to colon-separated formatting.
         Throws a SyntaxError if the mac is not 12 characters without formatting.
+        See maccodec.normalize_many for whole batches.
 
         Args:
             mac: The MAC address to format.
@@ -64,236 +565,778 @@ class ISETools(object):
         Returns:
             mac formatted Cisco style.
         """
-        mac = mac.upper()
-        # Strips everything but the hexadecimal characters.
-        mac = ''.join(char for char in mac if char in 'ABCDEF0123456789')
-        if len(mac) != 12:
-            raise SyntaxError('MAC Address needs to be 12 characters')
-        # Places colons between every 2 characters.
-        return ':'.join(mac[i:i+2] for i in range(0, len(mac), 2))
+        return maccodec.normalize(mac)
 
-    def test_ise_version(self, retries=0):
-        """Test ISE connectivity and service account validity. Note that this
-        does not check to see if the current server is the active one (if set up
-        for HA).
+    def read(self, path, headers, timeout=10, operation='read',
+            deadline=None, hedge=True):
+        """Send a read to ISE. Any node can answer reads, so they are spread
+        across the server list, moving on to the next server if one times out
+        or cannot be reached. With hedged reads enabled, see hedged_read.
 
         Args:
-            retries: Optional retry attempt number as an integer.
+            path: Path after the ERS prefix as a string.
+            headers: HTTP headers as a dictionary.
+            timeout: Optional timeout in seconds for each server.
+            operation: Optional operation name for metrics as a string.
+            deadline: Optional Deadline object shared by every attempt.
+            hedge: Optional, set to False to never hedge this read (for large
+                reads where a second copy costs more than waiting).
 
         Returns:
-            True for successful, False otherwise.
+            requests.Response object.
+
+        Raises:
+            DeadlineExceeded if the deadline passed or was cancelled.
         """
-        if retries >= 3: # retried too many times, give up
-            return False
+        deadline = deadline or NO_DEADLINE
+        tried = set()
+        server = self.read_server()
+        while server is not None:
+            if self.hedger is not None and hedge:
+                result = self.hedged_read(server, tried, path, headers,
+                        timeout, operation, deadline)
+                if result is not None:
+                    return result
+            else:
+                tried.add(server)
+                try:
+                    return self.send(server, 'GET', path,
+                            operation=operation, headers=headers,
+                            timeout=timeout, deadline=deadline)
+                except (requests.exceptions.Timeout,
+                        requests.exceptions.ConnectionError):
+                    self.unreachable(server, operation, deadline)
+            server = self.read_server(exclude=tried)
+        raise ISEAPIError('No ISE servers could be reached')
+
+    def hedged_read(self, server, tried, path, headers, timeout, operation,
+            deadline):
+        """Send a read to a server, and if it hasn't answered within
+        hedge_delay, to the next best server as well. Whichever answers first
+        wins, and the other attempt is cancelled (an attempt already sent can
+        only be left to finish in the background).
+
+        Args:
+            server: Server name as a string.
+            tried: Set of server names already tried, the servers used are
+                added to it.
+            path: Path after the ERS prefix as a string.
+            headers: HTTP headers as a dictionary.
+            timeout: Timeout in seconds for each server.
+            operation: Operation name for metrics as a string.
+            deadline: Deadline object.
+
+        Returns:
+            requests.Response object, or None type if none of the servers
+            could be reached.
+        """
+        attempts = {} # Future -> (server name, Deadline of the attempt)
+        try:
+            while server is not None:
+                tried.add(server)
+                attempt = deadline.child()
+                attempts[self.hedger.submit(self.send, server, 'GET', path,
+                        operation=operation, headers=headers,
+                        timeout=timeout, deadline=attempt)] = (server, attempt)
+                if len(attempts) > 1:
+                    break
+                done, running = wait(attempts, timeout=deadline.timeout(
+                        self.hedge_delay(server, operation)))
+                server = None if done else self.read_server(exclude=tried)
+
+            first = next(iter(attempts.values()))[0]
+            error = None
+            running = set(attempts)
+            while running:
+                done, running = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    server = attempts[future][0]
+                    try:
+                        result = future.result()
+                    except (requests.exceptions.Timeout,
+                            requests.exceptions.ConnectionError):
+                        self.unreachable(server, operation, deadline)
+                        continue
+                    except Exception as e:
+                        # the other server may still answer
+                        error = e
+                        continue
+                    if len(attempts) > 1:
+                        self.metrics.inc('ise_hedged_reads_total', {
+                                'operation': operation, 'winner': ('first'
+                                if server == first else 'hedge')})
+                    return result
+            if error is not None:
+                raise error
+            return None
+        finally:
+            for future, (server, attempt) in attempts.items():
+                future.cancel()
+                attempt.cancel()
+
+    def unreachable(self, server, operation, deadline):
+        """Note that a server timed out or could not be connected to, before
+        moving on to the next one.
+
+        Args:
+            server: Server name as a string.
+            operation: Operation name as a string.
+            deadline: Deadline object of the request.
+
+        Raises:
+            DeadlineExceeded if the timeout was only cut short by the deadline,
+            which is not the server's fault.
+        """
+        deadline.check()
+        logging.warn(server + ' could not be reached, cycling...')
+        self.failover(server, operation, 'unreachable')
+
+    def check_node(self, server):
+        """Check that a single server is reachable and accepts the service
+        account, and remember the result for health_report().
 
-        url = self.url() + "service/versioninfo"
+        Args:
+            server: Server name as a string.
+
+        Returns:
+            Dictionary with 'ok', 'checked' (Unix timestamp), 'latency_ms'
+            and 'error' keys.
+        """
+        started = time.monotonic()
         try:
-            result = requests.get(url,
+            result = self.send(server, 'GET', "service/versioninfo",
+                    operation='health_check', limit=False,
+                    headers=self.get_headers, timeout=5)
+            result.json()['VersionInfo']
+            ok, error = True, None
+        except requests.exceptions.RequestException:
+            ok, error = False, 'Could not be reached'
+        except (ValueError, KeyError, TypeError):
+            ok, error = False, 'HTTP Status ' + str(result.status_code)
+        check = {'ok': ok, 'checked': time.time(),
+                'latency_ms': round((time.monotonic() - started) * 1000, 1),
+                'error': error}
+        self.checks[server] = check
+        return check
+
+    def health_report(self, max_age=None):
+        """Summarize the last check_node() result of every server, without
+        touching the network.
+
+        Args:
+            max_age: Optional number of seconds after which a check is too
+                old to count as passing.
+
+        Returns:
+            Dictionary with 'ok' (True if any server passed), 'age' (seconds
+            since the oldest check, or None type if a server has not been
+            checked yet) and 'servers' (server name -> 'ok', 'age',
+            'latency_ms' and 'error') keys.
+        """
+        now = time.time()
+        servers = {}
+        for server in self.serverlist:
+            check = self.checks.get(server)
+            if check is None:
+                servers[server] = {'ok': False, 'age': None,
+                        'latency_ms': None, 'error': 'Not checked yet'}
+                continue
+            age = round(now - check['checked'], 1)
+            servers[server] = {'ok': check['ok'], 'age': age,
+                    'latency_ms': check['latency_ms'], 'error': check['error']}
+            if max_age is not None and age > max_age:
+                servers[server].update(ok=False, error='Check is out of date')
+        ages = [status['age'] for status in servers.values()]
+        return {'ok': any(status['ok'] for status in servers.values()),
+                'age': None if None in ages else max(ages),
+                'servers': servers}
+
+    def test_ise_version(self):
+        """Test ISE connectivity and service account validity. Note that this
+        does not check to see if the server is the PAN (if set up for HA).
+
+        Returns:
+            True for successful, False otherwise.
+        """
+        try:
+            result = self.read("service/versioninfo",
                     headers={'Content-Type': 'application/json',
-                    'Accept': 'application/json'}, auth=self.auth, timeout=5)
+                    'Accept': 'application/json'}, timeout=5,
+                    operation='version_test')
             json.loads(result.text)
             return True
-        except requests.exceptions.Timeout:
-            # switch to next ISE server and try again
-            logging.warn(self.serverlist[self.serverindex] +
-                    ' timed out, cycling...')
-            self.next_server()
-            return self.test_ise_version(retries=(retries + 1))
         except:
             return False
 
-    def get_endpointid(self, mac):
+    def remember(self, mac, endpoint, publish=True):
+        """Record known endpoint details in the cache, and in the endpoint
+        index if the endpoint is in the iPSK group.
+
+        Args:
+            mac: MAC address as a string.
+            endpoint: Dictionary with 'id', 'psk', 'group' and 'unid' keys.
+            publish: Optional, set to False to not tell other processes.
+        """
+        self.cache.put(mac, endpoint)
+        if endpoint.get('group') == settings.GROUP_ID:
+            self.index.update(mac, endpoint)
+        else:
+            self.index.remove(mac)
+        if publish and self.shared is not None:
+            self.shared.publish(mac, endpoint)
+
+    def forget(self, mac, publish=True):
+        """Drop endpoint details from the cache and endpoint index.
+
+        Args:
+            mac: MAC address as a string.
+            publish: Optional, set to False to not tell other processes.
+        """
+        self.cache.invalidate(mac)
+        self.index.remove(mac)
+        if publish and self.shared is not None:
+            self.shared.publish(mac, None)
+
+    def raise_error(self, result):
+        """Log and raise the error details from an unsuccessful ERS response.
+        ERS errors are JSON, but errors from the web server in front of it
+        (like failed authentication) are HTML pages.
+
+        Args:
+            result: requests.Response object from ISE.
+
+        Raises:
+            ISEAPIError with the error description from ISE.
+        """
+        errorsummary = 'HTTP Status ' + str(result.status_code)
+        errordescription = 'Unexpected response from ISE'
+        try:
+            messages = result.json()['ERSResponse']['messages']
+            errordescription = messages[0]['title']
+        except:
+            #get summary and details of html response
+            summary = HTML_H1.search(result.text)
+            paragraphs = HTML_P.findall(result.text)
+            if summary:
+                errorsummary = HTML_TAG.sub('', summary.group(1)).strip()
+            if len(paragraphs) > 1 and 'Description ' in HTML_TAG.sub('',
+                    paragraphs[1]):
+                errordescription = HTML_TAG.sub('', paragraphs[1]).split(
+                        'Description ', 1)[1].strip()
+        #bundle error details for logging
+        logging.error(errorsummary + ": " + errordescription)
+        #raise details as exception
+        raise ISEAPIError(errordescription)
+
+    def get_endpointid(self, mac, deadline=None):
         """Get the EndpointID for an endpoint MAC address.
 
         Args:
             mac: MAC address as a string.
+            deadline: Optional Deadline object.
 
         Returns:
             endpointID: Endpoint ID as a string if endpoint exists, or None
             type if none exists.
             responseCode: HTTP status code result of endpointID inquiry.
         """
-        url = self.url() + "endpoint?filter=mac.EQ." + mac
+        cached = self.cache.get(mac)
+        if cached:
+            return cached['id'], '200'
 
-        result = requests.get(url, headers=self.get_headers, auth=self.auth)
+        result = self.read("endpoint?filter=mac.EQ." + mac, self.get_headers,
+                operation='lookup', deadline=deadline)
         try:
-            root = ElemTree.fromstring(result.text)
-            responseCode = str(result).split('[')[1].split(']')[0]
+            resources = result.json()['SearchResult']['resources']
+        except:
+            self.raise_error(result)
+        if resources:
+            endpointid = resources[0]['id']
+            self.cache.put(mac, {'id': endpointid})
+            return endpointid, str(result.status_code)
+
+    def search_group(self, page, size=100, deadline=None):
+        """Get one page of the endpoints in the iPSK endpoint group.
 
-            for child in root.iter():
-                if 'id' in child.attrib:
-                    endpointid = child.attrib['id']
-                    return endpointid, responseCode
+        Args:
+            page: Page number as an integer, starting at 1.
+            size: Optional number of endpoints per page as an integer.
+            deadline: Optional Deadline object.
+
+        Returns:
+            resources: List of (Endpoint ID, MAC address) tuples.
+            total: Total number of endpoints in the group as an integer.
+        """
+        result = self.read("endpoint?filter=groupId.EQ." + settings.GROUP_ID +
+                "&size=" + str(size) + "&page=" + str(page), self.get_headers,
+                timeout=30, operation='group_search', deadline=deadline,
+                hedge=False)
+        try:
+            search = result.json()['SearchResult']
         except:
-            soup = BeautifulSoup(result.text, 'html.parser')
-            #get summary of html response
-            errorsummary = soup.body.h1.get_text()
-            #get details of html response
-            errordescription = (soup.body.find('p').findNext('p').get_text(
-                    ).split('Description ')[1])
-            #bundle error details for logging
-            logging.error(errorsummary + ": " + errordescription)
-            #raise details as exception
-            raise ISEAPIError(errordescription)
+            self.raise_error(result)
+        return ([(resource['id'], resource['name'])
+                for resource in search.get('resources', [])],
+                search.get('total', 0))
 
-    def put_psk(self, mac, psk, unid):
-        """Update an endpoint entry with MAC address, uNID, and PSK.
+    def get_endpoint(self, mac, deadline=None, fresh=False, publish=True):
+        """Get the ID and iPSK-related attributes of an endpoint in a single
+        call, using the endpoint's name (its MAC address).
 
         Args:
             mac: MAC address as a string.
-            psk: PSK as a string.
-            unid: uNID as a string.
+            deadline: Optional Deadline object.
+            fresh: Optional, set to True to always ask ISE instead of using
+                cached details.
+            publish: Optional, set to False to not tell other processes about
+                the details.
 
         Returns:
-            responseCode: HTTP status code result of attempted change.
+            Dictionary with 'id', 'psk', 'group' and 'unid' keys if the
+            endpoint exists, or None type if none exists.
         """
-        url = self.url() + "endpoint/" + self.get_endpointid(mac)[0]
+        cached = None if fresh else self.cache.get(mac)
+        if cached and 'psk' in cached:
+            return cached
 
-        xml = """<?xml version='1.0' encoding='UTF-8' standalone='yes'?>
-                <ns3:endpoint name='name' id='id' description='description'
-                xmlns:ns2='ers.ise.cisco.com'
-                xmlns:ns3='identity.ers.ise.cisco.com'>
-                    <customAttributes>
-                        <customAttributes>
-                            <entry>
-                                <key>iPSK</key>
-                                <value>psk=""" + psk + """</value>
-                            </entry>
-                        </customAttributes>
-                    </customAttributes>
-                <groupId>""" + settings.GROUP_ID + """</groupId>
-                <identityStore></identityStore>
-                <identityStoreId></identityStoreId>
-                <mac>""" + mac + """</mac>
-                <portalUser>""" + unid + """</portalUser>
-                <profileId></profileId>
-                <ipsk>""" + psk + """</ipsk>
-                <staticGroupAssignment>true</staticGroupAssignment>
-                <staticProfileAssignment>false</staticProfileAssignment>
-                </ns3:endpoint>"""
+        result = self.read("endpoint/name/" + mac, self.get_headers,
+                operation='lookup', deadline=deadline)
+        if result.status_code == 404:
+            return None
+        try:
+            details = result.json()['ERSEndPoint']
+        except:
+            self.raise_error(result)
+        psk = ((details.get('customAttributes') or {}).get('customAttributes')
+                or {}).get('iPSK')
+        endpoint = {'id': details['id'],
+                'psk': psk.split('psk=', 1)[-1] if psk is not None else None,
+                'group': details.get('groupId'),
+                'unid': details.get('portalUser')}
+        self.remember(mac, endpoint, publish=publish)
+        return endpoint
 
-        result = (requests.put(url, headers=self.put_headers, data=xml,
-                auth=self.auth))
-        responseCode = str(result).split('[')[1].split(']')[0]
+    def endpoint_json(self, mac, psk, unid, endpointid=None):
+        """Build the JSON body used to create or update an endpoint.
 
-        return responseCode
+        Args:
+            mac: MAC address as a string.
+            psk: PSK as a string.
+            unid: uNID as a string.
+            endpointid: Optional Endpoint ID as a string, for updates.
 
-    def create_psk(self, mac, psk, unid, retries=0):
-        """Create a new endpoint to add a PSK for a MAC address and uNID.
+        Returns:
+            JSON document as a string.
+        """
+        details = {'name': mac, 'mac': mac, 'groupId': settings.GROUP_ID,
+                'portalUser': unid, 'staticGroupAssignment': True,
+                'staticProfileAssignment': False,
+                'customAttributes': {'customAttributes': {'iPSK': 'psk=' + psk}}}
+        if endpointid is not None:
+            details['id'] = endpointid
+        return json.dumps({'ERSEndPoint': details})
+
+    def endpoint_xml(self, mac, psk, unid, endpointid='id'):
+        """Build the XML element for an endpoint, for use in bulk requests
+        (which ERS only accepts as XML).
 
         Args:
             mac: MAC address as a string.
             psk: PSK as a string.
             unid: uNID as a string.
-            retries: Optional retry attempt number as an integer.
+            endpointid: Optional Endpoint ID as a string, for updates.
 
         Returns:
-            responseCode: HTTP status code result of attempted change.
+            XML element as a string.
         """
-        if retries >= 3: # retried too many times, give up
-            raise ISEAPIError('No ISE servers could be reached')
-        url = self.url() + "endpoint/"
+        # only bulk requests use XML, so it is imported when first needed
+        from xml.sax.saxutils import escape as xml_escape, quoteattr
+        return ENDPOINT_XML.substitute(id=quoteattr(endpointid),
+                psk=xml_escape(psk), group=xml_escape(settings.GROUP_ID),
+                mac=xml_escape(mac), unid=xml_escape(unid))
 
-        xml = """<?xml version='1.0' encoding='UTF-8' standalone='yes'?>
-                <ns3:endpoint name='name' id='id' description='description'
-                xmlns:ns2='ers.ise.cisco.com'
-                xmlns:ns3='identity.ers.ise.cisco.com'>
-                    <customAttributes>
-                        <customAttributes>
-                            <entry>
-                                <key>iPSK</key>
-                                <value>psk=""" + psk + """</value>
-                            </entry>
-                        </customAttributes>
-                    </customAttributes>
-                <groupId>""" + settings.GROUP_ID + """</groupId>
-                <identityStore></identityStore>
-                <identityStoreId></identityStoreId>
-                <mac>""" + mac + """</mac>
-                <portalUser>""" + unid + """</portalUser>
-                <profileId></profileId>
-                <staticGroupAssignment>true</staticGroupAssignment>
-                <staticProfileAssignment>false</staticProfileAssignment>
-                </ns3:endpoint>"""
+    def write(self, method, path, headers, data=None, attempts=3,
+            operation='write', deadline=None, outcome=None):
+        """Send a change to ISE. Changes are only allowed on the primary admin
+        node, so this cycles through the server list until one accepts it.
+        Servers whose circuit is open are skipped, and retries after a
+        timeout back off exponentially.
 
-        try:
-            result = (requests.post(url, headers=self.post_headers, data=xml,
-                    auth=self.auth, timeout=10))
+        Args:
+            method: HTTP method as a string (POST, PUT or DELETE).
+            path: Path after the ERS prefix as a string.
+            headers: HTTP headers as a dictionary.
+            data: Optional request body as a string.
+            attempts: Optional number of servers to try as an integer.
+            operation: Optional operation name for metrics as a string.
+            deadline: Optional Deadline object shared by every attempt, and
+                the backoff between them.
+            outcome: Optional dictionary to store the name of the server that
+                answered in, as 'node'.
+
+        Returns:
+            requests.Response object from the server that accepted the change.
+
+        Raises:
+            DeadlineExceeded if the deadline passed or was cancelled.
+        """
+        deadline = deadline or NO_DEADLINE
+        for attempt in range(max(attempts, len(self.serverlist))):
+            server = self.pan()
+            if not self.health[server].available():
+                self.failover(server, operation, 'circuit_open')
+                self.next_pan(server)
+                continue
+            try:
+                result = self.send(server, method, path, operation=operation,
+                        headers=headers, data=data, timeout=10,
+                        deadline=deadline)
+            except (requests.exceptions.Timeout,
+                    requests.exceptions.ConnectionError):
+                # switch to next ISE server and try again
+                self.unreachable(server, operation, deadline)
+                self.next_pan(server)
+                time.sleep(deadline.timeout(min(2, 0.1 * 2 ** attempt)))
+                continue
             if (result.status_code == 401 and
                     'operation is allowed on pap node only'
                     in result.text.lower()):
                 # switch to next ISE server and try again
-                logging.warn(self.serverlist[self.serverindex] +
-                        ' is not primary node, cycling...')
-                self.next_server()
-                return self.create_psk(mac, psk, unid, retries=(retries + 1))
-            else:
-                return str(result.status_code)
-        except requests.exceptions.Timeout:
-            # switch to next ISE server and try again
-            logging.warn(self.serverlist[self.serverindex] +
-                    ' timed out, cycling...')
-            self.next_server()
-            return self.create_psk(mac, psk, unid, retries=(retries + 1))
+                logging.warn(server + ' is not primary node, cycling...')
+                self.failover(server, operation, 'not_pan')
+                self.next_pan(server)
+                continue
+            if outcome is not None:
+                outcome['node'] = server
+            return result
+        raise ISEAPIError('No ISE servers could be reached')
+
+    def put_psk(self, mac, psk, unid, endpointid=None, deadline=None,
+            outcome=None):
+        """Update an endpoint entry in place with MAC address, uNID, and PSK.
+
+        Args:
+            mac: MAC address as a string.
+            psk: PSK as a string.
+            unid: uNID as a string.
+            endpointid: Optional Endpoint ID as a string, looked up if not
+                given.
+            deadline: Optional Deadline object.
+            outcome: Optional dictionary, see write().
 
-    def delete_endpoint(self, mac, unid, retries=0):
-        """Delete an enpoint. This is useful for when an iPSK needs to be
-        updated.
+        Returns:
+            responseCode: HTTP status code result of attempted change.
+        """
+        if endpointid is None:
+            endpointid = self.get_endpointid(mac, deadline=deadline)[0]
+
+        self.forget(mac)
+        result = self.write('PUT', "endpoint/" + endpointid, self.put_headers,
+                data=self.endpoint_json(mac, psk, unid, endpointid=endpointid),
+                operation='update', deadline=deadline, outcome=outcome)
+        if result.ok:
+            self.remember(mac, {'id': endpointid, 'psk': psk,
+                    'group': settings.GROUP_ID, 'unid': unid})
+        return str(result.status_code)
+
+    def create_psk(self, mac, psk, unid, deadline=None, outcome=None):
+        """Create a new endpoint to add a PSK for a MAC address and uNID.
 
         Args:
             mac: MAC address as a string.
+            psk: PSK as a string.
             unid: uNID as a string.
-            retries: Optional retry attempt number as an integer.
+            deadline: Optional Deadline object.
+            outcome: Optional dictionary, see write().
+
+        Returns:
+            responseCode: HTTP status code result of attempted change.
+        """
+        self.forget(mac)
+        result = self.write('POST', "endpoint/", self.post_headers,
+                data=self.endpoint_json(mac, psk, unid), operation='create',
+                deadline=deadline, outcome=outcome)
+        # the new Endpoint ID is the last part of the Location header
+        location = result.headers.get('Location', '').rstrip('/')
+        if result.ok and location:
+            self.remember(mac, {'id': location.rsplit('/', 1)[-1],
+                    'psk': psk, 'group': settings.GROUP_ID, 'unid': unid})
+        return str(result.status_code)
+
+    def delete_endpoint(self, mac, unid, endpointid=None, deadline=None):
+        """Delete an enpoint.
+
+        Args:
+            mac: MAC address as a string.
+            unid: uNID as a string.
+            endpointid: Optional Endpoint ID as a string, looked up if not
+                given.
+            deadline: Optional Deadline object.
 
         Returns:
             Response code as a string.
         """
-        if retries >= 3: # retried too many times, give up
-            raise ISEAPIError('No ISE servers could be reached')
-        url = self.url() + "endpoint/" + self.get_endpointid(mac)[0]
+        if endpointid is None:
+            endpointid = self.get_endpointid(mac, deadline=deadline)[0]
+
+        self.forget(mac)
+        return str(self.write('DELETE', "endpoint/" + endpointid,
+                self.delete_headers, operation='delete',
+                deadline=deadline).status_code)
+
+    def set_psk(self, mac, psk, unid, trace=None, deadline=None):
+        """Set a PSK for an endpoint. Existing endpoints are updated in place,
+        or left alone if they already have the same PSK, group and uNID.
+        Otherwise a new endpoint is created. The endpoint is always looked up
+        in ISE rather than the cache, since a change made in ISE since it was
+        cached would otherwise be skipped or sent to a deleted endpoint. The
+        attempt is recorded in the ledger, if there is one.
+
+        Args:
+            mac: MAC address as a string.
+            psk: PSK as a string.
+            unid: uNID as a string.
+            trace: Optional Trace object to time the lookup and write in.
+            deadline: Optional Deadline object shared by the lookup and the
+                write.
 
+        Returns:
+            responseCode: HTTP status code result of attempted change.
+        """
+        trace = trace or Trace()
+        started = time.monotonic()
+        outcome = {} # action taken and the node that took it, for the ledger
         try:
-            result = (requests.delete(url, headers=self.delete_headers,
-                    auth=self.auth, timeout=10))
-            if (result.status_code == 401 and
-                    'operation is allowed on pap node only'
-                    in result.text.lower()):
-                # switch to next ISE server and try again
-                logging.warn(self.serverlist[self.serverindex] +
-                        ' is not primary node, cycling...')
-                self.next_server()
-                return self.delete_endpoint(mac, unid, retries=(retries + 1))
+            with trace.stage('lookup'):
+                endpoint = self.get_endpoint(mac, deadline=deadline,
+                        fresh=True)
+
+            if (endpoint and endpoint['psk'] == psk and
+                    endpoint['unid'] == unid and
+                    endpoint['group'] == settings.GROUP_ID):
+                logging.info(mac + ' already has the requested iPSK, skipping')
+                outcome['action'] = 'unchanged'
+                responseCode = '200'
             else:
-                return str(result.status_code)
-        except requests.exceptions.Timeout:
-            # switch to next ISE server and try again
-            logging.warn(self.serverlist[self.serverindex] +
-                    ' timed out, cycling...')
-            self.next_server()
-            return self.delete_endpoint(mac, unid, retries=(retries + 1))
+                outcome['action'] = 'update' if endpoint else 'create'
+                with trace.stage('write'):
+                    if not endpoint:
+                        responseCode = self.create_psk(mac, psk, unid,
+                                deadline=deadline, outcome=outcome)
+                    else:
+                        responseCode = self.put_psk(mac, psk, unid,
+                                endpointid=endpoint['id'], deadline=deadline,
+                                outcome=outcome)
+        except Exception as e:
+            self.log_registration(mac, unid, started, outcome,
+                    error=str(e) or type(e).__name__)
+            raise
+        self.log_registration(mac, unid, started, outcome, responseCode)
+        return responseCode
 
-    def set_psk(self, mac, psk, unid):
-        """Set a PSK for an endpoint, choose to edit existing endpoint or
-        create new one based off of return from get_endpointid().
+    def log_registration(self, mac, unid, started, outcome, responseCode=None,
+            error=None):
+        """Record a set_psk attempt in the ledger, if there is one.
 
         Args:
             mac: MAC address as a string.
-            psk: PSK as a string.
             unid: uNID as a string.
+            started: time.monotonic() value when the attempt started.
+            outcome: Dictionary with optional 'action' and 'node' keys.
+            responseCode: Optional HTTP status code from ISE as a string.
+            error: Optional error message as a string.
+        """
+        if self.ledger is None:
+            return
+        self.ledger.record(mac, unid, 'ok' if responseCode is not None and
+                responseCode.startswith('2') else 'failed',
+                action=outcome.get('action'), status=responseCode,
+                node=outcome.get('node'), latency=time.monotonic() - started,
+                error=error)
+
+    def bulk_submit(self, operation, endpoints, deadline=None, outcome=None):
+        """Submit a bulk request to ISE.
+
+        Args:
+            operation: Bulk operation type as a string ('create' or 'update').
+            endpoints: List of (MAC address, PSK, uNID, Endpoint ID) tuples.
+                Endpoint ID may be None type for creates.
+            deadline: Optional Deadline object.
+            outcome: Optional dictionary, see write().
 
         Returns:
-            XML details of endpoint.
+            Bulk ID as a string, used with bulk_status().
         """
-        endpointid = self.get_endpointid(mac)
+        xml = ("<?xml version='1.0' encoding='UTF-8' standalone='yes'?>\n" +
+                "<ns4:endpointBulkRequest operationType='" + operation + "' " +
+                "resourceMediaType=" +
+                "'vnd.com.cisco.ise.identity.endpoint.1.0+xml' " +
+                "xmlns:ns4='identity.ers.ise.cisco.com'><ns4:resourcesList>" +
+                ''.join(self.endpoint_xml(mac, psk, unid,
+                        endpointid=(endpointid or 'id'))
+                        for mac, psk, unid, endpointid in endpoints) +
+                "</ns4:resourcesList></ns4:endpointBulkRequest>")
 
-        if not endpointid:
-            return self.create_psk(mac, psk, unid)
-        else:
-            self.delete_endpoint(mac, unid)
-            return self.create_psk(mac, psk, unid)
+        result = self.write('PUT', "endpoint/bulk/submit", self.bulk_headers,
+                data=xml, operation='bulk_submit', deadline=deadline,
+                outcome=outcome)
+        location = result.headers.get('Location', '').rstrip('/')
+        if result.status_code != 202 or not location:
+            self.raise_error(result)
+        return location.rsplit('/', 1)[-1]
+
+    def bulk_status(self, bulkid, server=None, deadline=None):
+        """Get the status of a bulk request. Bulk requests are only tracked by
+        the node they were submitted to, so pass the node bulk_submit() put
+        in outcome['node'].
+
+        Args:
+            bulkid: Bulk ID as a string.
+            server: Optional server name the request was submitted to as a
+                string, defaults to the current PAN.
+            deadline: Optional Deadline object.
+
+        Returns:
+            done: True if ISE has finished the request, False otherwise.
+            statuses: Dictionary of MAC address -> (True if successful,
+                status as a string, Endpoint ID as a string).
+        """
+        result = self.send(server or self.pan(), 'GET',
+                "endpoint/bulk/" + bulkid,
+                operation='bulk_status', headers=self.bulk_status_headers,
+                timeout=10, deadline=deadline)
+        import xml.etree.ElementTree as ElemTree
+        try:
+            root = ElemTree.fromstring(result.text)
+            statuses = {child.attrib['name']: (
+                    child.attrib.get('resourceExecutionStatus') == 'SUCCESS',
+                    child.attrib.get('status', ''), child.attrib.get('id'))
+                    for child in root.iter()
+                    if child.tag.endswith('resourceStatus')}
+            done = root.attrib.get('executionStatus') in ('COMPLETED',
+                    'ABORTED')
+            return done, statuses
+        except:
+            self.raise_error(result)
+
+    def bulk_set_psk(self, entries, chunksize=500, poll=2, timeout=600,
+            deadline=None, concurrency=8):
+        """Set PSKs for many endpoints using ERS bulk requests. Like set_psk,
+        existing endpoints are updated in place and unchanged ones are
+        skipped. If the deadline passes or ISE turns requests away partway
+        through, the chunks not yet sent are marked as failed; the results so
+        far are still returned and recorded.
+
+        Args:
+            entries: List of (MAC address, PSK, uNID) tuples. MAC addresses
+                should be formatted with parse_mac() and be unique.
+            chunksize: Optional maximum number of endpoints per bulk request.
+            poll: Optional number of seconds between bulk status checks.
+            timeout: Optional number of seconds to wait for each bulk request.
+            deadline: Optional Deadline object for the whole call.
+            concurrency: Optional number of endpoints to look up at once.
+
+        Returns:
+            Dictionary of MAC address -> result as a string ('created',
+            'updated', 'unchanged', or 'failed: <reason>').
+        """
+        deadline = deadline or NO_DEADLINE
+        started = time.monotonic()
+        results = {}
+        outcomes = {} # MAC address -> outcome dictionary, for the ledger
+        pending = {'create': [], 'update': []}
+
+        def lookup(mac):
+            try:
+                # the index may be behind changes made in ISE, so this asks
+                # ISE before deciding whether anything needs to change
+                return self.get_endpoint(mac, deadline=deadline,
+                        fresh=True), None
+            except (ISEAPIError, Overloaded, DeadlineExceeded,
+                    requests.exceptions.RequestException) as e:
+                return None, str(e) or type(e).__name__
+
+        # a few at a time, so large requests don't wait on one read after
+        # another before the first bulk request
+        with ThreadPoolExecutor(max_workers=max(1, min(concurrency,
+                len(entries)))) as pool:
+            lookups = list(pool.map(lookup, [mac for mac, psk, unid
+                    in entries]))
+        for (mac, psk, unid), (endpoint, error) in zip(entries, lookups):
+            outcomes[mac] = {}
+            if error is not None:
+                results[mac] = 'failed: ' + error
+            elif not endpoint:
+                outcomes[mac]['action'] = 'create'
+                pending['create'].append((mac, psk, unid, None))
+            elif (endpoint['psk'] == psk and endpoint['unid'] == unid and
+                    endpoint['group'] == settings.GROUP_ID):
+                outcomes[mac]['action'] = 'unchanged'
+                results[mac] = 'unchanged'
+            else:
+                outcomes[mac]['action'] = 'update'
+                pending['update'].append((mac, psk, unid, endpoint['id']))
+
+        stopped = None # why the remaining chunks were not sent
+        for operation, endpoints in pending.items():
+            for i in range(0, len(endpoints), chunksize):
+                chunk = endpoints[i:i+chunksize]
+                outcome = {'action': operation}
+                statuses = {}
+                missing = 'no status from ISE'
+                if stopped is not None:
+                    missing = 'not sent, ' + stopped
+                else:
+                    for mac, psk, unid, endpointid in chunk:
+                        self.forget(mac)
+                    try:
+                        bulkid = self.bulk_submit(operation, chunk,
+                                deadline=deadline, outcome=outcome)
+                        until = time.monotonic() + timeout
+                        done = False
+                        while not done and time.monotonic() < until:
+                            time.sleep(deadline.timeout(poll))
+                            done, statuses = self.bulk_status(bulkid,
+                                    outcome.get('node'), deadline=deadline)
+                    except (ISEAPIError,
+                            requests.exceptions.RequestException) as e:
+                        logging.error('Bulk ' + operation + ' failed: ' +
+                                str(e))
+                    except (DeadlineExceeded, Overloaded) as e:
+                        # later chunks would fare no better
+                        stopped = str(e) or type(e).__name__
+                        logging.error('Bulk ' + operation + ' stopped: ' +
+                                stopped)
+                        missing += ', ' + stopped
+
+                for mac, psk, unid, endpointid in chunk:
+                    outcomes[mac] = outcome
+                    ok, status, newid = statuses.get(mac,
+                            (False, missing, None))
+                    if ok:
+                        results[mac] = operation + 'd'
+                        if endpointid or newid:
+                            self.remember(mac, {'id': endpointid or newid,
+                                    'psk': psk, 'group': settings.GROUP_ID,
+                                    'unid': unid})
+                    else:
+                        results[mac] = 'failed: ' + status
+
+        if self.ledger is not None:
+            latency = time.monotonic() - started
+            for mac, psk, unid in entries:
+                result = results[mac]
+                failed = result.startswith('failed: ')
+                self.ledger.record(mac, unid, 'failed' if failed else 'ok',
+                        action=outcomes[mac].get('action'),
+                        node=outcomes[mac].get('node'), latency=latency,
+                        error=result[len('failed: '):] if failed else None)
+        return results
 
     def send_email(self, responseCode, unid, fname, lname, mac):
-        """Send an email for unsuccessful registrations.
+        """Send an email for unsuccessful registrations. The user is emailed
+        right away, and the failure is added to the next digest email for IPSK
+        admins. Emails are sent in the background, so this does not block.
 
         Args:
             responseCode: Response code from ISE as a string.
@@ -302,53 +1345,513 @@ class ISETools(object):
             lname: Last name of the user as a string.
             mac: Attempted MAC address as a string.
         """
-        if responseCode.startswith('2'):
+        if responseCode.startswith('2') or self.mailer is None:
             return # Cloudpath already sends an email for successful
                    # registrations
 
-        EMAIL_TO = unid + '@utah.edu'
-        # email header details
-        message = ('Dear ' + fname + ' ' + lname + ', <br><p>' +
-                'Thank you for using onboard.utah.edu to register your IoT ' +
-                'device to connect with the University of Utah ULink network. '+
-                ' Unfortunately, we were unable to successfully register your '+
-                'device.<br><br>Please try again. Note: Devices on ULink must '+
-                'register the hardware, or MAC, address (view instructions at '+
-                '<a href="http://bit.ly/finding-mac-for-ulink">' +
-                'http://bit.ly/finding-mac-for-ulink</a>). Then use your MAC ' +
-                'address to register your device via ' +
-                '<a href="https://onboard.utah.edu/">' +
-                'https://onboard.utah.edu/</a>.<br><br>' +
-                'Your device with MAC address ' + mac + ', and associated '+
-                'password or pre-shared key (PSK), should be configured as ' +
-                'follows in order to connect:<br><br>' +
-                'SSID: ULink<br>Authentication: WPA2-Personal<br>Encryption: ' +
-                'AES<br><br>Please note: The ULink network is not intended ' +
-                'for laptops, smartphones, or tablets that are capable of '+
-                'connecting to UConnect.<br><br>For more information about ' +
-                "ULink, copy/paste the following link into your browser's " +
-                "address bar: " +
-                '<a href="http://bit.ly/ulink-device-configuration">' +
-                'http://bit.ly/ulink-device-configuration</a>.<br><br>' +
-                "If you're still unsuccessful after trying to register " +
-                'your device again, please contact the UIT Help Desk ' +
-                '(801-581-4000, option 1) for technical assistance.</p>')
-        message_footer = ('Best regards,<br><br>University ' +
-                'Information Technology<br>The University of Utah<br>' +
-                '102 S 200 E Ste. 110<br>Salt Lake City, UT 84111<br>UIT Help '+
-                'Desk: 801-581-4000 x 1')
-
-        self.emailer.send_email(('ULink device registration status for ' + mac),
-                message, EMAIL_TO, html=True, footer=message_footer,
+        self.mailer.send(('ULink device registration status for ' + mac),
+                USER_EMAIL.substitute(fname=escape(str(fname)),
+                lname=escape(str(lname)), mac=escape(str(mac))),
+                unid + '@utah.edu', html=True, footer=USER_EMAIL_FOOTER,
                 sender=settings.EMAIL_FROM)
 
-        # also send an email to IPSK admins
-        admin_message = ("<p>A recent IOT device registration failed on ULink."+
-                "<br><br>MAC Address: " + str(mac) +
-                "<br>uNID: " + str(unid) +
-                "<br>Response code from ISE: " + str(responseCode) + "</p><p>" +
-                "Please view TOAST logs for more information, or use this " +
-                "API call to test TOAST's connectivity/service account to ISE:"+
-                "<br>(GET) https://toast.utah.edu/ise/test</p>")
-        self.emailer.send_email('ULink device registration failure',
-                admin_message, settings.IPSK_ADMINS, html=True)
+        # also let IPSK admins know in the next digest
+        self.mailer.add_to_digest(ADMIN_DIGEST_ENTRY.substitute(
+                time=time.strftime('%Y-%m-%d %H:%M:%S'), mac=escape(str(mac)),
+                unid=escape(str(unid)), code=escape(str(responseCode))))
+
+class AsyncISETools(object):
+    """Non-blocking wrapper around ISETools for use within Tornado handlers.
+    ERS calls are run on a thread pool, so a slow or unreachable ISE node only
+    ties up a worker thread instead of the whole IOLoop.
+
+    Args:
+        tools: ISETools object to wrap.
+        workers: Optional maximum number of concurrent ISE calls as an integer.
+        journal: Optional Journal object. If given, registrations can be
+            queued with queue_psk and applied in the background.
+        health_interval: Optional number of seconds between background
+            check_health() calls, 0 if they are not run in the background.
+        backlog: Optional number of calls that may wait for a free worker
+            before API requests are turned away, None type for no limit.
+        request_timeout: Optional number of seconds API requests may spend on
+            ISE calls, None type for no limit.
+        sync_interval: Optional number of seconds between endpoint index
+            syncs, 0 if the index is not synced.
+    """
+    def __init__(self, tools, workers=10, journal=None, health_interval=10,
+            backlog=100, request_timeout=30, sync_interval=0):
+        self.tools = tools
+        self.workers = workers
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.journal = journal
+        self.health_interval = health_interval
+        self.sync_interval = sync_interval
+        self.backlog = backlog
+        self.request_timeout = request_timeout
+        self.pending = 0 # calls submitted to the thread pool and not done
+        self.ready = Event() # set once start() has warmed up
+        self.warmup = None # seconds start() took
+        self.requests = 0 # API requests being handled, see begin_request
+        self.draining = False # shutting down, see drain
+        self.applying = False
+        self.checking = False
+        self.lookups = {} # MAC address -> Future of the running lookup
+        self.writes = {} # MAC address -> queued write for that MAC address
+
+    @gen.coroutine
+    def run(self, func, *args, **kwargs):
+        """Run a blocking function on the thread pool.
+
+        Args:
+            func: Function to call.
+            *args, **kwargs: Arguments to pass to func.
+
+        Returns:
+            Future resolving to the return value of func.
+        """
+        self.pending += 1
+        try:
+            result = yield self.executor.submit(func, *args, **kwargs)
+        finally:
+            self.pending -= 1
+        return result
+
+    def admit(self):
+        """Check there is room for another request or journal job on the
+        thread pool. Other background work is not checked, it waits its
+        turn.
+
+        Raises:
+            Overloaded if the backlog is full.
+        """
+        if (self.backlog is not None and
+                self.pending >= self.workers + self.backlog):
+            self.tools.metrics.inc('ise_rejected_total', {'server': 'any',
+                    'kind': 'backlog', 'status': 503})
+            raise Overloaded('Too many requests waiting for ISE', 503,
+                    max(1, int(self.pending / self.workers)))
+
+    def evict_idle(self):
+        """See ISETools.evict_idle."""
+        return self.run(self.tools.evict_idle)
+
+    def cache_stats(self):
+        """See EndpointCache.stats. This does not touch the network, so it is
+        not run on the thread pool.
+        """
+        return self.tools.cache.stats()
+
+    def health_status(self):
+        """See ISETools.health_status. This does not touch the network, so it
+        is not run on the thread pool.
+        """
+        return self.tools.health_status()
+
+    def metrics_text(self):
+        """See Metrics.render. This does not touch the network, so it is not
+        run on the thread pool.
+        """
+        return self.tools.metrics.render()
+
+    def trace(self, name):
+        """See Metrics.trace."""
+        return self.tools.metrics.trace(name)
+
+    def deadline(self, parent=None):
+        """Start the deadline for an API request.
+
+        Args:
+            parent: Optional Deadline object that cancels this one too, for
+                one of many items in a longer request.
+
+        Returns:
+            Deadline object expiring after request_timeout seconds.
+        """
+        return Deadline(self.request_timeout, parent)
+
+    def begin_request(self):
+        """Note the start of an API request, so drain() waits for it."""
+        self.requests += 1
+
+    def end_request(self):
+        """Note the end of an API request from begin_request()."""
+        self.requests -= 1
+
+    def busy(self):
+        """Check whether any work that shouldn't be cut short is running:
+        API requests, writes for a MAC address, or queued registrations being
+        applied.
+
+        Returns:
+            True if there is work running, False otherwise.
+        """
+        return bool(self.requests or self.writes or self.applying)
+
+    @gen.coroutine
+    def drain(self, timeout=30):
+        """Prepare to shut down: report not ready, stop applying queued
+        registrations, and wait for the work in progress to finish.
+
+        Args:
+            timeout: Optional maximum number of seconds to wait.
+
+        Returns:
+            True if all work finished, False if some was still running after
+            timeout seconds.
+        """
+        self.draining = True
+        deadline = time.monotonic() + timeout
+        while self.busy():
+            if time.monotonic() >= deadline:
+                return False
+            yield gen.sleep(0.05)
+        return True
+
+    def single_flight(self, key, func, *args):
+        """Run a blocking function on the thread pool, unless a call with the
+        same key is already running, in which case its result is shared.
+
+        Args:
+            key: Hashable key identifying the call.
+            func: Function to call.
+            *args: Arguments to pass to func.
+
+        Returns:
+            Future resolving to the return value of func.
+        """
+        future = self.lookups.get(key)
+        if future is None:
+            future = self.lookups[key] = self.run(func, *args)
+            future.add_done_callback(lambda f: self.lookups.pop(key, None))
+        return future
+
+    def parse_mac(self, mac):
+        """See ISETools.parse_mac. This does not touch the network, so it is
+        not run on the thread pool.
+        """
+        return self.tools.parse_mac(mac)
+
+    def test_ise_version(self):
+        """See ISETools.test_ise_version."""
+        return self.run(self.tools.test_ise_version)
+
+    @gen.coroutine
+    def start(self, discover_pan=True):
+        """Warm up before reporting ready. Every server is checked at once
+        with ISETools.check_node, which pays for DNS, the TLS handshake and
+        authentication now instead of on the first request and gives
+        /ise/test fresh results. Then the PAN is found, so the first write
+        goes straight to it. Servers that can't be reached are logged and
+        otherwise ignored, so ISE being down doesn't stop the web server from
+        starting. Sets ready and warmup once done.
+
+        Args:
+            discover_pan: Optional, set to False to skip finding the PAN.
+        """
+        started = time.monotonic()
+        checks = yield [self.run(self.tools.check_node, server)
+                for server in self.tools.serverlist]
+        for server, check in zip(self.tools.serverlist, checks):
+            if not check['ok']:
+                logging.warn('Could not warm up ' + server + ': ' +
+                        check['error'])
+        if discover_pan:
+            yield self.discover_pan()
+        self.warmup = time.monotonic() - started
+        self.ready.set()
+
+    @gen.coroutine
+    def check_health(self):
+        """Check every server at once with ISETools.check_node. If this is
+        already running, it returns right away.
+        """
+        if self.checking:
+            return
+        self.checking = True
+        try:
+            yield [self.run(self.tools.check_node, server)
+                    for server in self.tools.serverlist]
+        finally:
+            self.checking = False
+
+    def health_report(self):
+        """See ISETools.health_report. Checks older than three check
+        intervals are treated as failed, in case the checks have stalled. This
+        does not touch the network, so it is not run on the thread pool.
+        """
+        return self.tools.health_report(max_age=(3 * self.health_interval
+                if self.health_interval else None))
+
+    @gen.coroutine
+    def get_endpointid(self, mac, fresh=False, deadline=None):
+        """See ISETools.get_endpointid. The MAC address may be in any form
+        parse_mac accepts, and raises a SyntaxError if it isn't valid.
+        Endpoints in the iPSK group are answered from the local endpoint
+        index once it has synced, unless fresh is True. A lookup already
+        running for the same MAC address is shared, so it can run out of time
+        but is not cancelled.
+        """
+        # the same key the cache, the index and writes use
+        mac = self.tools.parse_mac(mac)
+        if not fresh and self.tools.index.ready():
+            endpoint = self.tools.index.get(mac)
+            if endpoint is not None:
+                return endpoint['id'], '200'
+        if fresh:
+            self.tools.cache.invalidate(mac)
+        if mac not in self.lookups:
+            self.admit()
+        deadline = deadline or NO_DEADLINE
+        result = yield self.single_flight(mac, self.tools.get_endpointid, mac,
+                deadline.shared())
+        return result
+
+    def history(self, mac=None, unid=None, limit=100):
+        """See Ledger.history. This raises a ValueError if there is no
+        ledger.
+        """
+        if self.tools.ledger is None:
+            raise ValueError('Registration history is not enabled')
+        return self.run(self.tools.ledger.history, mac, unid, limit)
+
+    def list_unid(self, unid):
+        """See EndpointIndex.list_unid. This raises a ValueError if the
+        endpoint index is not synced, and returns None type if it has not
+        finished its first sync yet.
+        """
+        if not self.sync_interval:
+            raise ValueError('Looking up devices by uNID is not enabled')
+        if not self.tools.index.ready():
+            return None
+        return self.tools.index.list_unid(unid)
+
+    def sync_shared(self):
+        """See ISETools.sync_shared."""
+        return self.run(self.tools.sync_shared)
+
+    def discover_pan(self):
+        """See ISETools.discover_pan."""
+        return self.run(self.tools.discover_pan)
+
+    def sync_index(self, lease=3600):
+        """See ISETools.sync_index."""
+        return self.run(self.tools.sync_index, lease)
+
+    @gen.coroutine
+    def export_page(self, page, size=100, concurrency=4, deadline=None):
+        """Get one page of the iPSK endpoint group along with each endpoint's
+        details, for exports. Details come from the endpoint index once it
+        has synced; otherwise, or if the index is behind, they are looked up
+        concurrency at a time so an export doesn't crowd out other requests.
+
+        Args:
+            page: Page number as an integer, starting at 1.
+            size: Optional number of endpoints per page as an integer.
+            concurrency: Optional number of lookups to run at once.
+            deadline: Optional Deadline object.
+
+        Returns:
+            endpoints: List of dictionaries with 'mac', 'id', 'psk', 'group'
+                and 'unid' keys, in ERS order. Endpoints deleted since the
+                page was read are left out, and endpoints that couldn't be
+                looked up only have 'mac', 'id' and 'error' keys.
+            total: Total number of endpoints in the group as an integer.
+        """
+        @gen.coroutine
+        def lookup(endpointid, mac):
+            try:
+                endpoint = yield self.run(self.tools.get_endpoint, mac,
+                        deadline=deadline)
+            except (ISEAPIError, Overloaded,
+                    requests.exceptions.RequestException) as e:
+                # one failed lookup shouldn't end the whole export
+                error = str(e) or type(e).__name__
+                logging.warning('Export lookup of ' + mac + ' failed: ' +
+                        error)
+                self.tools.metrics.inc('ise_export_errors_total')
+                return {'id': endpointid, 'error': error}
+            return endpoint
+
+        resources, total = yield self.run(self.tools.search_group, page, size,
+                deadline=deadline)
+        details = {}
+        missing = []
+        for endpointid, mac in resources:
+            endpoint = (self.tools.index.get(mac)
+                    if self.tools.index.ready() else None)
+            if endpoint is not None and endpoint['id'] == endpointid:
+                details[mac] = endpoint
+            else:
+                missing.append((endpointid, mac))
+        for i in range(0, len(missing), concurrency):
+            chunk = missing[i:i + concurrency]
+            endpoints = yield gen.multi([lookup(endpointid, mac)
+                    for endpointid, mac in chunk],
+                    quiet_exceptions=DeadlineExceeded)
+            macs = [mac for endpointid, mac in chunk]
+            details.update(zip(macs, endpoints))
+        return [dict(details[mac], mac=mac) for endpointid, mac in resources
+                if details.get(mac) is not None], total
+
+    @gen.coroutine
+    def set_psk(self, mac, psk, unid, trace=None, deadline=None):
+        """See ISETools.set_psk. Writes for the same MAC address are run one
+        at a time. Writes that arrive while one is running wait for it, and
+        only the last of them is sent to ISE; the ones it replaced with a
+        different PSK or uNID get SUPERSEDED instead of a response code, and
+        are recorded in the ledger as superseded. Repeats of the queued write
+        (retries and double submits) share its result instead. Time spent
+        waiting is traced as the 'queued' stage.
+        """
+        deadline = deadline or NO_DEADLINE
+        queued = self.writes.get(mac)
+        if queued is not None:
+            # waits for the running write, so this needs no room of its own
+            if queued['future'] is None:
+                queued['future'] = Future()
+                queued['started'] = time.monotonic()
+            elif queued['args'][:2] != (psk, unid):
+                self.supersede(mac, queued) # last write wins
+                queued['future'] = Future()
+                queued['started'] = time.monotonic()
+            # sent with the deadline of the latest caller
+            queued['args'] = (psk, unid, deadline.shared())
+            with (trace or Trace()).stage('queued'):
+                result = yield queued['future']
+            return result
+
+        self.admit()
+        self.writes[mac] = {'future': None, 'args': None, 'started': None}
+        try:
+            result = yield self.run(self.tools.set_psk, mac, psk, unid,
+                    trace=trace, deadline=deadline)
+        finally:
+            ioloop.IOLoop.current().spawn_callback(self.drain_writes, mac)
+        return result
+
+    def supersede(self, mac, queued):
+        """Answer a queued write that is being replaced by a later one with
+        SUPERSEDED, and record that in the ledger, if there is one.
+
+        Args:
+            mac: MAC address as a string.
+            queued: Queued write dictionary from self.writes.
+        """
+        psk, unid, deadline = queued['args']
+        if self.tools.ledger is not None:
+            self.tools.ledger.record(mac, unid, SUPERSEDED,
+                    latency=time.monotonic() - queued['started'])
+        queued['future'].set_result(SUPERSEDED)
+
+    @gen.coroutine
+    def drain_writes(self, mac):
+        """Run the writes queued for a MAC address by set_psk, until none are
+        left.
+
+        Args:
+            mac: MAC address as a string.
+        """
+        queued = self.writes[mac]
+        while queued['future'] is not None:
+            future, (psk, unid, deadline) = queued['future'], queued['args']
+            queued['future'] = queued['args'] = queued['started'] = None
+            try:
+                future.set_result((yield self.run(self.tools.set_psk, mac,
+                        psk, unid, deadline=deadline)))
+            except Exception as e:
+                future.set_exception(e)
+        del self.writes[mac]
+
+    @gen.coroutine
+    def queue_psk(self, mac, psk, unid, fname, lname):
+        """Queue a registration in the journal, to be applied to ISE in the
+        background.
+
+        Args:
+            mac: MAC address as a string, formatted by parse_mac.
+            psk: PSK as a string.
+            unid: uNID as a string.
+            fname: First name of the user as a string.
+            lname: Last name of the user as a string.
+
+        Returns:
+            Job ID as a string.
+        """
+        jobid = yield self.run(self.journal.add, mac, psk, unid, fname, lname)
+        ioloop.IOLoop.current().spawn_callback(self.apply_journal)
+        return jobid
+
+    def get_job(self, jobid):
+        """See Journal.get."""
+        return self.run(self.journal.get, jobid)
+
+    @gen.coroutine
+    def purge_journal(self):
+        """See Journal.purge."""
+        deleted = yield self.run(self.journal.purge)
+        if deleted:
+            logging.info('Journal purged ' + str(deleted) + ' finished jobs')
+
+    @gen.coroutine
+    def apply_journal(self):
+        """Apply queued registrations from the journal until none are ready.
+        If this is already running, it returns right away. While draining, no
+        new jobs are started; they are left for the next start.
+        """
+        if self.applying or self.draining:
+            return
+        self.applying = True
+        try:
+            while not self.draining:
+                jobs = yield self.run(self.journal.claim, self.workers)
+                if not jobs:
+                    break
+                yield [self.apply_job(job) for job in jobs]
+        finally:
+            self.applying = False
+
+    @gen.coroutine
+    def apply_job(self, job):
+        """Apply a single job from the journal, and record the outcome. Server
+        errors are retried with exponential backoff; other failures are final
+        and the user and IPSK admins are emailed.
+
+        Args:
+            job: Job dictionary from Journal.claim.
+        """
+        try:
+            responseCode = yield self.set_psk(job['mac'], job['psk'],
+                    job['unid'])
+            retry = responseCode.startswith('5')
+        except Exception as e:
+            logging.error('Queued iPSK change for ' + job['mac'] +
+                    ' failed: ' + str(e))
+            responseCode, retry = str(e), True
+
+        if responseCode == SUPERSEDED:
+            # a later change for the same MAC address was made instead
+            yield self.run(self.journal.finish, job['id'], SUPERSEDED,
+                    responseCode)
+        elif responseCode.startswith('2'):
+            yield self.run(self.journal.finish, job['id'], 'done',
+                    responseCode)
+        elif retry and job['attempts'] < self.journal.max_attempts:
+            yield self.run(self.journal.retry, job['id'], responseCode,
+                    min(300, 5 * 2 ** (job['attempts'] - 1)))
+        else:
+            yield self.run(self.journal.finish, job['id'], 'failed',
+                    responseCode)
+            self.send_email(responseCode, job['unid'], job['firstname'],
+                    job['lastname'], job['mac'])
+
+    def bulk_set_psk(self, entries, deadline=None):
+        """See ISETools.bulk_set_psk."""
+        self.admit()
+        return self.run(self.tools.bulk_set_psk, entries, deadline=deadline)
+
+    def send_email(self, responseCode, unid, fname, lname, mac):
+        """See ISETools.send_email. This does not block, so it is not run on
+        the thread pool.
+        """
+        self.tools.send_email(responseCode, unid, fname, lname, mac)
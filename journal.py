@@ -0,0 +1,202 @@
+import os, sqlite3, threading, time, uuid
+
+def pid_exists(pid):
+    """Check whether a process is running.
+
+    Args:
+        pid: Process ID as an integer.
+
+    Returns:
+        True if the process exists, False otherwise.
+    """
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+class Journal(object):
+    """Durable queue of iPSK registrations waiting to be applied to ISE,
+    stored in SQLite. Jobs for the same MAC address are applied in the order
+    they were added, and a new job replaces any job for the same MAC address
+    that has not started yet. PSKs are only kept until a job is finished,
+    and finished jobs are deleted after the retention period. This is safe to
+    use from multiple threads and from multiple processes sharing the same
+    file.
+
+    Args:
+        filename: SQLite database filename as a string.
+        max_attempts: Optional number of tries before a job is failed.
+        retention: Optional number of seconds to keep finished jobs for, None
+            type to keep them forever.
+    """
+    def __init__(self, filename, max_attempts=10, retention=None):
+        self.max_attempts = max_attempts
+        self.retention = retention
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(filename, timeout=5,
+                check_same_thread=False, isolation_level=None)
+        self.db.row_factory = sqlite3.Row
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.execute('''CREATE TABLE IF NOT EXISTS jobs (
+                seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                id TEXT UNIQUE NOT NULL,
+                mac TEXT NOT NULL,
+                psk TEXT NOT NULL,
+                unid TEXT NOT NULL,
+                firstname TEXT,
+                lastname TEXT,
+                status TEXT NOT NULL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                owner INTEGER,
+                result TEXT,
+                created REAL NOT NULL,
+                updated REAL NOT NULL,
+                next_try REAL NOT NULL)''')
+        self.db.execute('''CREATE INDEX IF NOT EXISTS jobs_mac_status
+                ON jobs (mac, status)''')
+        self.db.execute('''CREATE INDEX IF NOT EXISTS jobs_status_next_try
+                ON jobs (status, next_try)''')
+        self.db.execute('''CREATE INDEX IF NOT EXISTS jobs_updated
+                ON jobs (updated)''')
+        # finished before PSKs were cleared on finishing
+        self.db.execute("UPDATE jobs SET psk='' WHERE status NOT IN "
+                "('pending', 'running') AND psk!=''")
+        # jobs that were running when their process stopped are retried
+        for (owner,) in self.db.execute("SELECT DISTINCT owner FROM jobs "
+                "WHERE status='running'").fetchall():
+            # (this process can't have claimed anything yet, so a job it owns
+            # is from before a restart that reused the process ID)
+            if (owner is None or owner == os.getpid() or
+                    not pid_exists(owner)):
+                self.db.execute("UPDATE jobs SET status='pending' WHERE "
+                        "status='running' AND owner IS ?", (owner,))
+
+    def add(self, mac, psk, unid, fname=None, lname=None):
+        """Queue a registration. If the same registration is already waiting,
+        its job ID is returned instead of adding a new job.
+
+        Args:
+            mac: MAC address as a string, formatted by ISETools.parse_mac.
+            psk: PSK as a string.
+            unid: uNID as a string.
+            fname: Optional first name of the user as a string.
+            lname: Optional last name of the user as a string.
+
+        Returns:
+            Job ID as a string.
+        """
+        now = time.time()
+        with self.lock:
+            self.db.execute('BEGIN IMMEDIATE')
+            try:
+                row = self.db.execute("SELECT id FROM jobs WHERE mac=? AND "
+                        "psk=? AND unid=? AND status='pending'",
+                        (mac, psk, unid)).fetchone()
+                if row is not None:
+                    jobid = row['id']
+                else:
+                    jobid = uuid.uuid4().hex
+                    self.db.execute("UPDATE jobs SET status='superseded', "
+                            "psk='', result=?, updated=? WHERE mac=? AND "
+                            "status='pending'", (jobid, now, mac))
+                    self.db.execute("INSERT INTO jobs (id, mac, psk, unid, "
+                            "firstname, lastname, status, created, updated, "
+                            "next_try) VALUES (?, ?, ?, ?, ?, ?, 'pending', "
+                            "?, ?, ?)", (jobid, mac, psk, unid, fname, lname,
+                            now, now, now))
+                self.db.execute('COMMIT')
+            except:
+                self.db.execute('ROLLBACK')
+                raise
+        return jobid
+
+    def get(self, jobid):
+        """Look up a job.
+
+        Args:
+            jobid: Job ID as a string.
+
+        Returns:
+            Dictionary of job details (without the PSK), or None type if the
+            job does not exist.
+        """
+        with self.lock:
+            row = self.db.execute('SELECT id, mac, unid, status, attempts, '
+                    'result, created, updated FROM jobs WHERE id=?',
+                    (jobid,)).fetchone()
+        return dict(row) if row is not None else None
+
+    def claim(self, limit):
+        """Take jobs that are ready to be applied, and mark them as running.
+        Only the oldest waiting job for each MAC address is taken, and none
+        are taken for a MAC address that already has a running job.
+
+        Args:
+            limit: Maximum number of jobs to take as an integer.
+
+        Returns:
+            List of job dictionaries.
+        """
+        now = time.time()
+        with self.lock:
+            self.db.execute('BEGIN IMMEDIATE')
+            try:
+                rows = self.db.execute("""SELECT * FROM jobs j
+                        WHERE status='pending' AND next_try<=?
+                        AND NOT EXISTS (SELECT 1 FROM jobs o
+                            WHERE o.mac=j.mac AND (o.status='running' OR
+                            (o.status='pending' AND o.seq<j.seq)))
+                        ORDER BY seq LIMIT ?""", (now, limit)).fetchall()
+                self.db.executemany("UPDATE jobs SET status='running', "
+                        "attempts=attempts+1, owner=?, updated=? WHERE id=?",
+                        [(os.getpid(), now, row['id']) for row in rows])
+                self.db.execute('COMMIT')
+            except:
+                self.db.execute('ROLLBACK')
+                raise
+        return [dict(row, attempts=row['attempts'] + 1) for row in rows]
+
+    def finish(self, jobid, status, result):
+        """Record the outcome of a job, and clear its PSK.
+
+        Args:
+            jobid: Job ID as a string.
+            status: 'done', 'failed' if the job will not be retried, or
+                'superseded' if a later change was made instead.
+            result: Response code or error message as a string.
+        """
+        with self.lock:
+            self.db.execute("UPDATE jobs SET status=?, psk='', result=?, "
+                    "updated=? WHERE id=?", (status, result, time.time(),
+                    jobid))
+
+    def purge(self):
+        """Delete finished jobs older than the retention period.
+
+        Returns:
+            Number of jobs deleted as an integer.
+        """
+        if self.retention is None:
+            return 0
+        with self.lock:
+            return self.db.execute("DELETE FROM jobs WHERE status NOT IN "
+                    "('pending', 'running') AND updated<?",
+                    (time.time() - self.retention,)).rowcount
+
+    def retry(self, jobid, result, delay):
+        """Put a job back in the queue to be tried again later.
+
+        Args:
+            jobid: Job ID as a string.
+            result: Error message from the last try as a string.
+            delay: Number of seconds to wait before the next try.
+        """
+        now = time.time()
+        with self.lock:
+            self.db.execute("UPDATE jobs SET status='pending', result=?, "
+                    "updated=?, next_try=? WHERE id=?",
+                    (result, now, now + delay, jobid))
@@ -0,0 +1,194 @@
+import logging, queue, sqlite3, threading, time, traceback
+
+class Ledger(object):
+    """History of every iPSK registration attempt, stored in SQLite and
+    indexed by MAC address, uNID and time, for the helpdesk and for triaging
+    failures. Records are written by a single background thread, a batch
+    at a time, so recording never blocks the caller. They wait in a bounded
+    queue and are dropped (with a warning) if the queue is full. This is safe
+    to use from multiple threads and from multiple processes sharing the same
+    file.
+
+    Args:
+        filename: SQLite database filename as a string.
+        retention: Optional number of seconds to keep records for, None type
+            to keep them forever.
+        batch_size: Optional maximum number of records per write as an
+            integer.
+        maxsize: Optional maximum number of queued records as an integer.
+    """
+    # records older than retention are deleted this often, in seconds
+    prune_interval = 3600
+
+    def __init__(self, filename, retention=None, batch_size=500,
+            maxsize=10000):
+        self.filename = filename
+        self.retention = retention
+        self.batch_size = batch_size
+        self.queue = queue.Queue(maxsize)
+        self.lock = threading.Lock()
+        self.db = self.connect()
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('''CREATE TABLE IF NOT EXISTS registrations (
+                seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                time REAL NOT NULL,
+                mac TEXT NOT NULL,
+                unid TEXT,
+                action TEXT,
+                outcome TEXT NOT NULL,
+                status TEXT,
+                node TEXT,
+                latency_ms REAL,
+                error TEXT)''')
+        self.db.execute('''CREATE INDEX IF NOT EXISTS registrations_mac_time
+                ON registrations (mac, time)''')
+        self.db.execute('''CREATE INDEX IF NOT EXISTS registrations_unid_time
+                ON registrations (unid, time)''')
+        self.db.execute('''CREATE INDEX IF NOT EXISTS registrations_time
+                ON registrations (time)''')
+        self.thread = threading.Thread(target=self.run, name='ledger',
+                daemon=True)
+        self.thread.start()
+
+    def connect(self):
+        """Open a connection to the database.
+
+        Returns:
+            sqlite3.Connection object.
+        """
+        db = sqlite3.connect(self.filename, timeout=5,
+                check_same_thread=False, isolation_level=None)
+        db.row_factory = sqlite3.Row
+        db.execute('PRAGMA synchronous=NORMAL')
+        return db
+
+    def record(self, mac, unid, outcome, action=None, status=None, node=None,
+            latency=None, error=None):
+        """Queue a record of a registration attempt.
+
+        Args:
+            mac: MAC address as a string, formatted by ISETools.parse_mac.
+            unid: uNID as a string.
+            outcome: 'ok', 'failed' if the iPSK was not set, or 'superseded'
+                if a later change for the same MAC address was made instead.
+            action: Optional change made as a string ('create', 'update' or
+                'unchanged'), None type if it failed before one was chosen.
+            status: Optional HTTP status code from ISE as a string.
+            node: Optional server name that made the change as a string.
+            latency: Optional number of seconds the attempt took.
+            error: Optional error message as a string.
+
+        Returns:
+            True if the record was queued, False if the queue was full.
+        """
+        try:
+            self.queue.put_nowait((time.time(), mac, unid, action, outcome,
+                    status, node, None if latency is None else
+                    round(latency * 1000, 1), error))
+            return True
+        except queue.Full:
+            logging.warn('Ledger queue is full, dropping record for ' +
+                    str(mac))
+            return False
+
+    def history(self, mac=None, unid=None, limit=100):
+        """Look up registration attempts, newest first.
+
+        Args:
+            mac: Optional MAC address as a string, formatted by
+                ISETools.parse_mac.
+            unid: Optional uNID as a string.
+            limit: Optional maximum number of records as an integer.
+
+        Returns:
+            List of record dictionaries with 'time', 'mac', 'unid', 'action',
+            'outcome', 'status', 'node', 'latency_ms' and 'error' keys.
+        """
+        where, args = [], []
+        if mac is not None:
+            where.append('mac=?')
+            args.append(mac)
+        if unid is not None:
+            where.append('unid=?')
+            args.append(unid)
+        with self.lock:
+            rows = self.db.execute('SELECT time, mac, unid, action, outcome, '
+                    'status, node, latency_ms, error FROM registrations' +
+                    (' WHERE ' + ' AND '.join(where) if where else '') +
+                    ' ORDER BY time DESC LIMIT ?', args + [limit]).fetchall()
+        return [dict(row) for row in rows]
+
+    def write(self, db, records):
+        """Write a batch of records in a single transaction. This runs on the
+        ledger's thread.
+
+        Args:
+            db: sqlite3.Connection object of the ledger's thread.
+            records: List of record tuples from record().
+        """
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            db.executemany('INSERT INTO registrations (time, mac, unid, '
+                    'action, outcome, status, node, latency_ms, error) '
+                    'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', records)
+            db.execute('COMMIT')
+        except:
+            db.execute('ROLLBACK')
+            raise
+
+    def prune(self, db):
+        """Delete records older than the retention period. This runs on the
+        ledger's thread.
+
+        Args:
+            db: sqlite3.Connection object of the ledger's thread.
+        """
+        deleted = db.execute('DELETE FROM registrations WHERE time<?',
+                (time.time() - self.retention,)).rowcount
+        if deleted:
+            logging.info('Ledger pruned ' + str(deleted) + ' old records')
+
+    def run(self):
+        """Write queued records until stop() is called. Whatever is queued
+        when a record arrives goes into the same batch, so under load there
+        are few, large writes. This runs on the ledger's thread.
+        """
+        db = self.connect()
+        next_prune = time.monotonic()
+        stopping = False
+        while not stopping:
+            try:
+                records = [self.queue.get(timeout=self.prune_interval)]
+            except queue.Empty:
+                records = []
+            while records and len(records) < self.batch_size:
+                try:
+                    records.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            if None in records:
+                # stop() was called, everything before it is written first
+                stopping = True
+                records = [record for record in records if record is not None]
+            try:
+                if records:
+                    self.write(db, records)
+                if (self.retention is not None and
+                        time.monotonic() >= next_prune):
+                    next_prune = time.monotonic() + self.prune_interval
+                    self.prune(db)
+            except:
+                traceback.print_exc()
+        db.close()
+
+    def stop(self, timeout=5):
+        """Write the records still queued, and stop the ledger's thread.
+
+        Args:
+            timeout: Optional number of seconds to wait.
+        """
+        try:
+            self.queue.put(None, timeout=timeout)
+        except queue.Full:
+            return
+        self.thread.join(timeout)
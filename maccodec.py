@@ -0,0 +1,196 @@
+import binascii
+
+ERROR_LENGTH = 'MAC Address needs to be 12 characters'
+ERROR_TYPE = 'MAC Address needs to be a string'
+
+# hex digits are kept and uppercased, everything else is dropped; that covers
+# the Cisco dotted (7431.7d60.9c9b), hyphenated, colon-separated and bare
+# forms, and matches what ISETools.parse_mac has always accepted
+UPPER = bytes.maketrans(b'abcdef', b'ABCDEF')
+DROP = bytes(sorted(set(range(256)) - set(b'0123456789ABCDEFabcdef')))
+# batches are joined on newlines, which have to survive the filtering
+DROP_BATCH = DROP.replace(b'\n', b'')
+# stands in for invalid addresses so batches can be formatted in one go
+PLACEHOLDER = b'0' * 12
+
+def digits(mac):
+    """Get the hex digits of a MAC address.
+
+    Args:
+        mac: MAC address as a string, in any form.
+
+    Returns:
+        Uppercase hex digits as bytes, or None type if mac is not a string.
+    """
+    if not isinstance(mac, str):
+        return None
+    return mac.encode('ascii', 'ignore').translate(UPPER, DROP)
+
+def digits_many(macs):
+    """Get the hex digits of a batch of MAC addresses. The batch is filtered
+    in one pass over a single joined buffer rather than one address at a
+    time.
+
+    Args:
+        macs: List of MAC addresses as strings, in any form.
+
+    Returns:
+        found: List the same length as macs of 12 uppercase hex digits as
+            bytes, or PLACEHOLDER where the MAC address is invalid.
+        errors: Dictionary of position in macs -> error message as a string,
+            for the invalid ones.
+    """
+    try:
+        found = '\n'.join(macs).encode('ascii', 'ignore').translate(UPPER,
+                DROP_BATCH).split(b'\n')
+    except TypeError:
+        found = None # not all strings
+    if found is None or len(found) != len(macs):
+        # newlines within an address, so take them one at a time
+        found = [digits(mac) for mac in macs]
+    elif set(map(len, found)) <= {12}:
+        return found, {} # all valid, the usual case
+    errors = {i: ERROR_TYPE if mac is None else ERROR_LENGTH
+            for i, mac in enumerate(found) if mac is None or len(mac) != 12}
+    for i in errors:
+        found[i] = PLACEHOLDER
+    return found, errors
+
+def format_many(found):
+    """Format hex digits in the colon-separated form ISE uses.
+
+    Args:
+        found: List of 12 uppercase hex digits as bytes.
+
+    Returns:
+        List of MAC addresses as strings, like 74:31:7D:60:9C:9B.
+    """
+    return format_joined(b''.join(found), len(found))
+
+def format_joined(joined, count):
+    """Format hex digits in the colon-separated form ISE uses.
+
+    Args:
+        joined: 12 uppercase hex digits per MAC address as bytes, back to
+            back.
+        count: Number of MAC addresses as an integer.
+
+    Returns:
+        List of MAC addresses as strings, like 74:31:7D:60:9C:9B.
+    """
+    if not count:
+        return []
+    # every address is 17 characters and a newline, so each digit can be
+    # copied into place for the whole batch at once
+    text = bytearray(b':') * (18 * count)
+    for i in range(12):
+        text[i + i // 2::18] = joined[i::12]
+    text[17::18] = b'\n' * count
+    return text[:-1].decode('ascii').split('\n')
+
+def normalize(mac):
+    """Convert a MAC address to the colon-separated form ISE uses.
+
+    Args:
+        mac: MAC address as a string, in any form.
+
+    Returns:
+        MAC address as a string, like 74:31:7D:60:9C:9B.
+
+    Raises:
+        SyntaxError if the MAC address is not 12 hex digits.
+    """
+    found = digits(mac)
+    if found is None:
+        raise SyntaxError(ERROR_TYPE)
+    if len(found) != 12:
+        raise SyntaxError(ERROR_LENGTH)
+    return format_joined(found, 1)[0]
+
+def normalize_many(macs):
+    """Convert a batch of MAC addresses to the colon-separated form ISE
+    uses, reporting invalid ones instead of raising.
+
+    Args:
+        macs: List of MAC addresses as strings, in any form.
+
+    Returns:
+        normalized: List the same length as macs of MAC addresses as
+            strings, or None type where the MAC address is invalid.
+        errors: Dictionary of position in macs -> error message as a string,
+            for the invalid ones.
+    """
+    found, errors = digits_many(macs)
+    normalized = format_many(found)
+    for i in errors:
+        normalized[i] = None
+    return normalized, errors
+
+def to_int(mac):
+    """Convert a MAC address to a 48-bit integer, a compact key for indexes
+    and de-duplication.
+
+    Args:
+        mac: MAC address as a string, in any form.
+
+    Returns:
+        MAC address as an integer.
+
+    Raises:
+        SyntaxError if the MAC address is not 12 hex digits.
+    """
+    found = digits(mac)
+    if found is None:
+        raise SyntaxError(ERROR_TYPE)
+    if len(found) != 12:
+        raise SyntaxError(ERROR_LENGTH)
+    return int(found, 16)
+
+def to_int_many(macs):
+    """Convert a batch of MAC addresses to 48-bit integers, reporting
+    invalid ones instead of raising.
+
+    Args:
+        macs: List of MAC addresses as strings, in any form.
+
+    Returns:
+        values: List the same length as macs of MAC addresses as integers,
+            or None type where the MAC address is invalid.
+        errors: Dictionary of position in macs -> error message as a string,
+            for the invalid ones.
+    """
+    found, errors = digits_many(macs)
+    values = [int(mac, 16) for mac in found]
+    for i in errors:
+        values[i] = None
+    return values, errors
+
+def from_int(value):
+    """Convert a 48-bit integer from to_int back to a MAC address.
+
+    Args:
+        value: MAC address as an integer.
+
+    Returns:
+        MAC address as a string, like 74:31:7D:60:9C:9B.
+
+    Raises:
+        OverflowError if value is negative or more than 48 bits.
+    """
+    return format_joined(binascii.hexlify(value.to_bytes(6, 'big')).upper(),
+            1)[0]
+
+def from_int_many(values):
+    """Convert a batch of 48-bit integers from to_int back to MAC addresses.
+
+    Args:
+        values: List of MAC addresses as integers.
+
+    Returns:
+        List of MAC addresses as strings, like 74:31:7D:60:9C:9B.
+
+    Raises:
+        OverflowError if a value is negative or more than 48 bits.
+    """
+    return format_joined(binascii.hexlify(b''.join(value.to_bytes(6, 'big')
+            for value in values)).upper(), len(values))
@@ -0,0 +1,108 @@
+import logging, queue, threading, time, traceback
+
+class MailDispatcher(object):
+    """Sends email from a single background thread, so sending never blocks
+    the caller. Messages wait in a bounded queue, and are dropped (with a
+    warning) if the queue is full. Digest entries are collected and sent as
+    one message every digest_interval seconds.
+
+    Args:
+        emailer: Object with a send_email(subject, message, to, **kwargs)
+            method. It is only ever used from the dispatcher's thread, so it
+            can keep its SMTP connection open between messages.
+        digest_subject: Subject of digest messages as a string.
+        digest_to: Recipient(s) of digest messages.
+        digest_header: Optional HTML to put before digest entries.
+        digest_footer: Optional HTML to put after digest entries.
+        digest_interval: Optional number of seconds between digests.
+        maxsize: Optional maximum number of queued messages as an integer.
+    """
+    def __init__(self, emailer, digest_subject, digest_to, digest_header='',
+            digest_footer='', digest_interval=300, maxsize=1000):
+        self.emailer = emailer
+        self.digest_subject = digest_subject
+        self.digest_to = digest_to
+        self.digest_header = digest_header
+        self.digest_footer = digest_footer
+        self.digest_interval = digest_interval
+        self.queue = queue.Queue(maxsize)
+        self.digest = []
+        self.lock = threading.Lock()
+        self.thread = threading.Thread(target=self.run, name='maildispatcher',
+                daemon=True)
+        self.thread.start()
+
+    def send(self, subject, message, to, **kwargs):
+        """Queue a message to be sent.
+
+        Args:
+            subject: Subject as a string.
+            message: Message body as a string.
+            to: Recipient(s).
+            **kwargs: Other arguments for the emailer's send_email.
+
+        Returns:
+            True if the message was queued, False if the queue was full.
+        """
+        try:
+            self.queue.put_nowait((subject, message, to, kwargs))
+            return True
+        except queue.Full:
+            logging.warn('Mail queue is full, dropping message to ' + str(to))
+            return False
+
+    def add_to_digest(self, entry):
+        """Add an entry to the next digest message.
+
+        Args:
+            entry: HTML for the entry as a string.
+        """
+        with self.lock:
+            self.digest.append(entry)
+
+    def flush_digest(self):
+        """Queue a digest message with every entry added since the last one,
+        if there are any. This does not accept or return anything.
+        """
+        with self.lock:
+            entries, self.digest = self.digest, []
+        if entries:
+            self.send(self.digest_subject + ' (' + str(len(entries)) + ')',
+                    self.digest_header + ''.join(entries) +
+                    self.digest_footer, self.digest_to, html=True)
+
+    def run(self):
+        """Send queued messages until stop() is called. This runs on the
+        dispatcher's thread.
+        """
+        next_digest = time.monotonic() + self.digest_interval
+        while True:
+            try:
+                item = self.queue.get(
+                        timeout=max(0, next_digest - time.monotonic()))
+                if item is None:
+                    # stop() was called, everything before it is sent first
+                    return
+                subject, message, to, kwargs = item
+                self.emailer.send_email(subject, message, to, **kwargs)
+            except queue.Empty:
+                pass
+            except:
+                traceback.print_exc()
+            if time.monotonic() >= next_digest:
+                next_digest = time.monotonic() + self.digest_interval
+                self.flush_digest()
+
+    def stop(self, timeout=5):
+        """Send the digest and the messages still queued, and stop the
+        dispatcher's thread.
+
+        Args:
+            timeout: Optional number of seconds to wait.
+        """
+        self.flush_digest()
+        try:
+            self.queue.put(None, timeout=timeout)
+        except queue.Full:
+            return
+        self.thread.join(timeout)
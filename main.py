@@ -1,20 +1,166 @@
-import traceback, logging, signal, time, ssl
+import time
+STARTED = time.monotonic() # before the other imports, to time them
+import traceback, logging, signal, ssl, os
 from functools import partial
-from tornado import httpserver, ioloop, log
+from tornado import gen, httpserver, ioloop, log, netutil
 from tornado.web import Application
 
 import settings, isetools, isehandlers, ruckushandlers
 
 PORT = 2443
 
+# startup phase -> seconds it took, reported once the server is ready
+STARTUP = {'imports': time.monotonic() - STARTED}
+
+def number(minimum=0, optional=False):
+    """Get a check for a number setting, see SETTINGS."""
+    return lambda value: ((optional and value is None) or
+            (isinstance(value, (int, float)) and not isinstance(value, bool)
+            and value >= minimum))
+
+def instance(kind, optional=False):
+    """Get a check for a setting of a given type, see SETTINGS."""
+    return lambda value: ((optional and value is None) or
+            isinstance(value, kind))
+
+# setting -> (required, check taking the value, description)
+SETTINGS = {
+    'ISE_SERVERLIST': (True, lambda value: isinstance(value, (list, tuple))
+            and len(value) > 0 and all(isinstance(server, str)
+            for server in value), 'a list of IP/FQDN strings'),
+    'ISE_USERNAME': (True, instance(str), 'a string'),
+    'ISE_PASSWORD': (True, instance(str), 'a string'),
+    'GROUP_ID': (True, instance(str), 'an endpoint group ID string'),
+    'CERTFILE': (True, instance(str), 'the HTTPS certificate .cer filename'),
+    'KEYFILE': (True, instance(str), 'the HTTPS private key .key filename'),
+    'IPSK_ADMINS': (False, instance((list, tuple)),
+            'a list of email addresses'),
+    'ISE_WORKERS': (False, number(1), 'a number, at least 1'),
+    'ISE_IDLE_TIMEOUT': (False, number(1), 'a number of seconds'),
+    'ISE_CACHE_SIZE': (False, number(), 'a number'),
+    'ISE_CACHE_TTL': (False, number(), 'a number of seconds'),
+    'ISE_SYNC_INTERVAL': (False, number(), 'a number of seconds'),
+    'ISE_INDEX_MAX_AGE': (False, number(optional=True),
+            'a number of seconds or None'),
+    'ISE_ROLE_CHECK_INTERVAL': (False, number(), 'a number of seconds'),
+    'ISE_HEALTH_CHECK_INTERVAL': (False, number(), 'a number of seconds'),
+    'ISE_JOURNAL': (False, instance(str, optional=True),
+            'a filename or None'),
+    'ISE_JOURNAL_ATTEMPTS': (False, number(1), 'a number, at least 1'),
+    'ISE_JOURNAL_DAYS': (False, number(optional=True),
+            'a number of days or None'),
+    'ISE_LEDGER': (False, instance(str, optional=True), 'a filename or None'),
+    'ISE_LEDGER_DAYS': (False, number(optional=True),
+            'a number of days or None'),
+    'ISE_VERIFY': (False, instance((bool, str)),
+            'True, False or a CA bundle filename'),
+    'ISE_READ_LIMIT': (False, instance(dict, optional=True),
+            'a dictionary or None'),
+    'ISE_WRITE_LIMIT': (False, instance(dict, optional=True),
+            'a dictionary or None'),
+    'ISE_NODE_LIMITS': (False, instance(dict), 'a dictionary'),
+    'ISE_BACKLOG': (False, number(optional=True), 'a number or None'),
+    'ISE_REQUEST_TIMEOUT': (False, number(optional=True),
+            'a number of seconds or None'),
+    'ISE_HEDGE_READS': (False, instance(bool), 'True or False'),
+    'EMAIL_DIGEST_INTERVAL': (False, number(), 'a number of seconds'),
+    'PROCESSES': (False, number(), 'a number, 0 for one per CPU core'),
+    'SHARED_STATE_FILE': (False, instance(str), 'a filename'),
+    'DRAIN_TIMEOUT': (False, number(), 'a number of seconds'),
+    'DRAIN_GRACE': (False, number(), 'a number of seconds'),
+    'DEBUG': (False, instance(bool), 'True or False'),
+}
+
+def check_settings(settings):
+    """Check every setting in SETTINGS at once, so all mistakes in
+    settings.py are reported together.
+
+    Args:
+        settings: The settings module.
+
+    Raises:
+        ValueError listing every missing or invalid setting.
+    """
+    problems = []
+    for name, (required, check, description) in sorted(SETTINGS.items()):
+        if not hasattr(settings, name):
+            if required:
+                problems.append('missing ' + name + ', should be ' +
+                        description)
+        elif not check(getattr(settings, name)):
+            problems.append(name + ' should be ' + description)
+    if problems:
+        raise ValueError('settings.py has problems:\n    ' +
+                '\n    '.join(problems))
+
 def create_server(serverlist, username, password, emailer=None, certfile=None,
-        keyfile=None):
+        keyfile=None, workers=10, idle_timeout=300, sync_interval=0,
+        role_check_interval=300, health_check_interval=10, journal_file=None,
+        journal_attempts=10, journal_days=30, shared_state=None, verify=True,
+        limits=None, backlog=100, request_timeout=30, hedge_reads=False,
+        ledger_file=None, ledger_days=365, debug=False):
     """Create a Tornado server/app object.
     """
-    isetools_obj = isetools.ISETools(serverlist, username, password, emailer)
-    isehandlers.assign_objects(isetools_obj)
+    if ledger_file:
+        import ledger
+    isetools_obj = isetools.ISETools(serverlist, username, password, emailer,
+            poolsize=workers, idle_timeout=idle_timeout, verify=verify,
+            limits=limits, hedge_reads=hedge_reads,
+            ledger=(ledger.Ledger(ledger_file, retention=(ledger_days * 86400
+                    if ledger_days else None)) if ledger_file else None))
+    if shared_state:
+        # running as one of several processes, keep in step with the others
+        import sharedstate
+        isetools_obj.shared = sharedstate.SharedState(shared_state)
+    if journal_file:
+        import journal
+    async_obj = isetools.AsyncISETools(isetools_obj, workers=workers,
+            journal=(journal.Journal(journal_file,
+                    max_attempts=journal_attempts, retention=(journal_days *
+                    86400 if journal_days else None))
+                    if journal_file else None),
+            health_interval=health_check_interval, backlog=backlog,
+            request_timeout=request_timeout, sync_interval=sync_interval)
+    isehandlers.assign_objects(async_obj)
+
+    # connect to every ISE node and find the PAN ahead of the first request,
+    # before reporting ready
+    ioloop.IOLoop.current().spawn_callback(async_obj.start,
+            discover_pan=bool(role_check_interval))
+
+    # close connections that go unused for too long
+    ioloop.PeriodicCallback(async_obj.evict_idle,
+            idle_timeout * 1000 / 2).start()
+
+    # keep track of which node is the PAN, so writes go straight to it
+    if role_check_interval:
+        ioloop.PeriodicCallback(async_obj.discover_pan,
+                role_check_interval * 1000).start()
+
+    if health_check_interval:
+        # check ISE in the background, so /ise/test never waits on it
+        ioloop.PeriodicCallback(async_obj.check_health,
+                health_check_interval * 1000).start()
+
+    if sync_interval:
+        # mirror the iPSK endpoint group locally for fast lookups; with
+        # several processes, another takes over syncing if this one misses
+        # two syncs
+        sync_index = partial(async_obj.sync_index, lease=3 * sync_interval)
+        ioloop.IOLoop.current().spawn_callback(sync_index)
+        ioloop.PeriodicCallback(sync_index, sync_interval * 1000).start()
+
+    if journal_file:
+        # apply queued registrations, including any left from a restart
+        ioloop.PeriodicCallback(async_obj.apply_journal, 1000).start()
+        # and forget finished ones after a while
+        ioloop.PeriodicCallback(async_obj.purge_journal, 3600 * 1000).start()
+
+    if shared_state:
+        ioloop.PeriodicCallback(async_obj.sync_shared, 1000).start()
+
     handlers = isehandlers.handlers + ruckushandlers.handlers
-    app = Application(handlers, debug=True)
+    app = Application(handlers, debug=debug)
 
     if certfile and keyfile:
         # Enable HTTPS if certificates are available
@@ -25,48 +171,141 @@ def create_server(serverlist, username, password, emailer=None, certfile=None,
         # Otherwise set up for a front-end proxy (like nginx)
         return httpserver.HTTPServer(app, xheaders=True)
 
-def signal_handler(server, sig, frame):
+def signal_handler(server, drain_timeout, grace, sig, frame):
     """Handle shutdown signals (like SIGTERM) to shut off the web server
-    gracefully.
+    gracefully: /ise/ready starts failing at once, but new connections are
+    still accepted for grace seconds so load balancers can stop sending
+    traffic first. Then new connections are refused, and requests and ISE
+    changes in progress get up to drain_timeout seconds to finish. Queued
+    emails and registration records are sent and written before exiting. A
+    second signal stops right away.
     """
     io_loop = ioloop.IOLoop.current()
-    def stop_loop(deadline):
-        if (time.time() < deadline and
-                (io_loop._callbacks or io_loop._timeouts)): #pylint: disable=no-member
-            io_loop.add_timeout(time.time() + 1, stop_loop, deadline)
-        else:
-            io_loop.stop()
+    ise_obj = isehandlers.ise_obj
 
+    @gen.coroutine
     def shutdown():
-        logging.info('Signal received, stopping web server')
+        if ise_obj.draining:
+            logging.info('Signal received again, stopping now')
+            io_loop.stop()
+            return
+        ise_obj.draining = True
+        if grace:
+            logging.info('Signal received, reporting not ready for ' +
+                    str(grace) + ' seconds before stopping')
+            yield gen.sleep(grace)
+        logging.info('Stopping web server')
         server.stop()
-        # wait 2 seconds after receiving SIGINT to complete requests
-        stop_loop(time.time() + 2)
+        if not (yield ise_obj.drain(drain_timeout)):
+            logging.warning('Stopping with ' + str(ise_obj.requests) +
+                    ' requests still in progress after ' +
+                    str(drain_timeout) + ' seconds')
+        if ise_obj.tools.mailer is not None:
+            # send the last failure emails and digest
+            yield ise_obj.run(ise_obj.tools.mailer.stop)
+        if ise_obj.tools.ledger is not None:
+            # write out the last registration records
+            yield ise_obj.run(ise_obj.tools.ledger.stop)
+        io_loop.stop()
 
     io_loop.add_callback_from_signal(shutdown)
 
-if __name__ == "__main__":
-    if not hasattr(settings, 'ISE_SERVERLIST'):
-        raise ValueError("settings.py missing ISE_SERVERLIST (list of IP/FQDN strings)")
-    elif not hasattr(settings, 'ISE_USERNAME'):
-        raise ValueError("settings.py missing ISE_USERNAME (string)")
-    elif not hasattr(settings, 'ISE_PASSWORD'):
-        raise ValueError("settings.py missing ISE_PASSWORD (string)")
-    elif not hasattr(settings, 'CERTFILE'):
-        raise ValueError("settings.py missing CERTFILE (HTTPS certificate .cer filename)")
-    elif not hasattr(settings, 'KEYFILE'):
-        raise ValueError("settings.py missing KEYFILE (HTTPS private key .key filesname)")
+def run_server(sockets, shared_state=None, ready=None):
+    """Create a server from settings.py and run it on already bound sockets
+    until it is stopped.
 
-    log.enable_pretty_logging() # set up Tornado-formatted loggging
-    logging.root.handlers[0].setFormatter(log.LogFormatter())
+    Args:
+        sockets: List of listening sockets.
+        shared_state: Optional SharedState filename, when running as one of
+            several processes.
+        ready: Optional pipe file descriptor to write to (and close) once the
+            server is running and warmed up.
+    """
+    started = time.monotonic()
     server = create_server(settings.ISE_SERVERLIST, settings.ISE_USERNAME,
             settings.ISE_PASSWORD, certfile=settings.CERTFILE,
-            keyfile=settings.KEYFILE)
+            keyfile=settings.KEYFILE,
+            workers=getattr(settings, 'ISE_WORKERS', 10),
+            idle_timeout=getattr(settings, 'ISE_IDLE_TIMEOUT', 300),
+            sync_interval=getattr(settings, 'ISE_SYNC_INTERVAL', 0),
+            role_check_interval=getattr(settings, 'ISE_ROLE_CHECK_INTERVAL',
+                    300),
+            health_check_interval=getattr(settings,
+                    'ISE_HEALTH_CHECK_INTERVAL', 10),
+            journal_file=getattr(settings, 'ISE_JOURNAL', None),
+            journal_attempts=getattr(settings, 'ISE_JOURNAL_ATTEMPTS', 10),
+            journal_days=getattr(settings, 'ISE_JOURNAL_DAYS', 30),
+            shared_state=shared_state,
+            verify=getattr(settings, 'ISE_VERIFY', True),
+            limits=dict(getattr(settings, 'ISE_NODE_LIMITS', {}),
+                    read=getattr(settings, 'ISE_READ_LIMIT', None),
+                    write=getattr(settings, 'ISE_WRITE_LIMIT',
+                            {'concurrency': 4})),
+            backlog=getattr(settings, 'ISE_BACKLOG', 100),
+            request_timeout=getattr(settings, 'ISE_REQUEST_TIMEOUT', 30),
+            hedge_reads=getattr(settings, 'ISE_HEDGE_READS', False),
+            ledger_file=getattr(settings, 'ISE_LEDGER', None),
+            ledger_days=getattr(settings, 'ISE_LEDGER_DAYS', 365),
+            debug=getattr(settings, 'DEBUG', False))
 
-    signal.signal(signal.SIGTERM, partial(signal_handler, server))
-    signal.signal(signal.SIGINT, partial(signal_handler, server))
+    drain_timeout = getattr(settings, 'DRAIN_TIMEOUT', 30)
+    grace = getattr(settings, 'DRAIN_GRACE', 5)
+    signal.signal(signal.SIGTERM, partial(signal_handler, server,
+            drain_timeout, grace))
+    signal.signal(signal.SIGINT, partial(signal_handler, server,
+            drain_timeout, grace))
 
-    logging.info("Starting...")
-    server.listen(PORT)
+    server.add_sockets(sockets)
+
+    @gen.coroutine
+    def report_ready():
+        ise_obj = isehandlers.ise_obj
+        yield ise_obj.ready.wait()
+        # server is everything after the imports and settings check, and
+        # includes the warm-up
+        startup = dict(STARTUP, server=time.monotonic() - started,
+                warmup=ise_obj.warmup)
+        for phase, seconds in startup.items():
+            ise_obj.tools.metrics.set('ipsk_startup_seconds',
+                    {'phase': phase}, seconds)
+        logging.info('Ready in %.2f s (imports %.2f s, settings %.3f s, '
+                'ISE warm-up %.2f s)' % (startup['imports'] +
+                startup.get('settings', 0) + startup['server'],
+                startup['imports'], startup.get('settings', 0),
+                startup['warmup']))
+        if ready is not None:
+            try:
+                os.write(ready, b'1')
+            except OSError:
+                pass # nobody is waiting
+            os.close(ready)
+    ioloop.IOLoop.current().spawn_callback(report_ready)
     ioloop.IOLoop.current().start()
+
+if __name__ == "__main__":
+    checked = time.monotonic()
+    check_settings(settings)
+    STARTUP['settings'] = time.monotonic() - checked
+
+    log.enable_pretty_logging() # set up Tornado-formatted loggging
+    logging.root.handlers[0].setFormatter(log.LogFormatter())
+
+    logging.info("Starting...")
+    sockets = netutil.bind_sockets(PORT)
+    processes = getattr(settings, 'PROCESSES', 1)
+    if processes == 1:
+        run_server(sockets)
+    else:
+        # pre-fork workers sharing the listening sockets and a state file
+        import tempfile
+        from multiprocessing import cpu_count
+        from supervisor import Supervisor
+        processes = processes or cpu_count()
+        shared_state = getattr(settings, 'SHARED_STATE_FILE',
+                os.path.join(tempfile.gettempdir(),
+                'ise_ipsk_state.' + str(os.getpid()) + '.db'))
+        # give workers time to drain before they are killed
+        Supervisor(partial(run_server, sockets, shared_state), processes,
+                stop_timeout=getattr(settings, 'DRAIN_GRACE', 5) +
+                getattr(settings, 'DRAIN_TIMEOUT', 30) + 15).run()
     logging.info("Stopping...")
@@ -0,0 +1,258 @@
+import logging, threading, time
+from contextlib import contextmanager
+
+# upper bounds of histogram buckets, in seconds
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+# metric name -> (type, help text)
+METRICS = {
+    'ise_requests_total': ('counter',
+            'ERS requests by server, operation and status code'),
+    'ise_request_duration_seconds': ('histogram',
+            'ERS request latency by server and operation'),
+    'ise_requests_in_flight': ('gauge', 'ERS requests waiting on a server'),
+    'ise_retries_total': ('counter',
+            'ERS requests retried on another server, by operation and reason'),
+    'ise_failovers_total': ('counter',
+            'Times a server was skipped or left behind, by reason'),
+    'ise_hedged_reads_total': ('counter',
+            'Reads also sent to a second server, by operation and winner'),
+    'ise_rejected_total': ('counter',
+            'ERS requests turned away by admission control'),
+    'ise_requests_waiting': ('gauge',
+            'ERS requests waiting for admission, by server and kind'),
+    'ise_circuit_open': ('gauge', '1 if a server is being skipped, else 0'),
+    'ise_error_rate': ('gauge', 'Recent ERS error rate by server'),
+    'ise_cache_hits_total': ('counter', 'Endpoint cache hits'),
+    'ise_cache_misses_total': ('counter', 'Endpoint cache misses'),
+    'ise_cache_size': ('gauge', 'Endpoints in the endpoint cache'),
+    'ise_export_errors_total': ('counter',
+            'Endpoints exported with an error because their lookup failed'),
+    'ipsk_startup_seconds': ('gauge', 'Time taken by each startup phase'),
+    'ipsk_request_duration_seconds': ('histogram',
+            'Traced API request latency by request'),
+    'ipsk_stage_duration_seconds': ('histogram',
+            'Time spent in each stage of traced API requests'),
+}
+
+def log_trace(name, total, stages):
+    """Default trace hook, logs the stages of a request at debug level.
+
+    Args:
+        name: Request name as a string.
+        total: Total request time in seconds.
+        stages: List of (stage name, seconds) tuples, in order.
+    """
+    logging.debug(name + ' took %.1f ms (' % (total * 1000) + ', '.join(
+            stage + ' %.1f ms' % (seconds * 1000)
+            for stage, seconds in stages) + ')')
+
+class Trace(object):
+    """Times the stages of a single request. Stages are timed with
+    `with trace.stage('lookup'):` and recorded when finish() is called. A
+    trace without a Metrics object records nothing, so code can always be
+    passed one.
+
+    Args:
+        name: Optional request name as a string.
+        metrics: Optional Metrics object to record the trace in.
+    """
+    def __init__(self, name=None, metrics=None):
+        self.name = name
+        self.metrics = metrics
+        self.started = time.monotonic()
+        self.stages = []
+
+    @contextmanager
+    def stage(self, stage):
+        """Time a stage of the request, as a context manager.
+
+        Args:
+            stage: Stage name as a string.
+        """
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.stages.append((stage, time.monotonic() - started))
+
+    def finish(self):
+        """Record the trace. This does not accept or return anything."""
+        if self.metrics is not None:
+            self.metrics.record_trace(self.name,
+                    time.monotonic() - self.started, self.stages)
+
+class Metrics(object):
+    """Counters, gauges and histograms for the metrics in METRICS, exposed in
+    the Prometheus text format. This is safe to use from multiple threads.
+
+    Args:
+        buckets: Optional tuple of histogram bucket upper bounds in seconds.
+    """
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.values = {name: {} for name in METRICS}
+        self.lock = threading.Lock()
+        self.collectors = [] # functions called for point-in-time values
+        self.trace_hooks = [log_trace]
+
+    def inc(self, name, labels=None, amount=1):
+        """Increase a counter, or change a gauge.
+
+        Args:
+            name: Metric name as a string.
+            labels: Optional dictionary of label name -> value.
+            amount: Optional amount to add, may be negative for gauges.
+        """
+        key = self.key(labels)
+        with self.lock:
+            values = self.values[name]
+            values[key] = values.get(key, 0) + amount
+
+    def set(self, name, labels, value):
+        """Set a gauge.
+
+        Args:
+            name: Metric name as a string.
+            labels: Dictionary of label name -> value.
+            value: New value as a number.
+        """
+        key = self.key(labels)
+        with self.lock:
+            self.values[name][key] = value
+
+    def observe(self, name, labels, value):
+        """Add a value to a histogram.
+
+        Args:
+            name: Metric name as a string.
+            labels: Dictionary of label name -> value.
+            value: Observed value in seconds.
+        """
+        key = self.key(labels)
+        with self.lock:
+            histogram = self.values[name].get(key)
+            if histogram is None:
+                # one count per bucket, then the sum and the total count
+                histogram = self.values[name][key] = [0] * len(
+                        self.buckets) + [0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    histogram[i] += 1
+            histogram[-2] += value
+            histogram[-1] += 1
+
+    def key(self, labels):
+        """Get the key values are stored under for a set of labels.
+
+        Args:
+            labels: Dictionary of label name -> value, or None type.
+
+        Returns:
+            Tuple of (label name, value as a string) tuples.
+        """
+        return tuple(sorted((label, str(value))
+                for label, value in (labels or {}).items()))
+
+    def add_collector(self, collector):
+        """Add a function that updates point-in-time metrics (like cache
+        sizes) with set() or inc(). Collectors are called on every render().
+
+        Args:
+            collector: Function taking the Metrics object.
+        """
+        self.collectors.append(collector)
+
+    def add_trace_hook(self, hook):
+        """Add a function that is called with every finished trace.
+
+        Args:
+            hook: Function taking the request name, total time in seconds and
+                a list of (stage name, seconds) tuples, like log_trace.
+        """
+        self.trace_hooks.append(hook)
+
+    def trace(self, name):
+        """Start tracing a request.
+
+        Args:
+            name: Request name as a string.
+
+        Returns:
+            Trace object.
+        """
+        return Trace(name, self)
+
+    def record_trace(self, name, total, stages):
+        """Record a finished trace, and pass it to the trace hooks.
+
+        Args:
+            name: Request name as a string.
+            total: Total request time in seconds.
+            stages: List of (stage name, seconds) tuples, in order.
+        """
+        self.observe('ipsk_request_duration_seconds', {'request': name}, total)
+        for stage, seconds in stages:
+            self.observe('ipsk_stage_duration_seconds', {'request': name,
+                    'stage': stage}, seconds)
+        for hook in self.trace_hooks:
+            try:
+                hook(name, total, stages)
+            except Exception as e:
+                logging.error('Trace hook failed: ' + str(e))
+
+    def render(self):
+        """Get every metric in the Prometheus text exposition format.
+
+        Returns:
+            Metrics as a string.
+        """
+        for collector in self.collectors:
+            collector(self)
+        lines = []
+        with self.lock:
+            for name, (kind, text) in sorted(METRICS.items()):
+                lines.append('# HELP ' + name + ' ' + text)
+                lines.append('# TYPE ' + name + ' ' + kind)
+                for key, value in sorted(self.values[name].items()):
+                    if kind != 'histogram':
+                        lines.append(name + self.labels(key) + ' ' +
+                                self.number(value))
+                        continue
+                    for bound, count in zip(self.buckets + ('+Inf',),
+                            value[:len(self.buckets)] + [value[-1]]):
+                        lines.append(name + '_bucket' + self.labels(key +
+                                (('le', bound),)) + ' ' + self.number(count))
+                    lines.append(name + '_sum' + self.labels(key) + ' ' +
+                            self.number(value[-2]))
+                    lines.append(name + '_count' + self.labels(key) + ' ' +
+                            self.number(value[-1]))
+        return '\n'.join(lines) + '\n'
+
+    def labels(self, key):
+        """Format labels for the text format.
+
+        Args:
+            key: Tuple of (label name, value) tuples.
+
+        Returns:
+            Labels as a string, empty if there are none.
+        """
+        if not key:
+            return ''
+        return '{' + ','.join(label + '="' + str(value).replace('\\', '\\\\'
+                ).replace('"', '\\"').replace('\n', '\\n') + '"'
+                for label, value in key) + '}'
+
+    def number(self, value):
+        """Format a number for the text format.
+
+        Args:
+            value: Integer or float.
+
+        Returns:
+            Number as a string.
+        """
+        if isinstance(value, float):
+            return repr(value)
+        return str(value)
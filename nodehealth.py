@@ -0,0 +1,214 @@
+import math, threading, time
+from collections import deque
+
+class NodeHealth(object):
+    """Rolling health of a single ISE node, with a circuit breaker. After
+    repeated failures the circuit opens and the node is skipped. Once the
+    backoff has passed, the next request sent is a trial (half-open) and
+    others wait for it; if it succeeds the circuit closes again, otherwise
+    the backoff doubles. A trial that never reports back is given up on after
+    trial_timeout, so another can be sent. This is safe to use from multiple
+    threads.
+
+    Args:
+        window: Optional number of recent requests to track as an integer.
+        threshold: Optional error rate (0 to 1) over the window that opens
+            the circuit.
+        consecutive: Optional number of failures in a row that opens the
+            circuit.
+        backoff: Optional initial number of seconds to keep the circuit open.
+        max_backoff: Optional maximum number of seconds to keep it open.
+        trial_timeout: Optional number of seconds to wait for a trial
+            request before letting another through.
+    """
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, window=20, threshold=0.5, consecutive=3, backoff=5,
+            max_backoff=300, trial_timeout=60):
+        self.window = window
+        self.threshold = threshold
+        self.consecutive = consecutive
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.trial_timeout = trial_timeout
+        self.results = deque(maxlen=window) # True for success
+        self.latency = None # moving average, in seconds
+        self.failures = 0 # failures in a row
+        self.opened = 0 # times opened in a row, for backoff
+        self.state = self.CLOSED
+        self.retry_at = 0
+        self.trial_at = 0 # when the half-open trial request was sent
+        self.inflight = 0
+        self.lock = threading.Lock()
+
+    def available(self):
+        """Check whether a request may be sent to this node. This doesn't
+        claim anything; the trial request of an open circuit is only claimed
+        by begin(), once it is actually being sent.
+
+        Returns:
+            True if the node can be used, False otherwise.
+        """
+        with self.lock:
+            now = time.monotonic()
+            if (self.state == self.HALF_OPEN and
+                    now >= self.trial_at + self.trial_timeout):
+                # the trial never reported back, so allow another
+                self.state = self.OPEN
+            if self.state == self.CLOSED:
+                return True
+            return self.state == self.OPEN and now >= self.retry_at
+
+    def begin(self):
+        """Note the start of a request to this node. If the circuit is open
+        and its backoff has passed, this request is the trial.
+        """
+        with self.lock:
+            self.inflight += 1
+            now = time.monotonic()
+            if self.state == self.OPEN and now >= self.retry_at:
+                self.state = self.HALF_OPEN
+                self.trial_at = now
+
+    def abort(self):
+        """Note the end of a request to this node that didn't get an answer
+        for reasons that are not the node's fault, so it doesn't count
+        either way. If it was the trial, another can be sent.
+        """
+        with self.lock:
+            self.inflight -= 1
+            if self.state == self.HALF_OPEN:
+                self.state = self.OPEN
+
+    def record(self, ok, elapsed):
+        """Note the end of a request to this node.
+
+        Args:
+            ok: True if the node answered properly, False otherwise.
+            elapsed: Request time in seconds.
+
+        Returns:
+            True if this opened the circuit, False otherwise.
+        """
+        with self.lock:
+            self.inflight -= 1
+            self.results.append(ok)
+            if ok:
+                self.latency = (elapsed if self.latency is None else
+                        0.8 * self.latency + 0.2 * elapsed)
+                self.failures = 0
+                self.opened = 0
+                self.state = self.CLOSED
+                return False
+
+            self.failures += 1
+            if (self.state == self.HALF_OPEN or
+                    self.failures >= self.consecutive or
+                    (len(self.results) >= self.window // 4 and
+                    self.error_rate() >= self.threshold)):
+                self.opened += 1
+                self.state = self.OPEN
+                self.retry_at = time.monotonic() + min(self.max_backoff,
+                        self.backoff * 2 ** (self.opened - 1))
+                self.results.clear()
+                return True
+            return False
+
+    def open_until(self, until):
+        """Open the circuit until a given time, if it isn't already open for
+        longer. This is used to share open circuits between processes.
+
+        Args:
+            until: Time to retry the node as a Unix timestamp.
+        """
+        with self.lock:
+            retry_at = time.monotonic() + (until - time.time())
+            if retry_at > time.monotonic() and (self.state == self.CLOSED or
+                    retry_at > self.retry_at):
+                self.state = self.OPEN
+                self.retry_at = retry_at
+
+    def retry_time(self):
+        """Get when an open circuit will next let a request through.
+
+        Returns:
+            Unix timestamp as a float.
+        """
+        with self.lock:
+            return time.time() + (self.retry_at - time.monotonic())
+
+    def error_rate(self):
+        """Get the share of recent requests that failed.
+
+        Returns:
+            Error rate from 0 to 1 as a float.
+        """
+        if not self.results:
+            return 0.0
+        return self.results.count(False) / len(self.results)
+
+    def score(self):
+        """Get a score for picking between nodes, lower is better. This is
+        the average latency weighted by the number of requests in flight, so
+        load still spreads across similar nodes.
+
+        Returns:
+            Score as a float.
+        """
+        return (self.latency or 0.0) * (self.inflight + 1)
+
+    def status(self):
+        """Get a summary of the node's health.
+
+        Returns:
+            Dictionary with 'state', 'latency_ms', 'error_rate' and 'inflight'
+            keys.
+        """
+        with self.lock:
+            return {'state': self.state,
+                    'latency_ms': (None if self.latency is None else
+                            round(self.latency * 1000, 1)),
+                    'error_rate': round(self.error_rate(), 3),
+                    'inflight': self.inflight}
+
+class LatencyWindow(object):
+    """Recent request times for one kind of request to a node, to estimate
+    percentiles from. This is safe to use from multiple threads.
+
+    Args:
+        size: Optional number of recent request times to keep as an integer.
+    """
+    def __init__(self, size=100):
+        self.times = deque(maxlen=size)
+        self.lock = threading.Lock()
+
+    def add(self, elapsed):
+        """Note the time a request took.
+
+        Args:
+            elapsed: Request time in seconds.
+        """
+        with self.lock:
+            self.times.append(elapsed)
+
+    def percentile(self, percent, minimum=20):
+        """Get a percentile of the recent request times, by the nearest-rank
+        method.
+
+        Args:
+            percent: Percentile to get as a number from 0 to 100.
+            minimum: Optional number of request times needed for a useful
+                estimate.
+
+        Returns:
+            The percentile in seconds as a float, or None type if there are
+            fewer than minimum request times.
+        """
+        with self.lock:
+            times = sorted(self.times)
+        if not times or len(times) < minimum:
+            return None
+        rank = int(math.ceil(percent / 100.0 * len(times)))
+        return times[min(max(rank, 1), len(times)) - 1]
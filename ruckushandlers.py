@@ -1,13 +1,126 @@
 # These handlers are used for Cloudpath - they implement the basics of a Ruckus
 # Wireless Controller so DPSKs/IPSKs can be generated for Cloudpath.
 #
-import json, traceback, random, string, asyncio
+import traceback, csv, secrets
 from datetime import datetime
 from tornado import web
 
 zone_uuid = 'uuidzone1'
 wlan_uuid = 'uuidwlan1'
 
+# passphrases are all lowercase and exclude vowels to avoid generating bad
+# words
+PASSPHRASE_CHARS = 'bcdfghjklmnpqrstvwxyz'
+PASSPHRASE_LENGTH = 12
+MAX_COUNT = 1000 # most passphrases /ise/psk/generate makes at once
+
+def generate_passphrases(count, length=PASSPHRASE_LENGTH,
+        alphabet=PASSPHRASE_CHARS):
+    """Generate random passphrases with the operating system's CSPRNG. The
+    random bytes for the whole batch are drawn at once and mapped onto the
+    alphabet, skipping bytes that would make some characters more likely
+    than others.
+
+    Args:
+        count: Number of passphrases as an integer.
+        length: Optional number of characters in each passphrase.
+        alphabet: Optional characters to use as a string (at most 256).
+
+    Returns:
+        List of passphrases as strings.
+    """
+    limit = 256 - 256 % len(alphabet)
+    table = bytes(ord(alphabet[byte % len(alphabet)]) if byte < limit else 0
+            for byte in range(256))
+    rejected = bytes(range(limit, 256))
+    needed = count * length
+    chars = b''
+    while len(chars) < needed:
+        # ask for a little extra, so one draw is almost always enough
+        missing = needed - len(chars)
+        chars += secrets.token_bytes(missing * 256 // limit + 16).translate(
+                table, rejected)
+    text = chars[:needed].decode('ascii')
+    return [text[i:i+length] for i in range(0, needed, length)]
+
+class CSVUpload(object):
+    """Parses an uploaded CSV file into rows as the request body arrives,
+    so large uploads are never buffered whole. The body can be
+    multipart/form-data (the first file in it is used) or plain CSV.
+
+    Args:
+        boundary: Optional multipart boundary as bytes, None type for a plain
+            CSV body.
+    """
+    def __init__(self, boundary=None):
+        self.rows = []
+        if boundary is None:
+            self.delimiter = None
+            self.state = 'file'
+            self.buffer = b''
+        else:
+            self.delimiter = b'\r\n--' + boundary
+            self.state = 'parts' # looking for the part with the file
+            # the first boundary has no line break in front of it
+            self.buffer = b'\r\n'
+
+    def feed(self, chunk):
+        """Parse the next part of the request body.
+
+        Args:
+            chunk: Body data as bytes.
+        """
+        self.buffer += chunk
+        while self.state == 'parts':
+            start = self.buffer.find(self.delimiter)
+            if start < 0:
+                # keep enough to find a boundary split across chunks
+                self.buffer = self.buffer[-len(self.delimiter):]
+                return
+            end = self.buffer.find(b'\r\n\r\n', start)
+            if end < 0:
+                return
+            headers = self.buffer[start:end]
+            self.buffer = self.buffer[end + 4:]
+            if b'filename=' in headers:
+                self.state = 'file'
+
+        if self.state == 'file':
+            end = (-1 if self.delimiter is None else
+                    self.buffer.find(self.delimiter))
+            if end >= 0:
+                self.add_lines(self.buffer[:end])
+                self.buffer = b''
+                self.state = 'done'
+                return
+            # leave lines that may be the start of the next boundary
+            cut = self.buffer.rfind(b'\n', 0, len(self.buffer) -
+                    len(self.delimiter or b'') + 2)
+            if cut >= 0:
+                self.add_lines(self.buffer[:cut])
+                self.buffer = self.buffer[cut + 1:]
+
+    def finish(self):
+        """Parse whatever is left once the whole body has arrived.
+
+        Returns:
+            List of rows, each a list of strings.
+        """
+        if self.state == 'file':
+            self.add_lines(self.buffer)
+        self.buffer = b''
+        self.state = 'done'
+        return self.rows
+
+    def add_lines(self, data):
+        """Parse complete CSV lines.
+
+        Args:
+            data: Lines as bytes, without a trailing line break.
+        """
+        self.rows.extend(csv.reader(line.rstrip(b'\r').decode('utf-8',
+                'replace') for line in data.split(b'\n')))
+
 class RuckusSession(web.RequestHandler):
     async def get(self):
         self.write({'apiVersions': "1_0", 'clientIp': self.request.remote_ip})
@@ -31,30 +144,46 @@ class RuckusWLANs(web.RequestHandler):
                 'name': 'ULink', 'ssid': 'ULink'}] })
         self.finish()
 
+@web.stream_request_body
 class RuckusDPSK(web.RequestHandler):
+    def prepare(self):
+        boundary = None
+        content_type = self.request.headers.get('Content-Type', '')
+        if content_type.startswith('multipart/form-data'):
+            for field in content_type.split(';')[1:]:
+                name, _, value = field.strip().partition('=')
+                if name == 'boundary':
+                    boundary = value.strip('"').encode('utf-8')
+        self.upload = CSVUpload(boundary)
+
+    def data_received(self, chunk):
+        self.upload.feed(chunk)
+
     async def post(self):
         try:
-            if self.request.files.keys():
-                filename = list(self.request.files.keys())[0]
-                fileinfo = self.request.files[filename][0]
+            # one DPSK per user name in the first column, skipping blank rows
+            # and the header row of Ruckus' CSV template
+            usernames = [row[0].strip() for row in self.upload.finish()
+                    if row and row[0].strip()]
+            if usernames and usernames[0].lower() in ('user name', 'username'):
+                usernames.pop(0)
+            if not usernames:
+                self.set_status(400)
+                self.write({})
+                return
+            created = str(datetime.now().strftime('%Y/%m/%d %H:%M:%S'))
             self.set_status(201)
-            # password: all lowercase, 12 character randomly generated
-            # also exclude vowels to avoid generating bad words
-            passphrase = ''.join([random.choice('bcdfghjklmnpqrstvwxyz')
-                    for _ in range(12)])
-            self.write({'resultCount': 1, 'dpskInfoList': [ {
-                    'id': "dpskid",
+            self.write({'resultCount': len(usernames), 'dpskInfoList': [{
+                    'id': "dpskid" + (str(i + 1) if i else ''),
                     'wlanId': str(wlan_uuid),
-                    'userName': str(fileinfo.get('body')).split(',')[0],
+                    'userName': username,
                     'macAddress': None,
-                    # password: all lowercase, 16 character randomly generated
-                    # also exclude vowels to avoid generating bad words
-                    'passphrase': str(passphrase),
+                    'passphrase': passphrase,
                     'vlanId': None,
-                    "creationDateTime" : str(datetime.now().strftime(
-                            '%Y/%m/%d %H:%M:%S')),
+                    "creationDateTime" : created,
                     "expirationDateTime" : "Not start using"
-                    }]})
+                    } for i, (username, passphrase) in enumerate(zip(
+                    usernames, generate_passphrases(len(usernames))))]})
         except:
             traceback.print_exc()
             self.set_status(500)
@@ -65,11 +194,20 @@ class RuckusDPSK(web.RequestHandler):
 class RegularDPSK(web.RequestHandler):
     async def get(self):
         try:
-            # password: all lowercase, 12 character randomly generated
-            # also exclude vowels to avoid generating bad words
-            passphrase = ''.join([random.choice('bcdfghjklmnpqrstvwxyz')
-                    for _ in range(12)])
-            self.write({'result': str(passphrase)})
+            count = self.get_argument('count', None)
+            if count is None:
+                self.write({'result': generate_passphrases(1)[0]})
+                return
+            try:
+                count = int(count)
+            except ValueError:
+                count = 0
+            if not 1 <= count <= MAX_COUNT:
+                self.set_status(400)
+                self.write({'error': "count must be a number from 1 to " +
+                        str(MAX_COUNT)})
+                return
+            self.write({'result': generate_passphrases(count)})
         except Exception as e:
             self.set_status(500)
             self.write({'error': str(e)})
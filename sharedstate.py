@@ -0,0 +1,164 @@
+import json, os, sqlite3, threading, time
+
+from journal import pid_exists
+
+class SharedState(object):
+    """State shared between worker processes through a local SQLite file.
+    Workers publish endpoint changes (so other workers can update their
+    caches) and small key/value state like the current PAN, then pick up
+    each other's changes by polling. Work only one worker should do, like
+    syncing the endpoint index, goes to whichever holds its lease. This is
+    safe to use from multiple threads.
+
+    Args:
+        filename: SQLite database filename as a string.
+        keep: Optional number of seconds to keep published endpoint changes.
+    """
+    def __init__(self, filename, keep=60):
+        self.keep = keep
+        self.pid = os.getpid()
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(filename, timeout=5, check_same_thread=False,
+                isolation_level=None)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=OFF') # nothing here outlives a run
+        self.db.execute('''CREATE TABLE IF NOT EXISTS state (
+                key TEXT PRIMARY KEY,
+                value TEXT NOT NULL)''')
+        self.db.execute('''CREATE TABLE IF NOT EXISTS events (
+                seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                pid INTEGER NOT NULL,
+                time REAL NOT NULL,
+                mac TEXT NOT NULL,
+                endpoint TEXT)''')
+        self.db.execute('''CREATE TABLE IF NOT EXISTS leases (
+                name TEXT PRIMARY KEY,
+                pid INTEGER NOT NULL,
+                expires REAL NOT NULL)''')
+        self.db.execute('''CREATE TABLE IF NOT EXISTS endpoints (
+                mac TEXT PRIMARY KEY,
+                endpoint TEXT NOT NULL,
+                updated REAL NOT NULL)''')
+        # a new worker starts with an empty cache, so older changes don't
+        # matter to it
+        self.last_seq = self.db.execute('SELECT COALESCE(MAX(seq), 0) '
+                'FROM events').fetchone()[0]
+
+    def set(self, key, value):
+        """Set a shared value.
+
+        Args:
+            key: Key as a string.
+            value: Any JSON-serializable value.
+        """
+        with self.lock:
+            self.db.execute('INSERT OR REPLACE INTO state (key, value) '
+                    'VALUES (?, ?)', (key, json.dumps(value)))
+
+    def get_all(self):
+        """Get every shared value.
+
+        Returns:
+            Dictionary of key -> value.
+        """
+        with self.lock:
+            rows = self.db.execute('SELECT key, value FROM state').fetchall()
+        return {key: json.loads(value) for key, value in rows}
+
+    def publish(self, mac, endpoint):
+        """Tell other workers about a changed endpoint.
+
+        Args:
+            mac: MAC address as a string.
+            endpoint: Dictionary of endpoint details, or None type if the
+                endpoint should be forgotten.
+        """
+        with self.lock:
+            self.db.execute('INSERT INTO events (pid, time, mac, endpoint) '
+                    'VALUES (?, ?, ?, ?)', (self.pid, time.time(), mac,
+                    json.dumps(endpoint) if endpoint is not None else None))
+
+    def poll(self):
+        """Get the endpoint changes other workers published since the last
+        poll, and clean up old ones.
+
+        Returns:
+            List of (MAC address, endpoint details or None type) tuples, oldest
+            first.
+        """
+        with self.lock:
+            rows = self.db.execute('SELECT seq, pid, mac, endpoint FROM events '
+                    'WHERE seq>? ORDER BY seq', (self.last_seq,)).fetchall()
+            if rows:
+                self.last_seq = rows[-1][0]
+            self.db.execute('DELETE FROM events WHERE time<?',
+                    (time.time() - self.keep,))
+        return [(mac, json.loads(endpoint) if endpoint is not None else None)
+                for seq, pid, mac, endpoint in rows if pid != self.pid]
+
+    def lease(self, name, seconds):
+        """Take or renew a lease, so that only one worker at a time does a
+        job. A lease is free once it expires or its worker has exited.
+
+        Args:
+            name: Lease name as a string.
+            seconds: Number of seconds the lease lasts unless renewed.
+
+        Returns:
+            True if this worker holds the lease, False otherwise.
+        """
+        now = time.time()
+        with self.lock:
+            self.db.execute('BEGIN IMMEDIATE')
+            try:
+                row = self.db.execute('SELECT pid, expires FROM leases '
+                        'WHERE name=?', (name,)).fetchone()
+                held = (row is None or row[0] == self.pid or row[1] < now or
+                        not pid_exists(row[0]))
+                if held:
+                    self.db.execute('INSERT OR REPLACE INTO leases (name, '
+                            'pid, expires) VALUES (?, ?, ?)', (name, self.pid,
+                            now + seconds))
+                self.db.execute('COMMIT')
+            except:
+                self.db.execute('ROLLBACK')
+                raise
+        return held
+
+    def save_index(self, endpoints, updated, started, synced):
+        """Replace the shared copy of the endpoint index.
+
+        Args:
+            endpoints: Dictionary of MAC address -> endpoint details.
+            updated: Dictionary of MAC address -> time last added or replaced.
+            started: Time the sync started.
+            synced: Time the sync finished.
+        """
+        with self.lock:
+            self.db.execute('BEGIN IMMEDIATE')
+            try:
+                self.db.execute('DELETE FROM endpoints')
+                self.db.executemany('INSERT INTO endpoints (mac, endpoint, '
+                        'updated) VALUES (?, ?, ?)', [(mac,
+                        json.dumps(endpoint), updated[mac])
+                        for mac, endpoint in endpoints.items()])
+                self.db.execute('INSERT OR REPLACE INTO state (key, value) '
+                        'VALUES (?, ?)', ('index', json.dumps(
+                        {'started': started, 'synced': synced})))
+                self.db.execute('COMMIT')
+            except:
+                self.db.execute('ROLLBACK')
+                raise
+
+    def load_index(self):
+        """Get the shared copy of the endpoint index.
+
+        Returns:
+            endpoints: Dictionary of MAC address -> endpoint details.
+            updated: Dictionary of MAC address -> time last added or replaced.
+        """
+        with self.lock:
+            rows = self.db.execute('SELECT mac, endpoint, updated '
+                    'FROM endpoints').fetchall()
+        return ({mac: json.loads(endpoint) for mac, endpoint, updated in rows},
+                {mac: updated for mac, endpoint, updated in rows})
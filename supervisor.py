@@ -0,0 +1,165 @@
+import errno, logging, os, select, signal, time, traceback
+
+class Supervisor(object):
+    """Pre-forks worker processes, restarts any that exit unexpectedly, and
+    replaces them one at a time (a rolling restart) on SIGHUP. SIGTERM and
+    SIGINT are passed on to the workers, which are expected to shut down
+    gracefully.
+
+    Args:
+        target: Function to run in each worker. It is passed a pipe file
+            descriptor to write to (and close) once the worker is ready to
+            serve requests, and should return when the worker shuts down.
+        count: Number of worker processes as an integer.
+        ready_timeout: Optional number of seconds to wait for a new worker to
+            become ready during a rolling restart.
+        stop_timeout: Optional number of seconds to wait for a worker to shut
+            down before it is killed.
+    """
+    def __init__(self, target, count, ready_timeout=30, stop_timeout=30):
+        self.target = target
+        self.count = count
+        self.ready_timeout = ready_timeout
+        self.stop_timeout = stop_timeout
+        self.children = set()
+        self.stopping = False
+        self.restarting = False
+
+    def spawn(self):
+        """Start a worker process.
+
+        Returns:
+            pid: Process ID of the worker as an integer.
+            ready: Pipe file descriptor that becomes readable once the worker
+                is ready.
+        """
+        ready, notify = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            os.close(ready)
+            signal.signal(signal.SIGHUP, signal.SIG_IGN)
+            code = 0
+            try:
+                self.target(notify)
+            except:
+                traceback.print_exc()
+                code = 1
+            os._exit(code)
+        os.close(notify)
+        self.children.add(pid)
+        logging.info('Started worker ' + str(pid))
+        return pid, ready
+
+    def wait_ready(self, ready):
+        """Wait for a worker to become ready.
+
+        Args:
+            ready: Pipe file descriptor from spawn().
+
+        Returns:
+            True if the worker became ready, False if it timed out or exited.
+        """
+        try:
+            readable = select.select([ready], [], [], self.ready_timeout)[0]
+            return bool(readable) and os.read(ready, 1) == b'1'
+        finally:
+            os.close(ready)
+
+    def stop_child(self, pid):
+        """Ask a worker to shut down, and wait for it to exit. Workers that
+        are still running after stop_timeout seconds are killed.
+
+        Args:
+            pid: Process ID of the worker as an integer.
+        """
+        self.stop_children([pid])
+
+    def stop_children(self, pids):
+        """Ask workers to shut down, and wait for them all to exit. They shut
+        down at the same time, so this takes as long as the slowest one.
+        Workers that are still running after stop_timeout seconds are killed.
+
+        Args:
+            pids: List of worker process IDs as integers.
+        """
+        running = set()
+        for pid in pids:
+            self.children.discard(pid)
+            try:
+                os.kill(pid, signal.SIGTERM)
+                running.add(pid)
+            except OSError as e:
+                if e.errno != errno.ESRCH:
+                    raise
+        deadline = time.time() + self.stop_timeout
+        while running:
+            for pid in list(running):
+                try:
+                    if os.waitpid(pid, os.WNOHANG)[0] != 0:
+                        running.discard(pid)
+                except OSError as e:
+                    if e.errno != errno.ECHILD:
+                        raise
+                    running.discard(pid)
+            if running and time.time() >= deadline:
+                for pid in running:
+                    logging.warn('Worker ' + str(pid) + ' did not shut ' +
+                            'down, killing it')
+                    try:
+                        os.kill(pid, signal.SIGKILL)
+                        os.waitpid(pid, 0)
+                    except OSError as e:
+                        if e.errno not in (errno.ESRCH, errno.ECHILD):
+                            raise
+                break
+            if running:
+                time.sleep(0.1)
+
+    def rolling_restart(self):
+        """Replace every worker, one at a time. Each new worker is started
+        and ready before the old one is stopped, so capacity never drops.
+        """
+        logging.info('Rolling restart of ' + str(len(self.children)) +
+                ' workers')
+        for pid in list(self.children):
+            if self.stopping:
+                return
+            newpid, ready = self.spawn()
+            if not self.wait_ready(ready):
+                logging.error('Worker ' + str(newpid) + ' did not become ' +
+                        'ready, stopping rolling restart')
+                return
+            self.stop_child(pid)
+
+    def run(self):
+        """Start the workers and look after them until SIGTERM/SIGINT."""
+        def stop(sig, frame):
+            self.stopping = True
+        def restart(sig, frame):
+            self.restarting = True
+        signal.signal(signal.SIGTERM, stop)
+        signal.signal(signal.SIGINT, stop)
+        signal.signal(signal.SIGHUP, restart)
+
+        for _ in range(self.count):
+            os.close(self.spawn()[1])
+
+        while self.children:
+            if self.stopping:
+                self.stop_children(list(self.children))
+                break
+            if self.restarting:
+                self.restarting = False
+                self.rolling_restart()
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                break
+            if pid == 0:
+                time.sleep(0.5)
+            elif pid in self.children:
+                # exited without being asked to, start a replacement
+                self.children.discard(pid)
+                logging.warn('Worker ' + str(pid) + ' exited with status ' +
+                        str(status) + ', restarting')
+                os.close(self.spawn()[1])
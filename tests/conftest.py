@@ -0,0 +1,17 @@
+"""Shared setup for the unit tests.
+
+Run from the project folder, on the interpreter and tornado version the
+Dockerfile and requirements.txt deploy:
+    python -m pytest tests
+"""
+import os, sys, types
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+try:
+    import settings
+except ImportError:
+    # tests don't talk to a real ISE, so placeholder settings are enough
+    settings = sys.modules['settings'] = types.ModuleType('settings')
+    settings.GROUP_ID = '6c2b5f70-8c00-11e6-996c-525400b48521'
+    settings.IPSK_ADMINS = []
+    settings.EMAIL_FROM = 'ipsk@example.com'
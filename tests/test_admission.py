@@ -0,0 +1,108 @@
+import threading, time, unittest
+
+from admission import Limiter, Overloaded
+import isetools
+
+class LimiterTest(unittest.TestCase):
+    def test_concurrency(self):
+        limiter = Limiter(concurrency=2, timeout=0.05)
+        limiter.acquire()
+        limiter.acquire()
+        self.assertEqual(limiter.status(), {'active': 2, 'waiting': 0})
+        with self.assertRaises(Overloaded) as caught:
+            limiter.acquire()
+        self.assertEqual(caught.exception.status, 503)
+        limiter.release()
+        limiter.acquire()
+        self.assertEqual(limiter.status(), {'active': 2, 'waiting': 0})
+
+    def test_waits_for_release(self):
+        limiter = Limiter(concurrency=1, timeout=5)
+        limiter.acquire()
+        threading.Timer(0.05, limiter.release).start()
+        started = time.monotonic()
+        limiter.acquire()
+        self.assertGreaterEqual(time.monotonic() - started, 0.04)
+
+    def test_rate(self):
+        limiter = Limiter(rate=2, burst=2, timeout=0.05)
+        limiter.acquire()
+        limiter.acquire()
+        with self.assertRaises(Overloaded) as caught:
+            limiter.acquire()
+        self.assertEqual(caught.exception.status, 429)
+        self.assertGreaterEqual(caught.exception.retry_after, 1)
+        # a token comes back every half second
+        limiter.acquire(timeout=1)
+
+    def test_queue_full(self):
+        limiter = Limiter(concurrency=1, queue=1, timeout=5)
+        limiter.acquire()
+        waiter = threading.Thread(target=limiter.acquire)
+        waiter.start()
+        while limiter.status()['waiting'] < 1:
+            time.sleep(0.01)
+        started = time.monotonic()
+        with self.assertRaises(Overloaded) as caught:
+            limiter.acquire()
+        self.assertEqual(caught.exception.status, 503)
+        # turned away right away, not after the timeout
+        self.assertLess(time.monotonic() - started, 1)
+        limiter.release()
+        waiter.join(1)
+        self.assertFalse(waiter.is_alive())
+        self.assertEqual(limiter.status(), {'active': 1, 'waiting': 0})
+
+    def test_first_come_first_served(self):
+        limiter = Limiter(concurrency=1, timeout=5)
+        limiter.acquire()
+        order = []
+        def wait(name):
+            limiter.acquire()
+            order.append(name)
+            limiter.release()
+        waiters = []
+        for name in range(3):
+            waiters.append(threading.Thread(target=wait, args=(name,)))
+            waiters[-1].start()
+            while limiter.status()['waiting'] < name + 1:
+                time.sleep(0.01)
+        limiter.release()
+        for waiter in waiters:
+            waiter.join(1)
+        self.assertEqual(order, [0, 1, 2])
+
+class FakeResponse(object):
+    status_code = 200
+
+class FakeSession(object):
+    def request(self, method, url, **kwargs):
+        return FakeResponse()
+
+class SendTest(unittest.TestCase):
+    def make_tools(self):
+        tools = isetools.ISETools(['ise1', 'ise2'], 'user', 'pass', None,
+                limits={'write': {'rate': 1, 'timeout': 0},
+                'ise2': {'write': {'rate': 2}}})
+        tools.session = lambda server=None: FakeSession()
+        return tools
+
+    def test_limits_for(self):
+        tools = self.make_tools()
+        self.assertEqual(tools.limiters[('ise1', 'write')].rate, 1)
+        self.assertEqual(tools.limiters[('ise2', 'write')].rate, 2)
+        self.assertEqual(tools.limiters[('ise2', 'write')].timeout, 0)
+        self.assertIsNone(tools.limiters[('ise1', 'read')].rate)
+
+    def test_turned_away(self):
+        tools = self.make_tools()
+        tools.send('ise1', 'PUT', 'endpoint/id1')
+        with self.assertRaises(Overloaded) as caught:
+            tools.send('ise1', 'PUT', 'endpoint/id1')
+        self.assertEqual(caught.exception.status, 429)
+        self.assertEqual(list(tools.metrics.values['ise_rejected_total']
+                .values()), [1])
+        # housekeeping skips the limiter
+        tools.send('ise1', 'PUT', 'endpoint/id1', limit=False)
+        # reads have their own limiter
+        tools.send('ise1', 'GET', 'endpoint/name/x')
@@ -0,0 +1,197 @@
+import threading
+
+from tornado.testing import AsyncTestCase, gen_test
+
+import isetools
+
+class LookupTools(isetools.ISETools):
+    """ISETools with get_endpointid answering from a dictionary, once
+    release is set, and counting calls.
+    """
+    def __init__(self, endpoints):
+        isetools.ISETools.__init__(self, ['ise1'], 'user', 'pass', None)
+        self.endpoints = endpoints
+        self.calls = []
+        self.release = threading.Event()
+
+    def get_endpointid(self, mac, deadline=None):
+        self.calls.append(mac)
+        self.release.wait(5)
+        cached = self.cache.get(mac)
+        if cached:
+            return cached['id'], '200'
+        if mac in self.endpoints:
+            self.cache.put(mac, {'id': self.endpoints[mac]})
+            return self.endpoints[mac], '200'
+
+class GetEndpointIdTest(AsyncTestCase):
+    def setUp(self):
+        AsyncTestCase.setUp(self)
+        self.tools = LookupTools({'74:31:7D:60:9C:9B': 'id1'})
+        self.async_tools = isetools.AsyncISETools(self.tools, workers=4)
+
+    @gen_test
+    def test_spellings_share_a_lookup(self):
+        first = self.async_tools.get_endpointid('7431.7d60.9c9b')
+        second = self.async_tools.get_endpointid('74-31-7d-60-9c-9b')
+        self.tools.release.set()
+        results = yield [first, second]
+        self.assertEqual(results, [('id1', '200'), ('id1', '200')])
+        self.assertEqual(self.tools.calls, ['74:31:7D:60:9C:9B'])
+
+    @gen_test
+    def test_fresh_invalidates_any_spelling(self):
+        self.tools.release.set()
+        self.tools.cache.put('74:31:7D:60:9C:9B', {'id': 'stale'})
+        result = yield self.async_tools.get_endpointid('7431.7d60.9c9b')
+        self.assertEqual(result, ('stale', '200'))
+        result = yield self.async_tools.get_endpointid('7431.7d60.9c9b',
+                fresh=True)
+        self.assertEqual(result, ('id1', '200'))
+
+    @gen_test
+    def test_index(self):
+        self.tools.index.update('74:31:7D:60:9C:9B', {'id': 'indexed'})
+        self.tools.index.synced = 0
+        result = yield self.async_tools.get_endpointid('7431.7d60.9c9b')
+        self.assertEqual(result, ('indexed', '200'))
+        self.assertEqual(self.tools.calls, [])
+
+    @gen_test
+    def test_invalid(self):
+        with self.assertRaises(SyntaxError):
+            yield self.async_tools.get_endpointid('7431.7d60')
+
+class FakeLedger(object):
+    def __init__(self):
+        self.records = []
+
+    def record(self, mac, unid, outcome, **kwargs):
+        self.records.append((mac, unid, outcome))
+
+class WriteTools(isetools.ISETools):
+    """ISETools with set_psk answering 200 once release is set, and
+    recording the writes made.
+    """
+    def __init__(self):
+        isetools.ISETools.__init__(self, ['ise1'], 'user', 'pass', None,
+                ledger=FakeLedger())
+        self.writes = []
+        self.release = threading.Event()
+
+    def set_psk(self, mac, psk, unid, trace=None, deadline=None):
+        self.release.wait(5)
+        self.writes.append((mac, psk, unid))
+        return '200'
+
+class SetPskTest(AsyncTestCase):
+    @gen_test
+    def test_superseded(self):
+        tools = WriteTools()
+        async_tools = isetools.AsyncISETools(tools, workers=4)
+        mac = '74:31:7D:60:9C:9B'
+        running = async_tools.set_psk(mac, 'one', 'u1')
+        replaced = async_tools.set_psk(mac, 'two', 'u2')
+        last = async_tools.set_psk(mac, 'three', 'u3')
+        # replaced as soon as the later write arrives
+        self.assertEqual((yield replaced), isetools.SUPERSEDED)
+        self.assertEqual(tools.ledger.records,
+                [(mac, 'u2', isetools.SUPERSEDED)])
+        tools.release.set()
+        self.assertEqual((yield [running, last]), ['200', '200'])
+        self.assertEqual(tools.writes, [(mac, 'one', 'u1'),
+                (mac, 'three', 'u3')])
+
+    @gen_test
+    def test_repeats_share_the_result(self):
+        tools = WriteTools()
+        async_tools = isetools.AsyncISETools(tools, workers=4)
+        mac = '74:31:7D:60:9C:9B'
+        # a double submit of the same change while a write is running
+        writes = [async_tools.set_psk(mac, 'one', 'u1') for _ in range(3)]
+        tools.release.set()
+        self.assertEqual((yield writes), ['200', '200', '200'])
+        self.assertEqual(tools.writes, [(mac, 'one', 'u1'),
+                (mac, 'one', 'u1')])
+        self.assertEqual(tools.ledger.records, [])
+
+    @gen_test
+    def test_repeat_after_superseding(self):
+        tools = WriteTools()
+        async_tools = isetools.AsyncISETools(tools, workers=4)
+        mac = '74:31:7D:60:9C:9B'
+        running = async_tools.set_psk(mac, 'one', 'u1')
+        replaced = async_tools.set_psk(mac, 'two', 'u1')
+        last = async_tools.set_psk(mac, 'three', 'u1')
+        repeat = async_tools.set_psk(mac, 'three', 'u1')
+        tools.release.set()
+        self.assertEqual((yield [running, replaced, last, repeat]),
+                ['200', isetools.SUPERSEDED, '200', '200'])
+        self.assertEqual(tools.writes, [(mac, 'one', 'u1'),
+                (mac, 'three', 'u1')])
+
+class DrainTest(AsyncTestCase):
+    @gen_test
+    def test_requests(self):
+        async_tools = isetools.AsyncISETools(WriteTools(), workers=4)
+        self.assertFalse(async_tools.busy())
+        async_tools.begin_request()
+        self.assertTrue(async_tools.busy())
+        self.assertFalse((yield async_tools.drain(timeout=0.1)))
+        self.assertTrue(async_tools.draining)
+        async_tools.end_request()
+        self.assertTrue((yield async_tools.drain(timeout=0.1)))
+
+    @gen_test
+    def test_waits_for_writes(self):
+        tools = WriteTools()
+        async_tools = isetools.AsyncISETools(tools, workers=4)
+        mac = '74:31:7D:60:9C:9B'
+        write = async_tools.set_psk(mac, 'one', 'u1')
+        self.assertTrue(async_tools.busy())
+        threading.Timer(0.1, tools.release.set).start()
+        self.assertTrue((yield async_tools.drain(timeout=5)))
+        self.assertTrue(write.done())
+        self.assertEqual(tools.writes, [(mac, 'one', 'u1')])
+
+class WarmupTools(isetools.ISETools):
+    """ISETools with the ERS calls warming up makes replaced, recording
+    them. Servers in down can't be reached.
+    """
+    def __init__(self, down=()):
+        isetools.ISETools.__init__(self, ['ise1', 'ise2'], 'user', 'pass',
+                None)
+        self.down = down
+        self.calls = []
+
+    def check_node(self, server):
+        self.calls.append(('check', server))
+        if server in self.down:
+            return {'ok': False, 'error': 'Could not be reached'}
+        return {'ok': True, 'error': None}
+
+    def discover_pan(self):
+        self.calls.append(('discover', None))
+        return 'ise2'
+
+class StartTest(AsyncTestCase):
+    @gen_test
+    def test_start(self):
+        tools = WarmupTools(down=('ise1',))
+        async_tools = isetools.AsyncISETools(tools, workers=4)
+        self.assertFalse(async_tools.ready.is_set())
+        yield async_tools.start()
+        # ready even though a server is down
+        self.assertTrue(async_tools.ready.is_set())
+        self.assertGreaterEqual(async_tools.warmup, 0)
+        self.assertEqual(sorted(tools.calls[:2]), [('check', 'ise1'),
+                ('check', 'ise2')])
+        self.assertEqual(tools.calls[2:], [('discover', None)])
+
+    @gen_test
+    def test_start_without_discovery(self):
+        tools = WarmupTools()
+        async_tools = isetools.AsyncISETools(tools, workers=4)
+        yield async_tools.start(discover_pan=False)
+        self.assertTrue(async_tools.ready.is_set())
+        self.assertNotIn(('discover', None), tools.calls)
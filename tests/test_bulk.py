@@ -0,0 +1,137 @@
+import threading, time, unittest
+
+import requests
+
+import isetools, settings
+from admission import Overloaded
+from deadline import DeadlineExceeded
+
+class FakeLedger(object):
+    def __init__(self):
+        self.records = []
+
+    def record(self, mac, unid, outcome, **kwargs):
+        self.records.append(dict(kwargs, mac=mac, unid=unid, outcome=outcome))
+
+class BulkTools(isetools.ISETools):
+    """ISETools with the ERS calls bulk_set_psk makes replaced. Bulk requests
+    succeed for every endpoint, except those listed in fail_chunks by chunk
+    number, which raise the given exception.
+    """
+    def __init__(self, endpoints, fail_chunks=None):
+        isetools.ISETools.__init__(self, ['ise1', 'ise2'], 'user', 'pass',
+                None, ledger=FakeLedger())
+        self.endpoints = endpoints
+        self.fail_chunks = fail_chunks or {}
+        self.submitted = []
+        self.polled = []
+        self.looking_up = 0
+        self.most_lookups = 0
+        self.lookup_lock = threading.Lock()
+
+    def get_endpoint(self, mac, deadline=None, fresh=False):
+        assert fresh
+        with self.lookup_lock:
+            self.looking_up += 1
+            self.most_lookups = max(self.most_lookups, self.looking_up)
+        try:
+            time.sleep(0.01) # long enough for lookups to overlap
+            endpoint = self.endpoints.get(mac)
+            if isinstance(endpoint, Exception):
+                raise endpoint
+            return endpoint
+        finally:
+            with self.lookup_lock:
+                self.looking_up -= 1
+
+    def bulk_submit(self, operation, endpoints, deadline=None, outcome=None):
+        error = self.fail_chunks.get(len(self.submitted))
+        self.submitted.append([mac for mac, psk, unid, endpointid
+                in endpoints])
+        if error is not None:
+            raise error
+        outcome['node'] = 'ise2'
+        return str(len(self.submitted))
+
+    def bulk_status(self, bulkid, server=None, deadline=None):
+        self.polled.append((bulkid, server))
+        return True, {mac: (True, 'OK', 'new-' + mac)
+                for mac in self.submitted[int(bulkid) - 1]}
+
+def entries(count, psk='psk'):
+    return [('MAC' + str(i), psk, 'u1') for i in range(count)]
+
+class BulkSetPskTest(unittest.TestCase):
+    def test_actions(self):
+        existing = {'id': 'id1', 'psk': 'psk', 'unid': 'u1',
+                'group': settings.GROUP_ID}
+        tools = BulkTools({'MAC1': existing, 'MAC2': dict(existing,
+                id='id2', psk='old')})
+        results = tools.bulk_set_psk(entries(3), poll=0)
+        self.assertEqual(results, {'MAC0': 'created', 'MAC1': 'unchanged',
+                'MAC2': 'updated'})
+        self.assertEqual(tools.submitted, [['MAC0'], ['MAC2']])
+        # polled on the node the request was submitted to
+        self.assertEqual(tools.polled, [('1', 'ise2'), ('2', 'ise2')])
+        self.assertEqual(tools.index.get('MAC0')['id'], 'new-MAC0')
+        self.assertEqual(tools.index.get('MAC2')['id'], 'id2')
+        self.assertEqual(sorted((record['mac'], record['action'],
+                record['node']) for record in tools.ledger.records),
+                [('MAC0', 'create', 'ise2'), ('MAC1', 'unchanged', None),
+                ('MAC2', 'update', 'ise2')])
+
+    def test_failed_lookups(self):
+        tools = BulkTools({'MAC0': requests.exceptions.ConnectionError(
+                'refused'), 'MAC1': Overloaded('Too busy')})
+        results = tools.bulk_set_psk(entries(3), poll=0)
+        self.assertEqual(results, {'MAC0': 'failed: refused',
+                'MAC1': 'failed: Too busy', 'MAC2': 'created'})
+        self.assertEqual(len(tools.ledger.records), 3)
+
+    def test_lookups_run_at_once(self):
+        tools = BulkTools({})
+        tools.bulk_set_psk(entries(40), poll=0, concurrency=4)
+        self.assertGreater(tools.most_lookups, 1)
+        self.assertLessEqual(tools.most_lookups, 4)
+
+    def test_stopped_partway(self):
+        for error in (DeadlineExceeded('ISE request took too long'),
+                Overloaded('Timed out waiting for ISE')):
+            tools = BulkTools({}, fail_chunks={1: error})
+            results = tools.bulk_set_psk(entries(5), chunksize=2, poll=0)
+            self.assertEqual(len(tools.submitted), 2)
+            self.assertEqual(results['MAC0'], 'created')
+            self.assertEqual(results['MAC1'], 'created')
+            self.assertEqual(results['MAC2'], 'failed: no status from ISE, ' +
+                    str(error))
+            self.assertEqual(results['MAC4'], 'failed: not sent, ' +
+                    str(error))
+            self.assertEqual(sorted(record['outcome']
+                    for record in tools.ledger.records),
+                    ['failed'] * 3 + ['ok'] * 2)
+
+    def test_ise_error_continues(self):
+        tools = BulkTools({}, fail_chunks={0: isetools.ISEAPIError('Bad')})
+        results = tools.bulk_set_psk(entries(3), chunksize=2, poll=0)
+        self.assertEqual(results, {'MAC0': 'failed: no status from ISE',
+                'MAC1': 'failed: no status from ISE', 'MAC2': 'created'})
+
+class FakeResponse(object):
+    status_code = 200
+    text = ("<ns4:bulkStatus executionStatus='COMPLETED' " +
+            "xmlns:ns4='identity.ers.ise.cisco.com'><resourcesStatus>" +
+            "<resourceStatus name='MAC0' id='id0' status='CREATED' " +
+            "resourceExecutionStatus='SUCCESS'/></resourcesStatus>" +
+            "</ns4:bulkStatus>")
+
+class BulkStatusTest(unittest.TestCase):
+    def test_polls_submitting_node(self):
+        tools = isetools.ISETools(['ise1', 'ise2'], 'user', 'pass', None)
+        sent = []
+        tools.send = lambda server, method, path, **kwargs: (
+                sent.append((server, path)) or FakeResponse())
+        self.assertEqual(tools.bulk_status('b1', 'ise2'), (True,
+                {'MAC0': (True, 'CREATED', 'id0')}))
+        self.assertEqual(sent, [('ise2', 'endpoint/bulk/b1')])
+        tools.bulk_status('b1')
+        self.assertEqual(sent[-1], ('ise1', 'endpoint/bulk/b1'))
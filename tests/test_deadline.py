@@ -0,0 +1,100 @@
+import json, time, unittest
+
+from tornado import testing, web
+
+from deadline import Deadline, DeadlineExceeded, NO_DEADLINE
+import isehandlers, isetools
+
+MAC = '74:31:7D:60:9C:9B'
+
+class DeadlineTest(unittest.TestCase):
+    def test_no_limit(self):
+        self.assertIsNone(NO_DEADLINE.remaining())
+        self.assertIsNone(NO_DEADLINE.timeout())
+        self.assertEqual(NO_DEADLINE.timeout(10), 10)
+        NO_DEADLINE.check()
+
+    def test_timeout(self):
+        deadline = Deadline(5)
+        self.assertAlmostEqual(deadline.timeout(), 5, delta=0.5)
+        self.assertEqual(deadline.timeout(1), 1)
+        self.assertAlmostEqual(deadline.timeout(60), 5, delta=0.5)
+
+    def test_expired(self):
+        deadline = Deadline(0.01)
+        time.sleep(0.02)
+        self.assertEqual(deadline.remaining(), 0)
+        with self.assertRaises(DeadlineExceeded):
+            deadline.check()
+        with self.assertRaises(DeadlineExceeded):
+            deadline.timeout(10)
+
+    def test_cancel(self):
+        deadline = Deadline()
+        deadline.cancel()
+        with self.assertRaises(DeadlineExceeded):
+            deadline.check()
+
+    def test_child(self):
+        parent = Deadline(5)
+        child = parent.child()
+        self.assertEqual(child.expires, parent.expires)
+        # cancelling a child leaves the parent running
+        child.cancel()
+        with self.assertRaises(DeadlineExceeded):
+            child.check()
+        parent.check()
+        # cancelling the parent cancels its children
+        other = parent.child()
+        parent.cancel()
+        with self.assertRaises(DeadlineExceeded):
+            other.check()
+
+    def test_shared(self):
+        deadline = Deadline(5)
+        shared = deadline.shared()
+        self.assertEqual(shared.expires, deadline.expires)
+        deadline.cancel()
+        shared.check()
+
+class FakeSession(object):
+    def __init__(self):
+        self.calls = 0
+
+    def request(self, method, url, **kwargs):
+        self.calls += 1
+        raise AssertionError('sent after the deadline')
+
+class SendTest(unittest.TestCase):
+    def test_not_sent_after_deadline(self):
+        tools = isetools.ISETools(['ise1'], 'user', 'pass', None)
+        session = FakeSession()
+        tools.session = lambda server=None: session
+        deadline = Deadline(5)
+        deadline.cancel()
+        with self.assertRaises(DeadlineExceeded):
+            tools.send('ise1', 'GET', 'endpoint/name/' + MAC,
+                    deadline=deadline)
+        self.assertEqual(session.calls, 0)
+        # not the server's fault
+        self.assertEqual(tools.limiters[('ise1', 'read')].status(),
+                {'active': 0, 'waiting': 0})
+        self.assertEqual(tools.metrics.values['ise_requests_total'], {})
+
+class SlowTools(isetools.ISETools):
+    def get_endpointid(self, mac, deadline=None):
+        time.sleep(0.1)
+        deadline.check()
+        return 'id1', '200'
+
+class HandlerTest(testing.AsyncHTTPTestCase):
+    def get_app(self):
+        tools = SlowTools(['ise1'], 'user', 'pass', None)
+        isehandlers.assign_objects(isetools.AsyncISETools(tools, workers=2,
+                request_timeout=0.05))
+        return web.Application(isehandlers.handlers)
+
+    def test_request_timeout(self):
+        response = self.fetch('/ise/psk?mac=' + MAC)
+        self.assertEqual(response.code, 504)
+        self.assertIn('error', json.loads(response.body.decode('utf-8')))
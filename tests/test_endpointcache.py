@@ -0,0 +1,93 @@
+import json, time, unittest
+
+from endpointcache import EndpointCache
+import isetools, settings
+
+MAC = '74:31:7D:60:9C:9B'
+
+class EndpointCacheTest(unittest.TestCase):
+    def test_get_and_put(self):
+        cache = EndpointCache()
+        self.assertIsNone(cache.get('M1'))
+        cache.put('M1', {'id': 'id1'})
+        self.assertEqual(cache.get('M1'), {'id': 'id1'})
+        cache.put('M1', {'id': 'id2'})
+        self.assertEqual(cache.get('M1'), {'id': 'id2'})
+        self.assertEqual(cache.stats(), {'hits': 2, 'misses': 1, 'size': 1})
+
+    def test_least_recently_used_dropped(self):
+        cache = EndpointCache(maxsize=2)
+        cache.put('M1', {'id': 'id1'})
+        cache.put('M2', {'id': 'id2'})
+        cache.get('M1')
+        cache.put('M3', {'id': 'id3'})
+        self.assertIsNone(cache.get('M2'))
+        self.assertEqual(cache.get('M1'), {'id': 'id1'})
+        self.assertEqual(cache.get('M3'), {'id': 'id3'})
+        self.assertEqual(cache.stats()['size'], 2)
+
+    def test_expiry(self):
+        cache = EndpointCache(ttl=0.01)
+        cache.put('M1', {'id': 'id1'})
+        time.sleep(0.02)
+        self.assertIsNone(cache.get('M1'))
+        self.assertEqual(cache.stats(), {'hits': 0, 'misses': 1, 'size': 0})
+
+    def test_invalidate(self):
+        cache = EndpointCache()
+        cache.put('M1', {'id': 'id1'})
+        cache.invalidate('M1')
+        cache.invalidate('M2')
+        self.assertIsNone(cache.get('M1'))
+
+    def test_disabled(self):
+        cache = EndpointCache(maxsize=0)
+        cache.put('M1', {'id': 'id1'})
+        self.assertIsNone(cache.get('M1'))
+        self.assertEqual(cache.stats()['size'], 0)
+
+class FakeResponse(object):
+    status_code = 200
+    ok = True
+
+    def __init__(self, psk):
+        self.text = json.dumps({'ERSEndPoint': {'id': 'id1', 'name': MAC,
+                'groupId': settings.GROUP_ID, 'portalUser': 'u1',
+                'customAttributes': {'customAttributes': {
+                'iPSK': 'psk=' + psk}}}})
+
+    def json(self):
+        return json.loads(self.text)
+
+class FakeSession(object):
+    """Answers every lookup with the same endpoint, with the current PSK."""
+    def __init__(self):
+        self.psk = 'one'
+        self.calls = 0
+
+    def request(self, method, url, **kwargs):
+        self.calls += 1
+        return FakeResponse(self.psk)
+
+class GetEndpointTest(unittest.TestCase):
+    def setUp(self):
+        self.tools = isetools.ISETools(['ise1'], 'user', 'pass', None)
+        self.session = FakeSession()
+        self.tools.session = lambda server=None: self.session
+
+    def test_cached(self):
+        self.assertEqual(self.tools.get_endpoint(MAC)['psk'], 'one')
+        self.session.psk = 'two'
+        self.assertEqual(self.tools.get_endpoint(MAC)['psk'], 'one')
+        self.assertEqual(self.session.calls, 1)
+        self.assertEqual(self.tools.cache.stats(), {'hits': 1, 'misses': 1,
+                'size': 1})
+
+    def test_fresh(self):
+        self.tools.get_endpoint(MAC)
+        self.session.psk = 'two'
+        self.assertEqual(self.tools.get_endpoint(MAC, fresh=True)['psk'],
+                'two')
+        # the fresh details replace the cached ones
+        self.assertEqual(self.tools.get_endpoint(MAC)['psk'], 'two')
+        self.assertEqual(self.session.calls, 2)
@@ -0,0 +1,162 @@
+import os, shutil, tempfile, time, unittest
+
+import isetools
+from endpointindex import EndpointIndex
+from sharedstate import SharedState
+
+class FakeTools(object):
+    """Stands in for ISETools, with endpoints as MAC address -> details."""
+    def __init__(self, endpoints):
+        self.endpoints = endpoints
+        self.lookups = []
+
+    def search_group(self, page, size=100, deadline=None):
+        macs = sorted(self.endpoints)
+        return ([(self.endpoints[mac]['id'], mac)
+                for mac in macs[(page - 1) * size:page * size]], len(macs))
+
+    def get_endpoint(self, mac, deadline=None, fresh=False, publish=True):
+        self.lookups.append((mac, fresh, publish))
+        endpoint = self.endpoints.get(mac)
+        return dict(endpoint) if endpoint is not None else None
+
+def endpoint(number, psk='psk', unid='u1'):
+    return {'id': 'id' + str(number), 'psk': psk, 'group': 'group',
+            'unid': unid}
+
+class EndpointIndexTest(unittest.TestCase):
+    def test_sync(self):
+        tools = FakeTools({'M' + str(i): endpoint(i) for i in range(5)})
+        index = EndpointIndex(pagesize=2)
+        self.assertFalse(index.ready())
+        self.assertTrue(index.sync(tools))
+        self.assertTrue(index.ready())
+        self.assertEqual(index.get('M3'), endpoint(3))
+        self.assertEqual(sorted(index.list_unid('u1')),
+                ['M0', 'M1', 'M2', 'M3', 'M4'])
+
+        # only new or replaced endpoints are fetched, and removed ones are
+        # dropped
+        del tools.endpoints['M0']
+        tools.endpoints['M1'] = endpoint(10)
+        tools.endpoints['M5'] = endpoint(5, unid='u2')
+        tools.lookups = []
+        index.sync(tools)
+        self.assertEqual(sorted(tools.lookups), [('M1', True, False),
+                ('M5', True, False)])
+        self.assertIsNone(index.get('M0'))
+        self.assertEqual(index.get('M1')['id'], 'id10')
+        self.assertEqual(list(index.list_unid('u2')), ['M5'])
+
+    def test_changes_in_ise_are_picked_up(self):
+        tools = FakeTools({'M0': endpoint(0)})
+        index = EndpointIndex(max_age=0)
+        index.sync(tools)
+        tools.endpoints['M0'] = endpoint(0, psk='changed', unid='u2')
+        index.sync(tools)
+        self.assertEqual(index.get('M0')['psk'], 'changed')
+        self.assertEqual(list(index.list_unid('u2')), ['M0'])
+        self.assertEqual(index.list_unid('u1'), {})
+
+    def test_max_age(self):
+        tools = FakeTools({'M0': endpoint(0)})
+        index = EndpointIndex(max_age=3600)
+        index.sync(tools)
+        tools.endpoints['M0'] = endpoint(0, psk='changed')
+        index.sync(tools)
+        # not old enough to fetch again yet
+        self.assertEqual(index.get('M0')['psk'], 'psk')
+        index.updated['M0'] -= 3601
+        index.sync(tools)
+        self.assertEqual(index.get('M0')['psk'], 'changed')
+
+    def test_writes_during_sync_are_kept(self):
+        tools = FakeTools({})
+        index = EndpointIndex()
+        search_group = tools.search_group
+        def write_then_search(*args, **kwargs):
+            index.update('M9', endpoint(9))
+            return search_group(*args, **kwargs)
+        tools.search_group = write_then_search
+        index.sync(tools)
+        self.assertEqual(index.get('M9'), endpoint(9))
+
+    def test_load(self):
+        index = EndpointIndex()
+        index.update('M0', endpoint(0, psk='written here'))
+        index.update('M1', endpoint(1))
+        index.update('M2', endpoint(2))
+        written = index.updated['M0']
+        # a snapshot from a sync that started before M0 was written here,
+        # and that no longer has M1
+        other = EndpointIndex()
+        other.update('M0', endpoint(0))
+        other.update('M3', endpoint(3))
+        endpoints, updated = other.snapshot()
+        updated['M0'] = written - 1
+        index.updated['M1'] = written - 3
+        index.updated['M2'] = written - 1
+        index.load(endpoints, updated, started=written - 2, synced=written)
+        self.assertTrue(index.ready())
+        self.assertEqual(index.get('M0')['psk'], 'written here')
+        self.assertIsNone(index.get('M1'))
+        # added while the other process was syncing
+        self.assertEqual(index.get('M2'), endpoint(2))
+        self.assertEqual(index.get('M3'), endpoint(3))
+
+class SearchTools(isetools.ISETools):
+    """ISETools with the ERS calls an index sync makes replaced, counting
+    group searches.
+    """
+    def __init__(self, endpoints, shared):
+        isetools.ISETools.__init__(self, ['ise1'], 'user', 'pass', None)
+        self.fake = FakeTools(endpoints)
+        self.shared = shared
+        self.searches = 0
+
+    def search_group(self, page, size=100, deadline=None):
+        self.searches += 1
+        return self.fake.search_group(page, size)
+
+    def get_endpoint(self, mac, deadline=None, fresh=False, publish=True):
+        endpoint = self.fake.get_endpoint(mac, fresh=fresh)
+        self.remember(mac, endpoint, publish=publish)
+        return endpoint
+
+class SharedIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.filename = os.path.join(self.folder, 'state.db')
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_one_process_syncs(self):
+        endpoints = {'M' + str(i): endpoint(i) for i in range(3)}
+        syncing = SearchTools(endpoints, SharedState(self.filename))
+        other = SearchTools(endpoints, SharedState(self.filename))
+        # as if it were another process
+        other.shared.pid = syncing.shared.pid + 1
+
+        self.assertTrue(syncing.sync_index(lease=60))
+        self.assertFalse(other.sync_index(lease=60))
+        self.assertEqual((syncing.searches, other.searches), (1, 0))
+        # the sync is shared as one snapshot, not as endpoint changes
+        self.assertEqual(other.shared.poll(), [])
+        self.assertFalse(other.index.ready())
+        other.sync_shared()
+        self.assertTrue(other.index.ready())
+        self.assertEqual(other.index.get('M2'), endpoint(2))
+
+    def test_lease_taken_over(self):
+        first = SharedState(self.filename)
+        second = SharedState(self.filename)
+        # another process that is still running, so only expiry ends its lease
+        second.pid = os.getppid()
+        self.assertTrue(first.lease('index', 60))
+        self.assertFalse(second.lease('index', 60))
+        self.assertTrue(first.lease('index', 60))
+        # expired without being renewed
+        first.db.execute('UPDATE leases SET expires=?', (time.time() - 1,))
+        self.assertTrue(second.lease('index', 60))
+        self.assertFalse(first.lease('index', 60))
@@ -0,0 +1,273 @@
+import json
+from unittest import mock
+
+import requests
+from tornado import testing, web
+
+import isehandlers, isetools
+
+MAC = '74:31:7D:60:9C:9B'
+
+class HandlerTest(testing.AsyncHTTPTestCase):
+    """Runs the API handlers against AsyncISETools, with whatever
+    ISETools make_tools() returns.
+    """
+    def make_tools(self):
+        return isetools.ISETools(['ise1'], 'user', 'pass', None)
+
+    def make_async_tools(self, tools):
+        return isetools.AsyncISETools(tools, workers=2)
+
+    def get_app(self):
+        self.tools = self.make_tools()
+        self.async_tools = self.make_async_tools(self.tools)
+        isehandlers.assign_objects(self.async_tools)
+        return web.Application(isehandlers.handlers)
+
+    def fetch_json(self, path, **kwargs):
+        response = self.fetch(path, **kwargs)
+        return response.code, json.loads(response.body.decode('utf-8'))
+
+class ListUnidTest(HandlerTest):
+    def test_not_enabled(self):
+        code, body = self.fetch_json('/ise/psk?unid=u1')
+        self.assertEqual(code, 400)
+        self.assertEqual(body, {'error':
+                'Looking up devices by uNID is not enabled'})
+
+    def test_still_syncing(self):
+        self.async_tools.sync_interval = 60
+        response = self.fetch('/ise/psk?unid=u1')
+        self.assertEqual(response.code, 503)
+        self.assertEqual(response.headers['Retry-After'], '10')
+        self.assertIn('still syncing', json.loads(response.body.decode(
+                'utf-8'))['error'])
+
+    def test_synced(self):
+        self.async_tools.sync_interval = 60
+        self.tools.index.update(MAC, {'id': 'id1', 'unid': 'u1'})
+        self.tools.index.update('00:00:00:00:00:01', {'id': 'id2',
+                'unid': 'u2'})
+        self.tools.index.synced = 0
+        self.assertEqual(self.fetch_json('/ise/psk?unid=u1'),
+                (200, {'result': {MAC: 'id1'}}))
+
+class FakeMailer(object):
+    def __init__(self):
+        self.sent = []
+
+    def send(self, subject, message, to, **kwargs):
+        self.sent.append(to)
+
+    def add_to_digest(self, entry):
+        self.sent.append('digest')
+
+class PostTest(HandlerTest):
+    def make_tools(self):
+        tools = HandlerTest.make_tools(self)
+        tools.mailer = FakeMailer()
+        return tools
+
+    def test_bad_mac(self):
+        code, body = self.fetch_json('/ise/psk', method='POST',
+                body=json.dumps({'mac': '74:31:7D:60:9C', 'psk': 'psk',
+                'unid': 'u1', 'firstname': 'First', 'lastname': 'Last'}),
+                headers={'Content-Type': 'application/json'})
+        self.assertEqual(code, 400)
+        self.assertEqual(body, {'error':
+                'MAC Address needs to be 12 characters'})
+        self.assertEqual(self.tools.mailer.sent, [])
+
+    def test_missing_argument(self):
+        code, body = self.fetch_json('/ise/psk?mac=' + MAC, method='POST',
+                body='')
+        self.assertEqual(code, 400)
+        self.assertEqual(self.tools.mailer.sent, [])
+
+class ExportTools(isetools.ISETools):
+    """Has one page of two endpoints, and fails to look up the second."""
+    def search_group(self, page, size=100, deadline=None):
+        return [('id1', MAC), ('id2', '00:00:00:00:00:01')], 2
+
+    def get_endpoint(self, mac, deadline=None, fresh=False, publish=True):
+        if mac != MAC:
+            raise isetools.ISEAPIError('Internal Server Error')
+        return {'id': 'id1', 'psk': 'secret', 'group': 'group', 'unid': 'u1'}
+
+class ExportTest(HandlerTest):
+    def make_tools(self):
+        return ExportTools(['ise1'], 'user', 'pass', None)
+
+    def test_csv_lookup_error(self):
+        response = self.fetch('/ise/psk/export')
+        self.assertEqual(response.code, 200)
+        self.assertEqual(response.body.decode('utf-8').splitlines(), [
+                'mac,unid,id', MAC + ',u1,id1',
+                'error,00:00:00:00:00:01: Internal Server Error'])
+        self.assertEqual(self.tools.metrics.values[
+                'ise_export_errors_total'], {self.tools.metrics.key(None): 1})
+
+    def test_ndjson_lookup_error(self):
+        response = self.fetch('/ise/psk/export?format=ndjson&psk=1')
+        self.assertEqual(response.code, 200)
+        self.assertEqual([json.loads(line) for line in response.body.decode(
+                'utf-8').splitlines()], [
+                {'mac': MAC, 'psk': 'secret', 'unid': 'u1', 'id': 'id1'},
+                {'mac': '00:00:00:00:00:01', 'id': 'id2',
+                'error': 'Internal Server Error'}])
+
+class VersionResponse(object):
+    status_code = 200
+    ok = True
+    text = json.dumps({'VersionInfo': {}})
+
+    def json(self):
+        return json.loads(self.text)
+
+class HealthSession(object):
+    """Answers health checks on the servers that are up."""
+    def __init__(self, server, up):
+        self.server = server
+        self.up = up
+
+    def request(self, method, url, **kwargs):
+        if self.server not in self.up:
+            raise requests.exceptions.ConnectionError('refused')
+        return VersionResponse()
+
+class TestHandlerTest(HandlerTest):
+    def make_tools(self):
+        tools = isetools.ISETools(['ise1', 'ise2'], 'user', 'pass', None)
+        self.up = {'ise1', 'ise2'}
+        tools.session = lambda server=None: HealthSession(server, self.up)
+        return tools
+
+    def make_async_tools(self, tools):
+        # no background checks, so each request checks
+        return isetools.AsyncISETools(tools, workers=2, health_interval=0)
+
+    def test_ok(self):
+        self.up.discard('ise2')
+        code, body = self.fetch_json('/ise/test')
+        self.assertEqual(code, 200)
+        self.assertEqual(body['result'], 'OK')
+        self.assertEqual(body['servers']['ise2']['error'],
+                'Could not be reached')
+
+    def test_all_down(self):
+        self.up.clear()
+        code, body = self.fetch_json('/ise/test')
+        self.assertEqual(code, 500)
+        self.assertIn('unreachable', body['error'])
+        self.assertEqual(sorted(body['servers']), ['ise1', 'ise2'])
+
+    def test_background_checks(self):
+        # with background checks, requests only report their results
+        self.async_tools.health_interval = 10
+        code, body = self.fetch_json('/ise/test')
+        self.assertEqual(code, 500)
+        self.assertEqual(body['servers']['ise1']['error'], 'Not checked yet')
+
+class ReadyTest(HandlerTest):
+    def test_starting_up(self):
+        self.assertEqual(self.fetch_json('/ise/ready'),
+                (503, {'error': 'Starting up'}))
+
+    def test_ready(self):
+        self.async_tools.ready.set()
+        self.assertEqual(self.fetch_json('/ise/ready'),
+                (200, {'result': 'OK'}))
+
+    def test_draining(self):
+        self.async_tools.ready.set()
+        self.async_tools.draining = True
+        self.assertEqual(self.fetch_json('/ise/ready'),
+                (503, {'error': 'Shutting down'}))
+        # still alive, and still answering while it drains
+        self.assertEqual(self.fetch_json('/ise/alive'),
+                (200, {'result': 'OK'}))
+
+    def test_requests_tracked(self):
+        self.fetch_json('/ise/psk?unid=u1')
+        self.fetch_json('/ise/psk', method='POST', body='')
+        self.assertEqual(self.async_tools.requests, 0)
+        self.assertFalse(self.async_tools.busy())
+
+class GroupTools(isetools.ISETools):
+    """ISETools keeping the iPSK group in a dictionary of MAC address ->
+    (PSK, uNID), with endpoint IDs made from the MAC address.
+    """
+    def search_group(self, page, size=100, deadline=None):
+        macs = sorted(self.group)
+        return [('id-' + mac, mac) for mac in macs[(page - 1) * size:
+                page * size]], len(macs)
+
+    def get_endpoint(self, mac, deadline=None, fresh=False, publish=True):
+        if mac not in self.group:
+            return None
+        psk, unid = self.group[mac]
+        return {'id': 'id-' + mac, 'psk': psk, 'group': 'group',
+                'unid': unid}
+
+    def set_psk(self, mac, psk, unid, trace=None, deadline=None):
+        code = '200' if mac in self.group else '201'
+        self.group[mac] = (psk, unid)
+        return code
+
+GROUP = {'00:00:00:00:00:0' + str(i): ('psk' + str(i), 'u' + str(i))
+        for i in range(5)}
+
+class RoundTripTest(HandlerTest):
+    def make_tools(self):
+        tools = GroupTools(['ise1'], 'user', 'pass', None)
+        tools.group = dict(GROUP)
+        return tools
+
+    def import_rows(self, body, content_type):
+        response = self.fetch('/ise/psk/import', method='POST', body=body,
+                headers={'Content-Type': content_type})
+        self.assertEqual(response.code, 200)
+        return [json.loads(line) for line in response.body.decode(
+                'utf-8').splitlines()]
+
+    def test_csv(self):
+        with mock.patch.object(isehandlers, 'EXPORT_PAGE_SIZE', 2):
+            exported = self.fetch('/ise/psk/export?psk=1').body
+        self.assertEqual(len(exported.splitlines()), 6)
+        self.tools.group = {}
+        results = self.import_rows(exported, 'text/csv')
+        self.assertEqual(results[-1], {'rows': 5, 'done': 5, 'failed': 0})
+        self.assertEqual(sorted(result['row'] for result in results[:-1]),
+                [1, 2, 3, 4, 5])
+        self.assertEqual(self.tools.group, GROUP)
+
+    def test_ndjson(self):
+        exported = self.fetch('/ise/psk/export?psk=1&format=ndjson').body
+        self.tools.group = {}
+        results = self.import_rows(exported, 'application/x-ndjson')
+        self.assertEqual(results[-1], {'rows': 5, 'done': 5, 'failed': 0})
+        self.assertEqual({result['result'] for result in results[:-1]},
+                {'201'})
+        self.assertEqual(self.tools.group, GROUP)
+
+    def test_without_psks(self):
+        exported = self.fetch('/ise/psk/export').body.decode('utf-8')
+        self.assertEqual(exported.splitlines()[:2], ['mac,unid,id',
+                '00:00:00:00:00:00,u0,id-00:00:00:00:00:00'])
+
+    def test_bad_rows(self):
+        results = self.import_rows(b'mac,psk,unid\r\n' +
+                b'00:00:00:00:00:05,new,u5\r\n' +
+                b'bad-mac,psk,u6\r\n' +
+                b'00:00:00:00:00:07,,u7', 'text/csv')
+        self.assertEqual(results[-1], {'rows': 3, 'done': 1, 'failed': 2})
+        errors = {result['row']: result['error'] for result in results[:-1]
+                if 'error' in result}
+        self.assertEqual(sorted(errors), [2, 3])
+        self.assertIn('Missing argument', errors[3])
+        self.assertEqual(self.tools.group['00:00:00:00:00:05'], ('new', 'u5'))
+
+    def test_bad_format(self):
+        code, body = self.fetch_json('/ise/psk/export?format=xml')
+        self.assertEqual(code, 400)
+        self.assertIn('Unknown format', body['error'])
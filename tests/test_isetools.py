@@ -0,0 +1,438 @@
+import json, time, unittest
+
+import requests
+
+import isetools, settings
+from deadline import NO_DEADLINE
+
+MAC = '74:31:7D:60:9C:9B'
+
+NOT_PAN_HTML = ('<html><body><h1>HTTP Status 401 - Unauthorized</h1>' +
+        '<p><b>Type</b> Status Report</p><p><b>Description</b> CRUD ' +
+        'operation is allowed on PAP node only</p></body></html>')
+
+class FakeResponse(object):
+    def __init__(self, status_code, body=None, text='', headers=None):
+        self.status_code = status_code
+        self.ok = status_code < 400
+        self.text = json.dumps(body) if body is not None else text
+        self.headers = headers or {}
+
+    def json(self):
+        return json.loads(self.text)
+
+def ers_error(status, title):
+    return FakeResponse(status, {'ERSResponse': {'messages': [
+            {'title': title}]}})
+
+class FakeERS(object):
+    """Stands in for the ERS API of an ISE deployment, with endpoints as
+    MAC address -> (Endpoint ID, PSK, uNID). Only the PAN accepts writes.
+    """
+    def __init__(self, endpoints=None, pan='ise1'):
+        self.endpoints = dict(endpoints or {})
+        self.pan = pan
+        self.calls = []
+        self.created = 0
+        self.down = set() # servers that can't be reached
+        self.unauthorized = set() # servers that turn the account away
+
+    def session(self, server):
+        ers = self
+        class Session(object):
+            def request(self, method, url, data=None, **kwargs):
+                path = url.split('/ers/config/', 1)[1]
+                ers.calls.append((server, method, path))
+                return ers.answer(server, method, path, data)
+        return Session()
+
+    def find(self, endpointid):
+        for mac, (knownid, psk, unid) in self.endpoints.items():
+            if knownid == endpointid:
+                return mac
+        return None
+
+    def answer(self, server, method, path, data):
+        if server in self.down:
+            raise requests.exceptions.ConnectionError('refused')
+        if method != 'GET' and server != self.pan:
+            return FakeResponse(401, text=NOT_PAN_HTML)
+        if method == 'GET' and path.startswith('endpoint/name/'):
+            mac = path[len('endpoint/name/'):]
+            if mac not in self.endpoints:
+                return ers_error(404, 'Resource not found')
+            endpointid, psk, unid = self.endpoints[mac]
+            return FakeResponse(200, {'ERSEndPoint': {'id': endpointid,
+                    'name': mac, 'groupId': settings.GROUP_ID,
+                    'portalUser': unid, 'customAttributes': {
+                    'customAttributes': {'iPSK': 'psk=' + psk}}}})
+        if method == 'POST' and path == 'endpoint/':
+            details = json.loads(data)['ERSEndPoint']
+            self.created += 1
+            endpointid = 'new' + str(self.created)
+            self.endpoints[details['mac']] = (endpointid, details[
+                    'customAttributes']['customAttributes']['iPSK'][4:],
+                    details['portalUser'])
+            return FakeResponse(201, headers={'Location': 'https://' +
+                    server + ':9060/ers/config/endpoint/' + endpointid})
+        if method in ('PUT', 'DELETE'):
+            mac = self.find(path[len('endpoint/'):])
+            if mac is None:
+                return ers_error(404, 'Resource not found')
+            if method == 'DELETE':
+                del self.endpoints[mac]
+                return FakeResponse(204)
+            details = json.loads(data)['ERSEndPoint']
+            self.endpoints[mac] = (details['id'], details['customAttributes'][
+                    'customAttributes']['iPSK'][4:], details['portalUser'])
+            return FakeResponse(200, {'UpdatedFieldsList': {}})
+        if method == 'GET' and path == 'service/versioninfo':
+            if server in self.unauthorized:
+                return FakeResponse(401, text='<html>Unauthorized</html>')
+            return FakeResponse(200, {'VersionInfo': {}})
+        return ers_error(400, 'Unexpected request ' + method + ' ' + path)
+
+def make_tools(ers, servers=('ise1',), **kwargs):
+    tools = isetools.ISETools(list(servers), 'user', 'pass', None, **kwargs)
+    tools.session = ers.session
+    return tools
+
+def writes(ers):
+    return [(method, path) for server, method, path in ers.calls
+            if method != 'GET']
+
+class SetPskTest(unittest.TestCase):
+    def test_create_update_unchanged(self):
+        ers = FakeERS()
+        tools = make_tools(ers)
+        self.assertEqual(tools.set_psk(MAC, 'one', 'u1'), '201')
+        self.assertEqual(tools.set_psk(MAC, 'two', 'u1'), '200')
+        self.assertEqual(tools.set_psk(MAC, 'two', 'u1'), '200')
+        self.assertEqual(writes(ers), [('POST', 'endpoint/'),
+                ('PUT', 'endpoint/new1')])
+        self.assertEqual(ers.endpoints[MAC], ('new1', 'two', 'u1'))
+
+    def test_changed_in_ise_since_cached(self):
+        ers = FakeERS({MAC: ('id1', 'one', 'u1')})
+        tools = make_tools(ers)
+        tools.get_endpoint(MAC)
+        # an admin changes the PSK in ISE while the old one is cached
+        ers.endpoints[MAC] = ('id1', 'other', 'u1')
+        self.assertEqual(tools.set_psk(MAC, 'one', 'u1'), '200')
+        self.assertEqual(writes(ers), [('PUT', 'endpoint/id1')])
+        self.assertEqual(ers.endpoints[MAC], ('id1', 'one', 'u1'))
+
+    def test_deleted_in_ise_since_cached(self):
+        ers = FakeERS({MAC: ('id1', 'one', 'u1')})
+        tools = make_tools(ers)
+        tools.get_endpoint(MAC)
+        del ers.endpoints[MAC]
+        self.assertEqual(tools.set_psk(MAC, 'two', 'u1'), '201')
+        self.assertEqual(writes(ers), [('POST', 'endpoint/')])
+        self.assertEqual(tools.cache.get(MAC)['id'], 'new1')
+
+class SessionTest(unittest.TestCase):
+    def adapter(self, tools):
+        return tools.new_session().get_adapter('https://ise1')
+
+    def test_pool_does_not_block(self):
+        adapter = self.adapter(isetools.ISETools(['ise1'], 'user', 'pass',
+                None, poolsize=4))
+        self.assertFalse(adapter._pool_block)
+        self.assertEqual(adapter._pool_maxsize, 4)
+
+    def test_pool_sized_for_hedger(self):
+        adapter = self.adapter(isetools.ISETools(['ise1'], 'user', 'pass',
+                None, poolsize=4, hedge_reads=True))
+        self.assertFalse(adapter._pool_block)
+        self.assertEqual(adapter._pool_maxsize, 12)
+
+class HealthTest(unittest.TestCase):
+    def setUp(self):
+        self.ers = FakeERS()
+        self.tools = make_tools(self.ers, servers=('ise1', 'ise2', 'ise3'))
+
+    def test_check_node(self):
+        self.ers.down.add('ise2')
+        self.ers.unauthorized.add('ise3')
+        self.assertEqual([self.tools.check_node(server)['error']
+                for server in ('ise1', 'ise2', 'ise3')],
+                [None, 'Could not be reached', 'HTTP Status 401'])
+        self.assertTrue(self.tools.checks['ise1']['ok'])
+        self.assertFalse(self.tools.checks['ise2']['ok'])
+
+    def test_health_report(self):
+        report = self.tools.health_report()
+        self.assertEqual(report['ok'], False)
+        self.assertIsNone(report['age'])
+        self.assertEqual(report['servers']['ise1']['error'],
+                'Not checked yet')
+        self.ers.down.add('ise2')
+        for server in ('ise1', 'ise2', 'ise3'):
+            self.tools.check_node(server)
+        report = self.tools.health_report()
+        # one passing server is enough
+        self.assertTrue(report['ok'])
+        self.assertEqual(report['age'], 0)
+        self.assertEqual(report['servers']['ise2']['error'],
+                'Could not be reached')
+
+    def test_out_of_date(self):
+        self.tools.check_node('ise1')
+        self.tools.checks['ise1']['checked'] = time.time() - 60
+        self.assertTrue(self.tools.health_report()['ok'])
+        report = self.tools.health_report(max_age=30)
+        self.assertFalse(report['ok'])
+        self.assertEqual(report['servers']['ise1']['error'],
+                'Check is out of date')
+        self.assertEqual(report['servers']['ise1']['age'], 60)
+
+class SlowSession(object):
+    """Answers after a delay, or fails to connect if the delay is None."""
+    def __init__(self, server, delays, calls):
+        self.server = server
+        self.delays = delays
+        self.calls = calls
+
+    def request(self, method, url, **kwargs):
+        self.calls.append(self.server)
+        if self.delays[self.server] is None:
+            raise requests.exceptions.ConnectionError('refused')
+        time.sleep(self.delays[self.server])
+        return FakeResponse(200, {'server': self.server})
+
+class HedgedReadTest(unittest.TestCase):
+    def setUp(self):
+        self.tools = isetools.ISETools(['ise1', 'ise2'], 'user', 'pass', None,
+                hedge_reads=True)
+        self.tools.hedge_default_delay = 0.05
+        self.delays = {'ise1': 0, 'ise2': 0}
+        self.calls = []
+        self.tools.session = lambda server=None: SlowSession(server,
+                self.delays, self.calls)
+
+    def tearDown(self):
+        self.tools.hedger.shutdown()
+
+    def hedged_read(self):
+        tried = set()
+        result = self.tools.hedged_read('ise1', tried, 'endpoint/name/' + MAC,
+                {}, 10, 'lookup', NO_DEADLINE)
+        return result, tried
+
+    def winners(self):
+        return {dict(key)['winner']: count for key, count in
+                self.tools.metrics.values['ise_hedged_reads_total'].items()}
+
+    def test_fast_first_server(self):
+        result, tried = self.hedged_read()
+        self.assertEqual(result.json(), {'server': 'ise1'})
+        self.assertEqual((self.calls, tried), (['ise1'], {'ise1'}))
+        self.assertEqual(self.winners(), {})
+
+    def test_slow_first_server(self):
+        self.delays['ise1'] = 0.5
+        started = time.monotonic()
+        result, tried = self.hedged_read()
+        self.assertLess(time.monotonic() - started, 0.4)
+        self.assertEqual(result.json(), {'server': 'ise2'})
+        self.assertEqual(tried, {'ise1', 'ise2'})
+        self.assertEqual(self.winners(), {'hedge': 1})
+
+    def test_first_server_wins(self):
+        self.delays.update(ise1=0.1, ise2=0.5)
+        result, tried = self.hedged_read()
+        self.assertEqual(result.json(), {'server': 'ise1'})
+        self.assertEqual(self.winners(), {'first': 1})
+
+    def test_unreachable(self):
+        self.delays['ise1'] = None
+        result, tried = self.hedged_read()
+        # left to read() to try the next server
+        self.assertIsNone(result)
+        self.assertEqual(self.calls, ['ise1'])
+        # read() moves on to a server that answers
+        self.assertEqual(self.tools.read('endpoint/name/' + MAC, {},
+                operation='lookup').json(), {'server': 'ise2'})
+        self.assertEqual(list(self.tools.metrics.values[
+                'ise_failovers_total']), [self.tools.metrics.key(
+                {'server': 'ise1', 'reason': 'unreachable'})])
+
+class OneResponse(object):
+    """Answers every request with the same response."""
+    def __init__(self, response):
+        self.response = response
+
+    def request(self, method, url, **kwargs):
+        return self.response
+
+def answering(response):
+    tools = isetools.ISETools(['ise1'], 'user', 'pass', None)
+    tools.session = lambda server=None: OneResponse(response)
+    return tools
+
+def ers_endpoint(custom=None, **details):
+    endpoint = {'id': 'id1', 'name': MAC, 'groupId': settings.GROUP_ID,
+            'portalUser': 'u1'}
+    if custom is not None:
+        endpoint['customAttributes'] = {'customAttributes': custom}
+    endpoint.update(details)
+    return FakeResponse(200, {'ERSEndPoint': endpoint})
+
+class RaiseErrorTest(unittest.TestCase):
+    def raise_error(self, response):
+        with self.assertRaises(isetools.ISEAPIError) as caught:
+            isetools.ISETools(['ise1'], 'user', 'pass', None).raise_error(
+                    response)
+        return str(caught.exception)
+
+    def test_ers_message(self):
+        self.assertEqual(self.raise_error(ers_error(400,
+                'Invalid MAC address')), 'Invalid MAC address')
+
+    def test_html_page(self):
+        self.assertEqual(self.raise_error(FakeResponse(401,
+                text=NOT_PAN_HTML)),
+                'CRUD operation is allowed on PAP node only')
+
+    def test_unexpected(self):
+        self.assertEqual(self.raise_error(FakeResponse(502,
+                text='Bad Gateway')), 'Unexpected response from ISE')
+        self.assertEqual(self.raise_error(FakeResponse(500, {'other': 1})),
+                'Unexpected response from ISE')
+
+class ParseTest(unittest.TestCase):
+    def test_endpoint(self):
+        tools = answering(ers_endpoint({'iPSK': 'psk=a=b psk=c'}))
+        self.assertEqual(tools.get_endpoint(MAC), {'id': 'id1',
+                'psk': 'a=b psk=c', 'group': settings.GROUP_ID,
+                'unid': 'u1'})
+        # remembered for later lookups and writes
+        self.assertEqual(tools.cache.get(MAC)['psk'], 'a=b psk=c')
+        self.assertEqual(tools.index.get(MAC)['id'], 'id1')
+
+    def test_endpoint_without_psk(self):
+        for custom in (None, {}, {'other': 'x'}):
+            endpoint = answering(ers_endpoint(custom, groupId='other'
+                    )).get_endpoint(MAC)
+            self.assertIsNone(endpoint['psk'])
+            self.assertEqual(endpoint['group'], 'other')
+
+    def test_endpoint_not_found(self):
+        tools = answering(ers_error(404, 'Resource not found'))
+        self.assertIsNone(tools.get_endpoint(MAC))
+        self.assertIsNone(tools.cache.get(MAC))
+
+    def test_endpoint_error(self):
+        tools = answering(FakeResponse(200, text='<html></html>'))
+        with self.assertRaises(isetools.ISEAPIError):
+            tools.get_endpoint(MAC)
+
+    def test_endpointid(self):
+        tools = answering(FakeResponse(200, {'SearchResult': {'total': 1,
+                'resources': [{'id': 'id1', 'name': MAC}]}}))
+        self.assertEqual(tools.get_endpointid(MAC), ('id1', '200'))
+        tools = answering(FakeResponse(200, {'SearchResult': {'total': 0,
+                'resources': []}}))
+        self.assertIsNone(tools.get_endpointid(MAC))
+
+    def test_search_group(self):
+        tools = answering(FakeResponse(200, {'SearchResult': {'total': 3,
+                'resources': [{'id': 'id1', 'name': MAC}]}}))
+        self.assertEqual(tools.search_group(2, size=2), ([('id1', MAC)], 3))
+        tools = answering(FakeResponse(200, {'SearchResult': {'total': 0}}))
+        self.assertEqual(tools.search_group(1), ([], 0))
+        tools = answering(ers_error(400, 'Invalid filter'))
+        with self.assertRaises(isetools.ISEAPIError) as caught:
+            tools.search_group(1)
+        self.assertEqual(str(caught.exception), 'Invalid filter')
+
+class BodyTest(unittest.TestCase):
+    def setUp(self):
+        self.tools = isetools.ISETools(['ise1'], 'user', 'pass', None)
+
+    def test_endpoint_json(self):
+        body = json.loads(self.tools.endpoint_json(MAC, 'a"b\\\\c', 'u<1>'))
+        details = body['ERSEndPoint']
+        self.assertNotIn('id', details)
+        self.assertEqual((details['mac'], details['portalUser'],
+                details['groupId']), (MAC, 'u<1>', settings.GROUP_ID))
+        self.assertEqual(details['customAttributes']['customAttributes'],
+                {'iPSK': 'psk=a"b\\\\c'})
+        body = json.loads(self.tools.endpoint_json(MAC, 'p', 'u1', 'id1'))
+        self.assertEqual(body['ERSEndPoint']['id'], 'id1')
+
+    def test_endpoint_xml(self):
+        # only the bulk API still takes XML
+        from xml.dom import minidom
+        element = minidom.parseString(self.tools.endpoint_xml(MAC,
+                'a<b&c', "u'1", "id'1")).documentElement
+        self.assertEqual(element.getAttribute('id'), "id'1")
+        self.assertEqual(element.getElementsByTagName('value')[0]
+                .firstChild.data, 'psk=a<b&c')
+
+class PanTest(unittest.TestCase):
+    def setUp(self):
+        self.ers = FakeERS(pan='ise2')
+        self.tools = make_tools(self.ers, servers=('ise1', 'ise2', 'ise3'))
+
+    def failovers(self):
+        reasons = {}
+        for key, count in self.tools.metrics.values[
+                'ise_failovers_total'].items():
+            reason = dict(key)['reason']
+            reasons[reason] = reasons.get(reason, 0) + count
+        return reasons
+
+    def test_discover_pan(self):
+        self.assertEqual(self.tools.discover_pan(), 'ise2')
+        self.assertEqual(self.tools.pan(), 'ise2')
+        # the PAN is the node that doesn't turn the delete away
+        self.assertEqual([(server, method) for server, method, path
+                in self.ers.calls], [('ise1', 'DELETE'), ('ise2', 'DELETE')])
+        self.ers.calls = []
+        self.assertEqual(self.tools.set_psk(MAC, 'one', 'u1'), '201')
+        self.assertEqual([server for server, method, path in self.ers.calls
+                if method != 'GET'], ['ise2'])
+
+    def test_discover_pan_skips_unreachable(self):
+        self.ers.pan = 'ise3'
+        self.ers.down.add('ise1')
+        self.assertEqual(self.tools.discover_pan(), 'ise3')
+        self.assertEqual(self.tools.pan(), 'ise3')
+
+    def test_no_pan_found(self):
+        self.ers.pan = None
+        self.assertIsNone(self.tools.discover_pan())
+        self.assertEqual(self.tools.pan(), 'ise1')
+
+    def test_write_follows_not_pan(self):
+        outcome = {}
+        result = self.tools.write('POST', 'endpoint/',
+                self.tools.post_headers, self.tools.endpoint_json(MAC, 'one',
+                'u1'), outcome=outcome)
+        self.assertEqual(result.status_code, 201)
+        self.assertEqual(outcome, {'node': 'ise2'})
+        self.assertEqual(self.failovers(), {'not_pan': 1})
+        # later writes go straight to the new PAN
+        self.ers.calls = []
+        self.assertEqual(self.tools.set_psk(MAC, 'two', 'u1'), '200')
+        self.assertEqual([server for server, method, path in self.ers.calls
+                if method != 'GET'], ['ise2'])
+        self.assertEqual(self.failovers(), {'not_pan': 1})
+
+    def test_write_skips_unreachable(self):
+        self.ers.pan = 'ise3'
+        self.ers.down.add('ise2')
+        result = self.tools.write('DELETE', 'endpoint/id1',
+                self.tools.delete_headers)
+        self.assertEqual(result.status_code, 404)
+        self.assertEqual(self.tools.pan(), 'ise3')
+        self.assertEqual(self.failovers(), {'not_pan': 1, 'unreachable': 1})
+
+    def test_no_server_accepts(self):
+        self.ers.pan = None
+        with self.assertRaises(isetools.ISEAPIError):
+            self.tools.write('DELETE', 'endpoint/id1',
+                    self.tools.delete_headers)
+        self.assertEqual(self.failovers(), {'not_pan': 3})
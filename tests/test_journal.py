@@ -0,0 +1,82 @@
+import os, shutil, tempfile, time, unittest
+
+from journal import Journal
+
+MAC = '74:31:7D:60:9C:9B'
+
+class JournalTest(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.filename = os.path.join(self.folder, 'journal.db')
+        self.journal = Journal(self.filename, retention=60)
+
+    def tearDown(self):
+        self.journal.db.close()
+        shutil.rmtree(self.folder)
+
+    def psk(self, jobid):
+        return self.journal.db.execute('SELECT psk FROM jobs WHERE id=?',
+                (jobid,)).fetchone()['psk']
+
+    def test_add_and_claim(self):
+        jobid = self.journal.add(MAC, 'secret', 'u1')
+        self.assertEqual(self.journal.add(MAC, 'secret', 'u1'), jobid)
+        jobs = self.journal.claim(10)
+        self.assertEqual([(job['id'], job['psk'], job['attempts'])
+                for job in jobs], [(jobid, 'secret', 1)])
+        self.assertEqual(self.journal.claim(10), [])
+        self.assertEqual(self.journal.get(jobid)['status'], 'running')
+
+    def test_finish_clears_psk(self):
+        jobid = self.journal.add(MAC, 'secret', 'u1')
+        self.journal.claim(10)
+        self.journal.finish(jobid, 'done', '200')
+        self.assertEqual(self.journal.get(jobid)['status'], 'done')
+        self.assertEqual(self.psk(jobid), '')
+
+    def test_superseded_clears_psk(self):
+        first = self.journal.add(MAC, 'secret', 'u1')
+        second = self.journal.add(MAC, 'other', 'u1')
+        self.assertEqual(self.journal.get(first)['status'], 'superseded')
+        self.assertEqual(self.journal.get(first)['result'], second)
+        self.assertEqual(self.psk(first), '')
+        self.assertEqual(self.psk(second), 'other')
+
+    def test_old_psks_cleared_on_open(self):
+        jobid = self.journal.add(MAC, 'secret', 'u1')
+        # as left by a version that kept PSKs
+        self.journal.db.execute("UPDATE jobs SET status='failed' WHERE id=?",
+                (jobid,))
+        self.journal.db.close()
+        self.journal = Journal(self.filename)
+        self.assertEqual(self.psk(jobid), '')
+
+    def test_retry(self):
+        jobid = self.journal.add(MAC, 'secret', 'u1')
+        self.journal.claim(10)
+        self.journal.retry(jobid, 'timed out', 60)
+        self.assertEqual(self.journal.claim(10), [])
+        self.journal.retry(jobid, 'timed out', 0)
+        jobs = self.journal.claim(10)
+        self.assertEqual([(job['psk'], job['attempts']) for job in jobs],
+                [('secret', 2)])
+
+    def test_purge(self):
+        finished = self.journal.add(MAC, 'secret', 'u1')
+        self.journal.claim(10)
+        self.journal.finish(finished, 'failed', 'error')
+        pending = self.journal.add('00:00:00:00:00:01', 'secret', 'u1')
+        self.assertEqual(self.journal.purge(), 0)
+        self.journal.db.execute('UPDATE jobs SET updated=?',
+                (time.time() - 120,))
+        self.assertEqual(self.journal.purge(), 1)
+        self.assertIsNone(self.journal.get(finished))
+        self.assertIsNotNone(self.journal.get(pending))
+
+    def test_keep_forever(self):
+        self.journal.retention = None
+        jobid = self.journal.add(MAC, 'secret', 'u1')
+        self.journal.finish(jobid, 'done', '200')
+        self.journal.db.execute('UPDATE jobs SET updated=0')
+        self.assertEqual(self.journal.purge(), 0)
+        self.assertIsNotNone(self.journal.get(jobid))
@@ -0,0 +1,92 @@
+import json, os, shutil, tempfile, time, unittest
+
+from tornado import testing, web
+
+from ledger import Ledger
+import isehandlers, isetools
+
+MAC = '74:31:7D:60:9C:9B'
+OTHER = '00:00:00:00:00:01'
+
+class LedgerTest(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.ledger = Ledger(os.path.join(self.folder, 'ledger.db'),
+                retention=60)
+
+    def tearDown(self):
+        if self.ledger.thread.is_alive():
+            self.ledger.stop()
+        self.ledger.db.close()
+        shutil.rmtree(self.folder)
+
+    def test_record_and_history(self):
+        self.assertTrue(self.ledger.record(MAC, 'u1', 'failed',
+                action='update', status='500', node='ise1', latency=0.25,
+                error='Internal Server Error'))
+        self.ledger.record(MAC, 'u1', 'ok', action='update', status='200',
+                node='ise2', latency=0.1)
+        self.ledger.record(OTHER, 'u2', 'superseded')
+        # stopping writes everything queued first
+        self.ledger.stop()
+        self.assertFalse(self.ledger.thread.is_alive())
+        history = self.ledger.history(mac=MAC)
+        self.assertEqual([(row['outcome'], row['node'], row['latency_ms'])
+                for row in history], [('ok', 'ise2', 100.0),
+                ('failed', 'ise1', 250.0)])
+        self.assertEqual(history[1]['error'], 'Internal Server Error')
+        self.assertEqual([row['mac'] for row in self.ledger.history(
+                unid='u2')], [OTHER])
+        self.assertEqual(len(self.ledger.history()), 3)
+        self.assertEqual(len(self.ledger.history(limit=1)), 1)
+        self.assertEqual(self.ledger.history(mac=MAC, unid='u2'), [])
+
+    def test_full_queue(self):
+        self.ledger.stop()
+        self.ledger.queue.maxsize = 1
+        self.assertTrue(self.ledger.record(MAC, 'u1', 'ok'))
+        self.assertFalse(self.ledger.record(MAC, 'u1', 'ok'))
+
+    def test_prune(self):
+        self.ledger.stop()
+        now = time.time()
+        self.ledger.write(self.ledger.db, [
+                (now - 120, MAC, 'u1', None, 'ok', None, None, None, None),
+                (now, MAC, 'u1', None, 'ok', None, None, None, None)])
+        self.ledger.prune(self.ledger.db)
+        self.assertEqual([row['time'] for row in self.ledger.history()],
+                [now])
+
+class HistoryTest(testing.AsyncHTTPTestCase):
+    def get_app(self):
+        self.folder = tempfile.mkdtemp()
+        self.ledger = Ledger(os.path.join(self.folder, 'ledger.db'))
+        tools = isetools.ISETools(['ise1'], 'user', 'pass', None,
+                ledger=self.ledger)
+        isehandlers.assign_objects(isetools.AsyncISETools(tools, workers=2))
+        return web.Application(isehandlers.handlers)
+
+    def tearDown(self):
+        testing.AsyncHTTPTestCase.tearDown(self)
+        self.ledger.db.close()
+        shutil.rmtree(self.folder)
+
+    def fetch_json(self, path):
+        response = self.fetch(path)
+        return response.code, json.loads(response.body.decode('utf-8'))
+
+    def test_history(self):
+        self.ledger.record(MAC, 'u1', 'ok', action='create', status='201')
+        self.ledger.stop()
+        # any MAC address format is accepted
+        code, body = self.fetch_json('/ise/psk/history?mac=74317d609c9b')
+        self.assertEqual(code, 200)
+        self.assertEqual([(row['mac'], row['outcome'], row['status'])
+                for row in body['result']], [(MAC, 'ok', '201')])
+
+    def test_bad_arguments(self):
+        self.ledger.stop()
+        self.assertEqual(self.fetch_json('/ise/psk/history')[0], 400)
+        self.assertEqual(self.fetch_json(
+                '/ise/psk/history?unid=u1&limit=0')[0], 400)
+        self.assertEqual(self.fetch_json('/ise/psk/history?mac=bad')[0], 400)
@@ -0,0 +1,58 @@
+import unittest
+
+import isetools, maccodec
+
+class NormalizeTest(unittest.TestCase):
+    def test_forms(self):
+        for mac in ['7431.7d60.9c9b', '74-31-7D-60-9C-9B', '74:31:7d:60:9c:9b',
+                '74317D609C9B', ' 74:31:7D:60:9C:9B\n']:
+            self.assertEqual(maccodec.normalize(mac), '74:31:7D:60:9C:9B')
+
+    def test_invalid(self):
+        with self.assertRaisesRegex(SyntaxError, maccodec.ERROR_LENGTH):
+            maccodec.normalize('74:31:7D:60:9C')
+        with self.assertRaisesRegex(SyntaxError, maccodec.ERROR_LENGTH):
+            maccodec.normalize('74:31:7D:60:9C:9G')
+        with self.assertRaisesRegex(SyntaxError, maccodec.ERROR_TYPE):
+            maccodec.normalize(None)
+
+    def test_normalize_many(self):
+        self.assertEqual(maccodec.normalize_many([]), ([], {}))
+        self.assertEqual(maccodec.normalize_many(['7431.7d60.9c9b',
+                '00-00-00-00-00-01']), (['74:31:7D:60:9C:9B',
+                '00:00:00:00:00:01'], {}))
+        self.assertEqual(maccodec.normalize_many(['7431.7d60.9c9b', 'abc',
+                42, 'ffff.ffff.ffff']), (['74:31:7D:60:9C:9B', None, None,
+                'FF:FF:FF:FF:FF:FF'], {1: maccodec.ERROR_LENGTH,
+                2: maccodec.ERROR_TYPE}))
+
+    def test_newline_within_address(self):
+        # can't be split on the joining newlines, so falls back to one at a
+        # time
+        self.assertEqual(maccodec.normalize_many(['7431.7d60\n.9c9b', 'x']),
+                (['74:31:7D:60:9C:9B', None], {1: maccodec.ERROR_LENGTH}))
+
+class IntegerTest(unittest.TestCase):
+    def test_round_trip(self):
+        self.assertEqual(maccodec.to_int('74:31:7D:60:9C:9B'), 0x74317D609C9B)
+        self.assertEqual(maccodec.from_int(0x74317D609C9B), '74:31:7D:60:9C:9B')
+        self.assertEqual(maccodec.from_int(1), '00:00:00:00:00:01')
+        values, errors = maccodec.to_int_many(['7431.7d60.9c9b', 'x', '1'*12])
+        self.assertEqual(values, [0x74317D609C9B, None, 0x111111111111])
+        self.assertEqual(errors, {1: maccodec.ERROR_LENGTH})
+        self.assertEqual(maccodec.from_int_many([0x74317D609C9B,
+                0x111111111111]), ['74:31:7D:60:9C:9B', '11:11:11:11:11:11'])
+
+    def test_out_of_range(self):
+        with self.assertRaises(OverflowError):
+            maccodec.from_int(1 << 48)
+        with self.assertRaises(OverflowError):
+            maccodec.from_int(-1)
+
+class ParseMacTest(unittest.TestCase):
+    def test_parse_mac(self):
+        # every registration goes through here
+        tools = isetools.ISETools(['ise1'], 'user', 'pass', None)
+        self.assertEqual(tools.parse_mac('7431.7d60.9c9b'), '74:31:7D:60:9C:9B')
+        with self.assertRaisesRegex(SyntaxError, maccodec.ERROR_LENGTH):
+            tools.parse_mac('7431.7d60')
@@ -0,0 +1,41 @@
+import threading, unittest
+
+from maildispatcher import MailDispatcher
+
+class FakeEmailer(object):
+    def __init__(self):
+        self.sent = []
+        self.thread = None
+
+    def send_email(self, subject, message, to, **kwargs):
+        self.thread = threading.current_thread()
+        self.sent.append((subject, message, to, kwargs))
+
+class MailDispatcherTest(unittest.TestCase):
+    def test_stop_sends_queue_and_digest(self):
+        emailer = FakeEmailer()
+        mailer = MailDispatcher(emailer, 'Failures', ['admin@example.com'],
+                digest_header='<ul>', digest_footer='</ul>',
+                digest_interval=3600)
+        self.assertTrue(mailer.send('Hello', 'Message', 'user@example.com',
+                html=True))
+        mailer.add_to_digest('<li>one</li>')
+        mailer.add_to_digest('<li>two</li>')
+        mailer.stop()
+        self.assertFalse(mailer.thread.is_alive())
+        self.assertEqual(emailer.sent, [
+                ('Hello', 'Message', 'user@example.com', {'html': True}),
+                ('Failures (2)', '<ul><li>one</li><li>two</li></ul>',
+                ['admin@example.com'], {'html': True})])
+        self.assertIs(emailer.thread, mailer.thread)
+
+    def test_full_queue(self):
+        emailer = FakeEmailer()
+        ready = threading.Event()
+        emailer.send_email = lambda *args, **kwargs: ready.wait(5)
+        mailer = MailDispatcher(emailer, 'Failures', [], maxsize=1)
+        mailer.send('Blocks', '', 'a')
+        sent = [mailer.send('Queued', '', 'b') for _ in range(3)]
+        self.assertIn(False, sent)
+        ready.set()
+        mailer.stop()
@@ -0,0 +1,34 @@
+import types, unittest
+
+import main
+
+def valid_settings(**overrides):
+    values = dict(ISE_SERVERLIST=['ise1', 'ise2'], ISE_USERNAME='user',
+            ISE_PASSWORD='pass', GROUP_ID='group', CERTFILE='ipsk.cer',
+            KEYFILE='ipsk.key')
+    values.update(overrides)
+    return types.SimpleNamespace(**values)
+
+class CheckSettingsTest(unittest.TestCase):
+    def test_valid(self):
+        main.check_settings(valid_settings())
+        main.check_settings(valid_settings(ISE_WORKERS=20,
+                ISE_INDEX_MAX_AGE=None, ISE_VERIFY='ca.pem',
+                ISE_HEDGE_READS=True))
+
+    def test_problems_listed_together(self):
+        settings = valid_settings(ISE_SERVERLIST=[], ISE_WORKERS=0,
+                ISE_CACHE_TTL='300', ISE_HEDGE_READS=1)
+        del settings.ISE_PASSWORD
+        with self.assertRaises(ValueError) as caught:
+            main.check_settings(settings)
+        self.assertEqual(str(caught.exception).split('\n    ')[1:], [
+                'ISE_CACHE_TTL should be a number of seconds',
+                'ISE_HEDGE_READS should be True or False',
+                'missing ISE_PASSWORD, should be a string',
+                'ISE_SERVERLIST should be a list of IP/FQDN strings',
+                'ISE_WORKERS should be a number, at least 1'])
+
+    def test_booleans_are_not_numbers(self):
+        with self.assertRaises(ValueError):
+            main.check_settings(valid_settings(ISE_CACHE_SIZE=True))
@@ -0,0 +1,101 @@
+import unittest
+
+from tornado import testing, web
+
+from metrics import Metrics, Trace
+import isehandlers, isetools
+
+class MetricsTest(unittest.TestCase):
+    def setUp(self):
+        self.metrics = Metrics(buckets=(0.1, 1))
+        self.metrics.trace_hooks = []
+
+    def test_counters_and_gauges(self):
+        self.metrics.inc('ise_cache_hits_total')
+        self.metrics.inc('ise_cache_hits_total', amount=2)
+        self.metrics.inc('ise_requests_in_flight', {'server': 'ise1'})
+        self.metrics.inc('ise_requests_in_flight', {'server': 'ise1'}, -1)
+        self.metrics.set('ise_circuit_open', {'server': 'ise1'}, 1)
+        text = self.metrics.render()
+        self.assertIn('# TYPE ise_cache_hits_total counter\n' +
+                'ise_cache_hits_total 3\n', text)
+        self.assertIn('ise_requests_in_flight{server="ise1"} 0\n', text)
+        self.assertIn('ise_circuit_open{server="ise1"} 1\n', text)
+
+    def test_histogram(self):
+        labels = {'server': 'ise1', 'operation': 'lookup'}
+        for value in (0.05, 0.5, 5):
+            self.metrics.observe('ise_request_duration_seconds', labels,
+                    value)
+        lines = [line for line in self.metrics.render().splitlines()
+                if line.startswith('ise_request_duration_seconds')]
+        prefix = ('ise_request_duration_seconds_bucket{operation="lookup",' +
+                'server="ise1",')
+        self.assertEqual(lines, [prefix + 'le="0.1"} 1',
+                prefix + 'le="1"} 2', prefix + 'le="+Inf"} 3',
+                'ise_request_duration_seconds_sum{operation="lookup",' +
+                'server="ise1"} 5.55',
+                'ise_request_duration_seconds_count{operation="lookup",' +
+                'server="ise1"} 3'])
+
+    def test_label_escaping(self):
+        self.metrics.inc('ise_failovers_total', {'server': 'a"b\\c\nd',
+                'reason': 'unreachable'})
+        self.assertIn('ise_failovers_total{reason="unreachable",' +
+                'server="a\\"b\\\\c\\nd"} 1\n', self.metrics.render())
+
+    def test_collectors(self):
+        self.metrics.add_collector(lambda metrics: metrics.set(
+                'ise_cache_size', None, 42))
+        self.assertIn('ise_cache_size 42\n', self.metrics.render())
+
+class TraceTest(unittest.TestCase):
+    def test_stages(self):
+        metrics = Metrics(buckets=(0.1, 1))
+        traces = []
+        metrics.trace_hooks = [lambda name, total, stages: traces.append(
+                (name, [stage for stage, seconds in stages]))]
+        trace = metrics.trace('psk_get')
+        with trace.stage('lookup'):
+            pass
+        with self.assertRaises(KeyError):
+            with trace.stage('write'):
+                raise KeyError('failed stages are timed too')
+        trace.finish()
+        self.assertEqual(traces, [('psk_get', ['lookup', 'write'])])
+        self.assertEqual(metrics.values['ipsk_request_duration_seconds'][
+                metrics.key({'request': 'psk_get'})][-1], 1)
+        self.assertEqual(metrics.values['ipsk_stage_duration_seconds'][
+                metrics.key({'request': 'psk_get', 'stage': 'lookup'})][-1],
+                1)
+
+    def test_failing_hook(self):
+        metrics = Metrics()
+        def hook(name, total, stages):
+            raise ValueError('broken hook')
+        metrics.trace_hooks = [hook]
+        metrics.trace('psk_get').finish()
+        self.assertEqual(len(metrics.values['ipsk_request_duration_seconds']),
+                1)
+
+    def test_without_metrics(self):
+        trace = Trace('psk_get')
+        with trace.stage('lookup'):
+            pass
+        trace.finish()
+        self.assertEqual([stage for stage, seconds in trace.stages],
+                ['lookup'])
+
+class MetricsHandlerTest(testing.AsyncHTTPTestCase):
+    def get_app(self):
+        tools = isetools.ISETools(['ise1'], 'user', 'pass', None)
+        isehandlers.assign_objects(isetools.AsyncISETools(tools, workers=2))
+        return web.Application(isehandlers.handlers)
+
+    def test_metrics(self):
+        response = self.fetch('/metrics')
+        self.assertEqual(response.code, 200)
+        self.assertTrue(response.headers['Content-Type'].startswith(
+                'text/plain'))
+        self.assertIn('# TYPE ise_requests_total counter',
+                response.body.decode('utf-8'))
@@ -0,0 +1,143 @@
+import time, unittest
+
+import isetools
+from admission import Overloaded
+from deadline import Deadline, DeadlineExceeded
+from nodehealth import NodeHealth, LatencyWindow
+
+def fail(health, times=1):
+    for _ in range(times):
+        health.begin()
+        health.record(False, 0.1)
+
+class NodeHealthTest(unittest.TestCase):
+    def test_opens_after_consecutive_failures(self):
+        health = NodeHealth(consecutive=3, backoff=5)
+        fail(health, 2)
+        self.assertEqual(health.state, NodeHealth.CLOSED)
+        self.assertTrue(health.available())
+        fail(health)
+        self.assertEqual(health.state, NodeHealth.OPEN)
+        self.assertFalse(health.available())
+        self.assertAlmostEqual(health.retry_time() - time.time(), 5, delta=1)
+
+    def test_opens_on_error_rate(self):
+        health = NodeHealth(window=20, threshold=0.5, consecutive=100)
+        for _ in range(4):
+            health.begin()
+            health.record(True, 0.1)
+        fail(health, 3)
+        self.assertEqual(health.state, NodeHealth.CLOSED)
+        fail(health)
+        self.assertEqual(health.state, NodeHealth.OPEN)
+
+    def test_trial(self):
+        health = NodeHealth(consecutive=1, backoff=5)
+        fail(health)
+        health.retry_at = time.monotonic() - 1
+        # checking doesn't claim the trial, sending does
+        self.assertTrue(health.available())
+        self.assertTrue(health.available())
+        self.assertEqual(health.state, NodeHealth.OPEN)
+        health.begin()
+        self.assertEqual(health.state, NodeHealth.HALF_OPEN)
+        self.assertFalse(health.available())
+        health.record(True, 0.1)
+        self.assertEqual(health.state, NodeHealth.CLOSED)
+        self.assertTrue(health.available())
+
+    def test_failed_trial_doubles_backoff(self):
+        health = NodeHealth(consecutive=1, backoff=5)
+        fail(health)
+        health.retry_at = time.monotonic() - 1
+        fail(health)
+        self.assertEqual(health.state, NodeHealth.OPEN)
+        self.assertAlmostEqual(health.retry_at - time.monotonic(), 10,
+                delta=1)
+
+    def test_aborted_trial(self):
+        # e.g. turned away by the Limiter or out of time before sending
+        health = NodeHealth(consecutive=1)
+        fail(health)
+        health.retry_at = time.monotonic() - 1
+        health.begin()
+        health.abort()
+        self.assertEqual(health.inflight, 0)
+        self.assertTrue(health.available())
+        health.begin()
+        health.record(True, 0.1)
+        self.assertEqual(health.state, NodeHealth.CLOSED)
+
+    def test_stale_trial(self):
+        health = NodeHealth(consecutive=1, trial_timeout=60)
+        fail(health)
+        health.retry_at = time.monotonic() - 1
+        health.begin()
+        self.assertFalse(health.available())
+        health.trial_at -= 61
+        self.assertTrue(health.available())
+        self.assertEqual(health.state, NodeHealth.OPEN)
+
+    def test_open_until(self):
+        health = NodeHealth()
+        health.open_until(time.time() + 30)
+        self.assertEqual(health.state, NodeHealth.OPEN)
+        self.assertFalse(health.available())
+        # already open for longer
+        health.open_until(time.time() + 10)
+        self.assertAlmostEqual(health.retry_time() - time.time(), 30,
+                delta=1)
+
+    def test_score(self):
+        health = NodeHealth()
+        self.assertEqual(health.score(), 0.0)
+        health.begin()
+        health.record(True, 0.2)
+        health.begin()
+        self.assertAlmostEqual(health.score(), 0.4)
+        self.assertEqual(health.status(), {'state': NodeHealth.CLOSED,
+                'latency_ms': 200.0, 'error_rate': 0.0, 'inflight': 1})
+
+class BrokenSession(object):
+    def request(self, *args, **kwargs):
+        raise ValueError('not a network error')
+
+class SendTest(unittest.TestCase):
+    """Trials that ISETools.send never gets an answer for must not leave the
+    circuit half-open.
+    """
+    def setUp(self):
+        self.tools = isetools.ISETools(['ise1'], 'user', 'pass', None,
+                limits={'read': {'queue': 0}})
+        self.health = self.tools.health['ise1']
+        fail(self.health, self.health.consecutive)
+        self.health.retry_at = time.monotonic() - 1
+
+    def test_limiter_turned_away(self):
+        with self.assertRaises(Overloaded):
+            self.tools.read('endpoint', {})
+        self.assertEqual(self.health.state, NodeHealth.OPEN)
+        self.assertTrue(self.health.available())
+
+    def test_out_of_time(self):
+        deadline = Deadline(10)
+        deadline.cancel()
+        with self.assertRaises(DeadlineExceeded):
+            self.tools.write('POST', 'endpoint', {}, deadline=deadline)
+        self.assertTrue(self.health.available())
+
+    def test_not_an_answer(self):
+        self.tools.session = lambda server: BrokenSession()
+        with self.assertRaises(ValueError):
+            self.tools.write('POST', 'endpoint', {})
+        self.assertEqual(self.health.inflight, 0)
+        self.assertTrue(self.health.available())
+
+class LatencyWindowTest(unittest.TestCase):
+    def test_percentile(self):
+        window = LatencyWindow(size=100)
+        for i in range(1, 11):
+            window.add(i / 10.0)
+        self.assertIsNone(window.percentile(95))
+        self.assertEqual(window.percentile(95, minimum=10), 1.0)
+        self.assertEqual(window.percentile(50, minimum=10), 0.5)
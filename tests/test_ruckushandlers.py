@@ -0,0 +1,108 @@
+import json, unittest
+
+from tornado import testing, web
+
+from ruckushandlers import (CSVUpload, MAX_COUNT, PASSPHRASE_CHARS,
+        RegularDPSK, RuckusDPSK, generate_passphrases)
+
+BOUNDARY = b'----boundary'
+
+def multipart(data, boundary=BOUNDARY):
+    return (b'--' + boundary + b'\r\n'
+            b'Content-Disposition: form-data; name="note"\r\n\r\n'
+            b'not the file\r\n'
+            b'--' + boundary + b'\r\n'
+            b'Content-Disposition: form-data; name="file"; '
+            b'filename="users.csv"\r\n'
+            b'Content-Type: text/csv\r\n\r\n' + data + b'\r\n'
+            b'--' + boundary + b'--\r\n')
+
+def parse(upload, body, size):
+    for i in range(0, len(body), size):
+        upload.feed(body[i:i + size])
+    return upload.finish()
+
+CSV = b'User Name,Note\r\nalice,"a, b"\r\nbob,\r\n\r\ncarol,x'
+ROWS = [['User Name', 'Note'], ['alice', 'a, b'], ['bob', ''], [],
+        ['carol', 'x']]
+
+class CSVUploadTest(unittest.TestCase):
+    def test_plain(self):
+        self.assertEqual(parse(CSVUpload(), CSV, len(CSV)), ROWS)
+
+    def test_plain_in_chunks(self):
+        for size in (1, 2, 7):
+            self.assertEqual(parse(CSVUpload(), CSV, size), ROWS)
+
+    def test_multipart(self):
+        body = multipart(CSV)
+        for size in (1, 3, 16, len(body)):
+            self.assertEqual(parse(CSVUpload(BOUNDARY), body, size), ROWS)
+
+    def test_multipart_without_file(self):
+        body = (b'--' + BOUNDARY + b'\r\n'
+                b'Content-Disposition: form-data; name="note"\r\n\r\n'
+                b'alice\r\n--' + BOUNDARY + b'--\r\n')
+        self.assertEqual(parse(CSVUpload(BOUNDARY), body, 5), [])
+
+class GeneratePassphrasesTest(unittest.TestCase):
+    def test_passphrases(self):
+        passphrases = generate_passphrases(100)
+        self.assertEqual(len(passphrases), 100)
+        for passphrase in passphrases:
+            self.assertEqual(len(passphrase), 12)
+            self.assertTrue(set(passphrase) <= set(PASSPHRASE_CHARS))
+        self.assertEqual(generate_passphrases(3, length=5, alphabet='a'),
+                ['aaaaa'] * 3)
+
+class RuckusDPSKTest(testing.AsyncHTTPTestCase):
+    def get_app(self):
+        return web.Application([(r'/dpsk', RuckusDPSK)])
+
+    def test_upload(self):
+        response = self.fetch('/dpsk', method='POST', body=multipart(CSV),
+                headers={'Content-Type': 'multipart/form-data; boundary=' +
+                BOUNDARY.decode('ascii')})
+        self.assertEqual(response.code, 201)
+        result = json.loads(response.body.decode('utf-8'))
+        self.assertEqual(result['resultCount'], 3)
+        self.assertEqual([dpsk['userName'] for dpsk in
+                result['dpskInfoList']], ['alice', 'bob', 'carol'])
+        self.assertEqual([dpsk['id'] for dpsk in result['dpskInfoList']],
+                ['dpskid', 'dpskid2', 'dpskid3'])
+
+    def test_empty(self):
+        response = self.fetch('/dpsk', method='POST', body=b'User Name\r\n',
+                headers={'Content-Type': 'text/csv'})
+        self.assertEqual(response.code, 400)
+
+    def test_plain_upload(self):
+        response = self.fetch('/dpsk', method='POST', body=CSV,
+                headers={'Content-Type': 'text/csv'})
+        self.assertEqual(response.code, 201)
+        self.assertEqual(json.loads(response.body.decode('utf-8'))[
+                'resultCount'], 3)
+
+class RegularDPSKTest(testing.AsyncHTTPTestCase):
+    def get_app(self):
+        return web.Application([(r'/generate', RegularDPSK)])
+
+    def fetch_json(self, path):
+        response = self.fetch(path)
+        return response.code, json.loads(response.body.decode('utf-8'))
+
+    def test_one(self):
+        code, body = self.fetch_json('/generate')
+        self.assertEqual(code, 200)
+        self.assertEqual(len(body['result']), 12)
+
+    def test_count(self):
+        code, body = self.fetch_json('/generate?count=5')
+        self.assertEqual(code, 200)
+        self.assertEqual(len(body['result']), 5)
+        self.assertEqual(len(set(body['result'])), 5)
+
+    def test_bad_count(self):
+        for count in ('0', 'x', str(MAX_COUNT + 1)):
+            self.assertEqual(self.fetch_json('/generate?count=' + count)[0],
+                    400)
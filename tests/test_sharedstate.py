@@ -0,0 +1,92 @@
+import os, shutil, tempfile, time, unittest
+
+from sharedstate import SharedState
+import isetools, settings
+
+MAC = '74:31:7D:60:9C:9B'
+
+ENDPOINT = {'id': 'id1', 'psk': 'secret', 'group': settings.GROUP_ID,
+        'unid': 'u1'}
+
+class SharedStateTest(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.filename = os.path.join(self.folder, 'state.db')
+        self.first = SharedState(self.filename)
+        self.second = SharedState(self.filename)
+        # as if it were another process
+        self.second.pid = self.first.pid + 1
+
+    def tearDown(self):
+        self.first.db.close()
+        self.second.db.close()
+        shutil.rmtree(self.folder)
+
+    def test_set_and_get_all(self):
+        self.first.set('pan', 'ise2')
+        self.first.set('open:ise1', 1.5)
+        self.first.set('pan', 'ise1')
+        self.assertEqual(self.second.get_all(), {'pan': 'ise1',
+                'open:ise1': 1.5})
+
+    def test_publish_and_poll(self):
+        self.first.publish(MAC, ENDPOINT)
+        self.first.publish(MAC, None)
+        self.assertEqual(self.second.poll(), [(MAC, ENDPOINT), (MAC, None)])
+        self.assertEqual(self.second.poll(), [])
+        # a process doesn't hear its own changes
+        self.assertEqual(self.first.poll(), [])
+
+    def test_new_process_skips_old_changes(self):
+        self.first.publish(MAC, ENDPOINT)
+        third = SharedState(self.filename)
+        third.pid = self.first.pid + 2
+        self.assertEqual(third.poll(), [])
+        third.db.close()
+
+    def test_old_changes_cleaned_up(self):
+        self.second.keep = 60
+        self.first.publish(MAC, ENDPOINT)
+        self.first.db.execute('UPDATE events SET time=?',
+                (time.time() - 120,))
+        # still delivered once, then removed
+        self.assertEqual(len(self.second.poll()), 1)
+        self.assertEqual(self.first.db.execute('SELECT COUNT(*) FROM events'
+                ).fetchone()[0], 0)
+
+class SyncSharedTest(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        filename = os.path.join(self.folder, 'state.db')
+        self.first = isetools.ISETools(['ise1', 'ise2'], 'user', 'pass', None)
+        self.first.shared = SharedState(filename)
+        self.second = isetools.ISETools(['ise1', 'ise2'], 'user', 'pass',
+                None)
+        self.second.shared = SharedState(filename)
+        self.second.shared.pid = self.first.shared.pid + 1
+
+    def tearDown(self):
+        self.first.shared.db.close()
+        self.second.shared.db.close()
+        shutil.rmtree(self.folder)
+
+    def test_endpoint_changes(self):
+        self.first.remember(MAC, ENDPOINT)
+        self.second.sync_shared()
+        self.assertEqual(self.second.cache.get(MAC), ENDPOINT)
+        self.assertEqual(self.second.index.get(MAC), ENDPOINT)
+        self.first.forget(MAC)
+        self.second.sync_shared()
+        self.assertIsNone(self.second.cache.get(MAC))
+        # picked up changes aren't passed on again
+        self.assertEqual(self.first.shared.poll(), [])
+
+    def test_pan_and_open_circuits(self):
+        self.first.shared.set('pan', 'ise2')
+        self.first.shared.set('open:ise1', time.time() + 60)
+        self.second.sync_shared()
+        self.assertEqual(self.second.pan(), 'ise2')
+        self.assertEqual(self.second.health['ise1'].state,
+                self.second.health['ise1'].OPEN)
+        self.assertEqual(self.second.health['ise2'].state,
+                self.second.health['ise2'].CLOSED)
@@ -0,0 +1,90 @@
+import os, signal, time, unittest
+
+from supervisor import Supervisor
+
+def worker(notify):
+    # ready right away, then serves until SIGTERM
+    os.write(notify, b'1')
+    os.close(notify)
+    while True:
+        signal.pause()
+
+def stubborn_worker(notify):
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    worker(notify)
+
+def failing_worker(notify):
+    os.close(notify)
+    raise RuntimeError('failed to start')
+
+def running(pid):
+    try:
+        return os.waitpid(pid, os.WNOHANG)[0] == 0
+    except ChildProcessError:
+        return False
+
+class SupervisorTest(unittest.TestCase):
+    def setUp(self):
+        self.supervisors = []
+
+    def tearDown(self):
+        for supervisor in self.supervisors:
+            for pid in list(supervisor.children):
+                os.kill(pid, signal.SIGKILL)
+                os.waitpid(pid, 0)
+
+    def make_supervisor(self, target, **kwargs):
+        supervisor = Supervisor(target, 2, **kwargs)
+        self.supervisors.append(supervisor)
+        return supervisor
+
+    def test_spawn_and_stop(self):
+        supervisor = self.make_supervisor(worker)
+        pid, ready = supervisor.spawn()
+        self.assertTrue(supervisor.wait_ready(ready))
+        self.assertEqual(supervisor.children, {pid})
+        supervisor.stop_child(pid)
+        self.assertEqual(supervisor.children, set())
+        self.assertFalse(running(pid))
+
+    def test_not_ready(self):
+        supervisor = self.make_supervisor(failing_worker)
+        pid, ready = supervisor.spawn()
+        self.assertFalse(supervisor.wait_ready(ready))
+        os.waitpid(pid, 0)
+        supervisor.children.discard(pid)
+
+    def test_stop_children_kills_stubborn(self):
+        supervisor = self.make_supervisor(stubborn_worker, stop_timeout=0.2)
+        pids = []
+        for _ in range(2):
+            pid, ready = supervisor.spawn()
+            self.assertTrue(supervisor.wait_ready(ready))
+            pids.append(pid)
+        started = time.monotonic()
+        supervisor.stop_children(pids)
+        # stopped together, so one timeout rather than one each
+        self.assertLess(time.monotonic() - started, 2)
+        self.assertFalse(any(running(pid) for pid in pids))
+
+    def test_rolling_restart(self):
+        supervisor = self.make_supervisor(worker)
+        old = []
+        for _ in range(2):
+            pid, ready = supervisor.spawn()
+            self.assertTrue(supervisor.wait_ready(ready))
+            old.append(pid)
+        supervisor.rolling_restart()
+        self.assertEqual(len(supervisor.children), 2)
+        self.assertFalse(supervisor.children & set(old))
+        self.assertFalse(any(running(pid) for pid in old))
+
+    def test_rolling_restart_stops_on_failure(self):
+        supervisor = self.make_supervisor(worker)
+        pid, ready = supervisor.spawn()
+        self.assertTrue(supervisor.wait_ready(ready))
+        supervisor.target = failing_worker
+        supervisor.rolling_restart()
+        # the old worker is kept when its replacement doesn't start
+        self.assertIn(pid, supervisor.children)
+        self.assertTrue(running(pid))